@@ -1,16 +1,27 @@
 import streamlit as st
-from transformers import AutoImageProcessor, AutoModelForImageClassification
-from PIL import Image
-import torch
-import matplotlib.pyplot as plt
 import numpy as np
 
+import os
+import time
+import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
 from io import BytesIO
 from typing import Literal
 
+from utils import tracing
+from utils.admission import AdmissionController, ServerBusy
+from utils.batching import result_or_cancel
+from utils.cache import PredictionCache
+from utils.fetch import DEFAULT_CACHE_DIR, ImageFetchError, fetch_image_bytes
+from utils.image_store import DEFAULT_MAX_PIXELS, ImageStore, ImageTooLargeError, StoredImage
 from utils.descriptions import lesion_descriptions, lesion_names
 
+# Heavy modules (torch, transformers) are imported inside the functions using them,
+# so the first page is painted before they are loaded
+
 # Set page config
 st.set_page_config(page_title="Skin Cancer Recognition", page_icon="🔬", layout="wide")
 
@@ -88,13 +99,203 @@ def set_color(key: str, style: Literal["red", "green", "yellow", "grey"], align:
 
 
 # Load the model and processor
+# Without network access if MODEL_DIR points to a bundle made by build_bundle.py
 @st.cache_resource
 def load_model():
-    processor = AutoImageProcessor.from_pretrained("Anwarkh1/Skin_Cancer-Image_Classification")
-    model = AutoModelForImageClassification.from_pretrained("Anwarkh1/Skin_Cancer-Image_Classification")
-    return processor, model
+    from utils.model import load_processor_and_model
+    return load_processor_and_model()
 
-processor, model = load_model()
+@st.cache_resource
+def load_preprocessor():
+    from utils.preprocessing import FastPreprocessor
+    return FastPreprocessor.from_processor(load_model()[0])
+
+# Cache of predictions shared by all sessions, so reruns and repeated uploads skip the model
+@st.cache_resource
+def load_prediction_cache():
+    from utils.backends import backend_name
+    from utils.model import model_revision
+    return PredictionCache(
+        max_entries=int(os.environ.get("PREDICTION_CACHE_SIZE", 256)),
+        ttl_seconds=float(os.environ.get("PREDICTION_CACHE_TTL", 3600)),
+        disk_dir=os.environ.get("PREDICTION_CACHE_DIR") or None,
+        max_disk_entries=int(os.environ.get("PREDICTION_CACHE_DISK_ENTRIES", 4096)),
+        # The disk tier may be shared with processes running another model or backend
+        namespace=f"{model_revision(model=load_model()[1])}:{backend_name()}",
+    )
+
+# Compressed images of all sessions, images of idle sessions are evicted when over the budget
+@st.cache_resource
+def load_image_store():
+    return ImageStore(
+        budget_bytes=int(float(os.environ.get("IMAGE_STORE_BUDGET_MB", 512)) * 2**20),
+        idle_seconds=float(os.environ.get("IMAGE_STORE_IDLE_SECONDS", 3600)),
+    )
+
+# Inference service shared by all sessions, it batches requests of concurrent users
+@st.cache_resource(show_spinner="Loading the AI model...")
+def load_batcher():
+    from utils.backends import load_backend
+    from utils.batching import MicroBatcher
+    from utils.model import warm_up
+
+    # With INFERENCE_WORKERS=N the model runs in N processes, each with its own thread budget
+    num_workers = int(os.environ.get("INFERENCE_WORKERS", 0))
+    if num_workers > 0:
+        from utils.workers import WorkerPool
+        return WorkerPool(
+            num_workers,
+            threads_per_worker=int(os.environ.get("THREADS_PER_WORKER", 0)) or None,
+            pin_cores=os.environ.get("PIN_CORES", "") not in ("", "0"),
+            max_batch_size=int(os.environ.get("MICRO_BATCH_SIZE", 8)),
+        )
+
+    # Backend is selected by the INFERENCE_BACKEND environment variable (eager, int8 or onnx)
+    backend = load_backend(load_model()[1])
+    warm_up(backend, load_preprocessor())
+    return MicroBatcher(
+        backend,
+        max_batch_size=int(os.environ.get("MICRO_BATCH_SIZE", 8)),
+        max_wait_ms=float(os.environ.get("MICRO_BATCH_WAIT_MS", 5)),
+    )
+
+# Index of labeled reference images, enabled by the LESION_INDEX_DIR environment variable
+@st.cache_resource
+def load_lesion_index():
+    index_dir = os.environ.get("LESION_INDEX_DIR")
+    if not index_dir:
+        return None
+    from utils.batching import MicroBatcher
+    from utils.similarity import Embedder, LesionIndex
+
+    # The index holds fp32 embeddings, the int8 backend quantizes a copy of the shared model
+    embedder = MicroBatcher(Embedder(load_model()[1]), max_batch_size=int(os.environ.get("MICRO_BATCH_SIZE", 8)),
+                            max_wait_ms=float(os.environ.get("MICRO_BATCH_WAIT_MS", 5)))
+    return LesionIndex(index_dir, nprobe=int(os.environ.get("LESION_INDEX_NPROBE", 8))), embedder
+
+# Bounds the requests using the model at once and those waiting for it, requests beyond are turned away
+@st.cache_resource
+def load_admission():
+    timeout = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", 30))
+    return AdmissionController(
+        max_concurrency=int(os.environ.get("MAX_CONCURRENT_PREDICTIONS", 4)),
+        max_queue=int(os.environ.get("MAX_QUEUED_PREDICTIONS", 16)),
+        timeout_seconds=timeout if timeout > 0 else None,
+    )
+
+# Test-time augmentation of uncertain predictions, enabled by the TTA environment variable
+@st.cache_resource
+def load_tta():
+    if os.environ.get("TTA", "") in ("", "0"):
+        return None
+    from utils.tta import AdaptiveTTA
+    return AdaptiveTTA(
+        load_batcher().submit,
+        min_margin=float(os.environ.get("TTA_MIN_MARGIN", 0.2)),
+        max_entropy=float(os.environ.get("TTA_MAX_ENTROPY", 1.0)),
+    )
+
+# Audit log of every prediction, enabled by the AUDIT_LOG environment variable (SQLite file)
+@st.cache_resource
+def load_audit_log():
+    path = os.environ.get("AUDIT_LOG")
+    if not path:
+        return None
+    from utils.audit import AuditLog
+    from utils.backends import backend_name
+    from utils.model import model_revision
+    model = load_model()[1]
+    id2label = model.config.id2label
+    return AuditLog(
+        path,
+        model=model_revision(model=model),
+        labels=[id2label[i] for i in range(len(id2label))],
+        backend=backend_name(),
+        tta=load_tta() is not None,
+        max_buffer=int(os.environ.get("AUDIT_LOG_BUFFER", 10000)),
+    )
+
+# Prometheus metrics on a local port, enabled by the TRACING environment variable
+@st.cache_resource
+def start_metrics_server():
+    def prediction_cache_metrics():
+        stats = load_prediction_cache().stats()
+        return [
+            "# TYPE skin_prediction_cache_hits_total counter",
+            f"skin_prediction_cache_hits_total {stats['hits'] + stats['disk_hits']}",
+            "# TYPE skin_prediction_cache_misses_total counter",
+            f"skin_prediction_cache_misses_total {stats['misses']}",
+        ]
+
+    tracing.register_collector(prediction_cache_metrics)
+
+    def image_store_metrics():
+        stats = load_image_store().stats()
+        return [
+            "# TYPE skin_image_store_bytes gauge",
+            f"skin_image_store_bytes {stats['bytes']}",
+            "# TYPE skin_image_store_sessions gauge",
+            f"skin_image_store_sessions {stats['sessions']}",
+            "# TYPE skin_image_store_evictions_total counter",
+            f"skin_image_store_evictions_total {stats['evictions']}",
+        ]
+    tracing.register_collector(image_store_metrics)
+
+    def tta_metrics():
+        tta = load_tta()
+        if tta is None:
+            return []
+        stats = tta.stats()
+        return [
+            "# TYPE skin_tta_requests_total counter",
+            f"skin_tta_requests_total {stats['requests']}",
+            "# TYPE skin_tta_escalated_total counter",
+            f"skin_tta_escalated_total {stats['escalated']}",
+            "# TYPE skin_tta_added_seconds_total counter",
+            f"skin_tta_added_seconds_total {stats['added_seconds']}",
+        ]
+    tracing.register_collector(tta_metrics)
+
+    def admission_metrics():
+        stats = load_admission().stats()
+        return [
+            "# TYPE skin_admission_active gauge",
+            f"skin_admission_active {stats['active']}",
+            "# TYPE skin_admission_queue_depth gauge",
+            f"skin_admission_queue_depth {stats['queued']}",
+            "# TYPE skin_admission_admitted_total counter",
+            f"skin_admission_admitted_total {stats['admitted']}",
+            "# TYPE skin_admission_rejected_total counter",
+            f"skin_admission_rejected_total {stats['rejected']}",
+            "# TYPE skin_admission_timed_out_total counter",
+            f"skin_admission_timed_out_total {stats['timed_out']}",
+        ]
+    tracing.register_collector(admission_metrics)
+
+    def audit_log_metrics():
+        audit_log = load_audit_log()
+        if audit_log is None:
+            return []
+        stats = audit_log.stats()
+        return [
+            "# TYPE skin_audit_log_written_total counter",
+            f"skin_audit_log_written_total {stats['written']}",
+            "# TYPE skin_audit_log_dropped_total counter",
+            f"skin_audit_log_dropped_total {stats['dropped'] + stats['failed']}",
+            "# TYPE skin_audit_log_queued gauge",
+            f"skin_audit_log_queued {stats['queued']}",
+        ]
+    tracing.register_collector(audit_log_metrics)
+
+    def startup_metrics():
+        # Imported when scraped, the model code is not needed to paint the page
+        from utils.model import render_startup_metrics
+        return render_startup_metrics()
+    tracing.register_collector(startup_metrics)
+    return tracing.start_metrics_server(int(os.environ.get("METRICS_PORT", 9464)))
+
+if tracing.enabled:
+  start_metrics_server()
 
 # Custom HTML layout
 st.markdown("""
@@ -125,87 +326,300 @@ st.markdown("""
 
 
 
-if "image" not in st.session_state:
-  st.session_state["image"] = None
+# The images are kept in the image store shared by all sessions, the session state holds only the id
+if "session_id" not in st.session_state:
+  st.session_state["session_id"] = uuid.uuid4().hex
+
+# Larger images are rejected before they are decoded
+max_image_pixels = int(float(os.environ.get("MAX_IMAGE_PIXELS", DEFAULT_MAX_PIXELS)))
+
+# Set when images were submitted, so an eviction can be told apart from no upload
+if "submitted" not in st.session_state:
+  st.session_state["submitted"] = False
+
+
+def audit_prediction(stored: StoredImage) -> None:
+  """
+  Records the prediction of an image in the audit log, if one is configured.
+  The record is only queued, the background writer of the log stores it.
+  """
+  if audit_log is not None:
+    logits = stored.logits[0]
+    probabilities = np.exp(logits - logits.max())
+    # The digest of the file as submitted, a downscaled copy may have been stored instead
+    audit_log.record(stored.original_digest, probabilities / probabilities.sum())
+
+
+def preprocess_stored(stored_images: list):
+  """
+  Decodes and preprocesses stored images into one batch of pixel values.
+  The images are processed concurrently, PIL releases the GIL while decoding and resizing.
+
+  Args:
+  stored_images (list): List of StoredImage
+
+  Returns:
+  torch.Tensor: Pixel values with shape (N, C, H, W), in the order of the images.
+  """
+  import torch
+
+  def preprocess(stored):
+    with tracing.stage("decode") as span:
+      image = preprocessor.decode(stored.open())
+      span.set(num_bytes=len(stored.data), image=image)
+    with tracing.stage("preprocess"):
+      return preprocessor(image)
+
+  if len(stored_images) == 1:
+    return preprocess(stored_images[0])
+  with ThreadPoolExecutor(max_workers=min(len(stored_images), os.cpu_count() or 1)) as executor:
+    return torch.cat(list(executor.map(preprocess, stored_images)))
+
+def embed_stored(stored_images: list, pixel_values=None, timeout=None) -> None:
+  """
+  Computes the embeddings of the images for the search of similar cases, if an index is configured.
+  Runs in the admitted request, like the prediction; the embedding is kept with the image.
+
+  Args:
+  stored_images (list): List of StoredImage, those with an embedding are skipped.
+  pixel_values (torch.Tensor | None): Preprocessed images, if all of them need an embedding.
+  timeout (float | None): Seconds left for the embeddings.
+  """
+  if lesion_index is None:
+    return
+  missing = [stored for stored in stored_images if stored.embedding is None]
+  if not missing:
+    return
+  if pixel_values is None or len(missing) < len(stored_images):
+    pixel_values = preprocess_stored(missing)
+  with tracing.stage("embed"):
+    embeddings = result_or_cancel(lesion_index[1].submit(pixel_values), timeout)
+  for stored, embedding in zip(missing, embeddings):
+    stored.embedding = embedding
+
+def predict_stored(stored: StoredImage, timeout=None):
+  """
+  Returns the logits of a stored image, from the image itself, the prediction cache or the model.
+  With TTA enabled, uncertain predictions are refined by test-time augmentation.
+  Raises concurrent.futures.TimeoutError if the prediction does not finish within `timeout` seconds.
+  """
+  import torch
 
+  deadline = None if timeout is None else time.monotonic() + timeout
 
-def convert_png_to_jpg(image):
-  if image.format == "PNG":
-    image = image.convert("RGB")
-  return image
+  # Predictions refined by TTA are cached apart from the plain ones of process_images()
+  cache_key = stored.digest if tta is None else f"{stored.digest}-tta"
 
+  pixel_values = None
 
-def process_image(image: Image):
+  # Reuse the prediction if this image was already processed (e.g. on rerun)
+  if stored.logits is None:
+    stored.logits = prediction_cache.get(cache_key)
+
+    if stored.logits is None:
+      # Make a prediction, the image is decoded only now
+      pixel_values = preprocess_stored([stored])
+      with tracing.stage("forward"):
+        logits = result_or_cancel(batcher.submit(pixel_values), timeout)
+      if tta is not None:
+        # The augmented forward pass has the rest of the deadline
+        with tracing.stage("tta"):
+          logits = tta(pixel_values, logits, None if deadline is None else max(0.0, deadline - time.monotonic()))
+      stored.logits = logits.numpy()
+      prediction_cache.put(cache_key, stored.logits)
+
+    # Reruns show the same prediction again, it is recorded once
+    audit_prediction(stored)
+
+  embed_stored([stored], pixel_values, None if deadline is None else max(0.0, deadline - time.monotonic()))
+  return torch.from_numpy(stored.logits.copy())
+
+
+def process_image(stored: StoredImage, timeout=None):
   """
   Process an image using the model.
   If sucessful, calls function to display the results to the user.
 
   Args:
-  image (PIL.Image): The image to process
+  stored (StoredImage): The image to process
+  timeout (float | None): Seconds left for the prediction, see run_admitted()
   """
+  import torch
+  from utils.model import record_first_prediction
+
   try:
-    # Make a prediction
-    inputs = processor(images=image, return_tensors="pt")
-    outputs = model(**inputs)
-    logits = outputs.logits
+    logits = predict_stored(stored, timeout)
 
     # Get the predicted class
     predicted_class_idx = torch.argmax(logits, dim=1).item()
     predicted_class = model.config.id2label[predicted_class_idx]
 
     # Show the results to the user
-    show_results(image, logits, predicted_class)
-  
+    show_results(stored, logits, predicted_class)
+    record_first_prediction()
+
+    stats = prediction_cache.stats()
+    st.caption(f"Prediction cache: {stats['hits'] + stats['disk_hits']} hits, {stats['misses']} misses")
+    if tta is not None:
+      stats = tta.stats()
+      st.caption(f"Test-time augmentation: {stats['escalation_rate']:.0%} of {stats['requests']} predictions escalated, "
+                 f"{stats['mean_added_ms']:.1f} ms added on average")
+
+  except FutureTimeoutError:
+    st.warning("The server is busy and the prediction took too long, please try again in a moment.")
   except Exception as e:
     st.error(f"Error processing the image by the AI model: {e}")
 
-def show_plot_probabilities(labels_sorted, probs_sorted, column_color, background_color, grid_color):
-    #Change codes to readable names
-    labels_human_readable = [lesion_names[label] for label in labels_sorted]
+def process_images(stored_images: list, timeout=None) -> None:
+  """
+  Process multiple images using the model in batched forward passes.
+  Results of each batch are shown as soon as the batch is done; when all
+  images are processed, the detailed results are shown by show_sorted_results().
+
+  Args:
+  stored_images (list): List of StoredImage
+  timeout (float | None): Seconds left for all predictions, see run_admitted()
+  """
+  import torch
+  from utils.model import record_first_prediction
+  from utils.results import malignancy_probability
+
+  placeholder = st.empty()
+  results = [] # (file name, logits, malignancy probability)
+  deadline = None if timeout is None else time.monotonic() + timeout
+
+  try:
+    for start in range(0, len(stored_images), batcher.max_batch_size):
+      chunk = stored_images[start:start + batcher.max_batch_size]
+
+      # Only images without a stored or cached prediction go through the model
+      new = [stored for stored in chunk if stored.logits is None]
+      for stored in new:
+        stored.logits = prediction_cache.get(stored.digest)
+      missing = [stored for stored in new if stored.logits is None]
+
+      if missing:
+        pixel_values = preprocess_stored(missing)
+        with tracing.stage("forward"):
+          remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+          batch_logits = result_or_cancel(batcher.submit(pixel_values), remaining)
+        for stored, logits in zip(missing, batch_logits):
+          stored.logits = logits[None].numpy()
+          prediction_cache.put(stored.digest, stored.logits)
+
+        embed_stored(missing, pixel_values, None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+      for stored in new:
+        audit_prediction(stored)
+      # Images whose prediction was cached are preprocessed only for their embedding
+      embed_stored(chunk, timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+      for stored in chunk:
+        logits = torch.from_numpy(stored.logits.copy())
+        results.append((stored.name, logits, malignancy_probability(logits, model.config.id2label)))
+
+      # Show the finished results while the next batch is processed
+      with placeholder.container():
+        st.progress(len(results) / len(stored_images), text=f"Processed {len(results)} of {len(stored_images)} images")
+        for name, logits, malignancy in results:
+          predicted_class = model.config.id2label[torch.argmax(logits, dim=1).item()]
+          st.markdown(f"<p>{name}: <strong>{lesion_names[predicted_class]}</strong> (malignancy probability {malignancy:.2%})</p>", unsafe_allow_html=True)
+
+    record_first_prediction()
+  except FutureTimeoutError:
+    st.warning("The server is busy and the predictions took too long, please try again in a moment.")
+    return
+  except Exception as e:
+    st.error(f"Error processing the images by the AI model: {e}")
+    return
 
-    #Change the order to have the most highest probababilities in the top
-    labels_sorted_ascending = labels_human_readable[::-1]
-    probs_sorted_ascending = probs_sorted[::-1]
+  placeholder.empty()
+  show_sorted_results(stored_images)
 
-    # Create and display bar chart with custom styling
-    fig, ax = plt.subplots(figsize=(10, 6))
+def run_admitted(process, stored_images: list) -> None:
+  """
+  Runs process_image() or process_images() once the admission controller lets the request use the model.
+  While the request waits, its position in the queue is shown; when the server is
+  overloaded, the user is told so at once instead of waiting for a timeout.
 
-    # Create the bar chart
-    ax.barh(labels_sorted_ascending, probs_sorted_ascending, color=column_color)
+  Args:
+  process (Callable): Processing function, called with the seconds left before the deadline as `timeout`.
+  stored_images (list): The images processed, the model is not needed if all have a prediction already.
+  """
+  # Reruns of the page show the stored predictions and are not queued
+  if all(stored.logits is not None and (lesion_index is None or stored.embedding is not None) for stored in stored_images):
+    process()
+    return
 
-    # Set dark background
-    fig.patch.set_facecolor(background_color)  # Dark background
-    ax.set_facecolor(background_color)  # Dark background for the plot
+  status = st.empty()
+  def show_position(position):
+    status.info(f"The server is busy, your request is number {position} in the queue...")
 
-    # Customize grid and axes
-    ax.grid(color=grid_color, linestyle='--', linewidth=0.5, axis='x')
-    ax.tick_params(colors=grid_color)  # White tick labels
-    for direction in ['bottom', 'left', 'top', 'right']:
-        ax.spines[direction].set_color(grid_color)
+  try:
+    with admission.admit(on_wait=show_position) as ticket:
+      status.empty()
+      if tracing.enabled:
+        tracing.observe("admission_wait_seconds", "inference", ticket.waited)
+      process(timeout=ticket.remaining())
+  except ServerBusy as e:
+    status.warning(f"The server is busy ({e.queued} requests waiting), please try again in a moment.")
+
+@st.fragment
+def show_sorted_results(stored_images: list) -> None:
+  """
+  Shows the detailed results of multiple images in the selected order.
+  Runs as a fragment: changing the order reruns only this function, from the logits stored with the images.
 
-    # Add labels and title with white color
-    ax.set_xlabel('Probability', color=grid_color)
-    ax.set_title('Predicted Probabilities for Each Lesion Type', color=grid_color)
+  Args:
+  stored_images (list): List of StoredImage with their logits
+  """
+  import torch
+  from utils.results import malignancy_probability
 
-    # Set y-axis labels to white
-    ax.set_yticks(range(len(labels_sorted_ascending)))
-    ax.set_yticklabels(labels_sorted_ascending, color=grid_color)
+  with tracing.request("sorted_results"):
+    sort_by = st.radio("Sort results by", ["Upload order", "Malignancy probability"], horizontal=True, key="sort_results")
+
+    results = [] # (upload index, stored image, logits, malignancy probability)
+    for index, stored in enumerate(stored_images):
+      logits = torch.from_numpy(stored.logits.copy())
+      results.append((index, stored, logits, malignancy_probability(logits, model.config.id2label)))
+
+    if sort_by == "Malignancy probability":
+      results.sort(key=lambda result: result[3], reverse=True)
+
+    # Widgets keys are prefixed by the upload index, so they keep their state when sorting
+    for index, stored, logits, malignancy in results:
+      predicted_class = model.config.id2label[torch.argmax(logits, dim=1).item()]
+      with st.expander(f"{stored.name}: {lesion_names[predicted_class]} (malignancy probability {malignancy:.2%})"):
+        show_results(stored, logits, predicted_class, key_prefix=f"image_{index}_")
+
+def show_plot_probabilities(labels_sorted, probs_sorted, column_color, background_color, grid_color):
+    from utils.charts import probability_chart_spec
+
+    #Change codes to readable names
+    labels_human_readable = [lesion_names[label] for label in labels_sorted]
+
+    # The bar chart is drawn by the browser from a (cached) Vega-Lite spec, no image is rendered on the server
+    spec = probability_chart_spec(labels_human_readable, probs_sorted, column_color, background_color, grid_color)
 
     # Display the chart using Streamlit
-    st.pyplot(fig)
+    st.vega_lite_chart(spec, theme=None, width="stretch")
 
 
-def show_results(image, logits, predicted_class):
+def show_results(stored, logits, predicted_class, key_prefix=""):
   """
   Shows the results of the prediction to the user in Streamlit.
 
   Args:
-  image (PIL.Image): The image that was processed.
+  stored (StoredImage): The image that was processed.
   logits (torch.Tensor): The logits from the model.
   predicted_class(str): The predicted class from the logits.
+  key_prefix (str): Prefix of the widget keys, needed when results of multiple images are shown.
   """
-  # Display the image in Streamlit
-  st.image(image, caption="Loaded Image", width=400)
+  from utils.results import sorted_probabilities
+
+  # Display the image in Streamlit, the compressed file is sent as is
+  st.image(stored.data, caption="Loaded Image", width=400)
   
   # Display the prediction
   st.markdown("<h3 class='text-white text-lg font-medium title-font mb-3'>Prediction:</h3>", unsafe_allow_html=True)
@@ -215,44 +629,80 @@ def show_results(image, logits, predicted_class):
   st.markdown("<h3 class='text-white text-lg font-medium title-font mb-3 mt-4'>Confidence Scores:</h3>",
               unsafe_allow_html=True)
 
-  # Apply softmax to logits to get probabilities
-  probs = torch.nn.functional.softmax(logits, dim=1)
-
-  # Get the sorted indices based on probabilities (highest to lowest)
-  sorted_indices = torch.argsort(probs[0], descending=True)
-
-  # Prepare data for the bar chart
-  labels_sorted = [model.config.id2label[idx.item()] for idx in sorted_indices]
-  probs_sorted = [probs[0][idx].item() for idx in sorted_indices]
+  # Apply softmax to logits and sort the labels by probability
+  with tracing.stage("postprocess"):
+    labels_sorted, probs_sorted = sorted_probabilities(logits, model.config.id2label)
 
   # Plot the probabilities
-  show_plot_probabilities(labels_sorted, probs_sorted,
-                          column_color='#10b981', background_color='#111827', grid_color='white')
+  with tracing.stage("chart"):
+    show_plot_probabilities(labels_sorted, probs_sorted,
+                            column_color='#10b981', background_color='#111827', grid_color='white')
 
   # Display the probabilities in percentage format with descriptions
-  for i, label in enumerate(labels_sorted):
-      prob = probs_sorted[i]
-      st.markdown(f"<p>{lesion_names[label]}: {prob:.2%}</p>", unsafe_allow_html=True)
+  show_descriptions(labels_sorted, probs_sorted, key_prefix)
+
+  # Display the most similar reference images, if an index is configured
+  if lesion_index is not None:
+    show_similar_cases(stored)
+
+def show_similar_cases(stored, k=None):
+  """
+  Shows the k reference images most similar to the image, with their known labels.
+
+  Args:
+  stored (StoredImage): The image that was processed.
+  k (int | None): Number of similar images, LESION_INDEX_K (default 5) if not set.
+  """
+  index = lesion_index[0]
+  k = k or int(os.environ.get("LESION_INDEX_K", 5))
+
+  # The embedding is computed with the prediction, see embed_stored()
+  if stored.embedding is None:
+    return
+  with tracing.stage("similar"):
+    cases = index.search(stored.embedding, k)
+
+  st.markdown("<h3 class='text-white text-lg font-medium title-font mb-3 mt-4'>Similar Known Cases:</h3>", unsafe_allow_html=True)
+  for column, case in zip(st.columns(max(len(cases), 1)), cases):
+    with column:
+      if os.path.exists(case["path"]):
+        st.image(case["path"], width="stretch")
+      st.caption(f"{lesion_names[case['label']]} (similarity {case['similarity']:.2f})")
+
+@st.fragment
+def show_descriptions(labels_sorted, probs_sorted, key_prefix=""):
+  """
+  Shows the probabilities with a button toggling the description of each lesion.
+  Runs as a fragment: a toggle reruns only this function, not the page or the model.
+
+  Args:
+  labels_sorted (list): Labels sorted by probability.
+  probs_sorted (list): Probabilities of the labels.
+  key_prefix (str): Prefix of the widget keys, needed when results of multiple images are shown.
+  """
+  with tracing.request("descriptions"):
+    for i, label in enumerate(labels_sorted):
+        prob = probs_sorted[i]
+        st.markdown(f"<p>{lesion_names[label]}: {prob:.2%}</p>", unsafe_allow_html=True)
 
-      # Manage button and description display using session_state
-      description_key = f"description_shown_{label}"
+        # Manage button and description display using session_state
+        description_key = f"description_shown_{key_prefix}{label}"
 
-      if description_key not in st.session_state:
-          st.session_state[description_key] = False  # Initialize the state to False (description hidden)
+        if description_key not in st.session_state:
+            st.session_state[description_key] = False  # Initialize the state to False (description hidden)
 
-      # Toggle button text and show/hide description in one step
-      if st.button(f"{'Show' if not st.session_state[description_key] else 'Hide'} description", key=label):
-          st.session_state[description_key] = not st.session_state[description_key]
+        # Toggle button text and show/hide description in one step
+        if st.button(f"{'Show' if not st.session_state[description_key] else 'Hide'} description", key=f"{key_prefix}{label}"):
+            st.session_state[description_key] = not st.session_state[description_key]
 
-      # Display description if the state is True
-      if st.session_state[description_key]:
-          st.markdown(f"**Description**: {lesion_descriptions[label]}")
+        # Display description if the state is True
+        if st.session_state[description_key]:
+            st.markdown(f"**Description**: {lesion_descriptions[label]}")
 
 def handle_file_upload(file: BytesIO) -> None:
   """
-  Handles a file uploaded by the user. Image will be
-  loaded as an image and saved into the session state. If the file is a PNG
-  image, it will be converted to a JPEG.
+  Handles a file uploaded by the user. The compressed file is checked
+  and saved into the image store, it is decoded only for the prediction.
   This function should be called only after the user presses the submit button.
 
   Args:
@@ -260,16 +710,62 @@ def handle_file_upload(file: BytesIO) -> None:
   """
   if file is not None:
     try:
-      st.session_state["image"] = Image.open(uploaded_file) # Save the loaded image into session state
-      st.session_state["image"] = convert_png_to_jpg(st.session_state["image"])
+      store_images([store_upload(file)]) # Save the image into the image store
       st.success(f"File '{file.name}' uploaded successfully!")
+    except ImageTooLargeError as e:
+      st.error(f"Error loading the image: {e}")
     except:
       st.error("Error loading the image")
 
+def store_upload(file: BytesIO) -> StoredImage:
+  """
+  Reads an uploaded file into a stored image, without decoding the pixels.
+
+  Args:
+  file (UploadedFile extending BytesIO): The file uploaded by the user.
+  """
+  with tracing.stage("store") as span:
+    stored = StoredImage(file.getvalue(), name=file.name, max_pixels=max_image_pixels)
+    span.set(num_bytes=file.size)
+  return stored
+
+def store_images(images: list) -> None:
+  """
+  Replaces the images of this session in the image store.
+  """
+  load_image_store().put(st.session_state["session_id"], images)
+  st.session_state["submitted"] = bool(images)
+
+def handle_file_uploads(files: list) -> None:
+  """
+  Handles multiple files uploaded by the user. The files are checked concurrently
+  and saved into the image store together with their names.
+  This function should be called only after the user presses the submit button.
+
+  Args:
+  files (list): The files (UploadedFile) uploaded by the user.
+  """
+  def try_store(file):
+    try:
+      return store_upload(file)
+    except Exception:
+      return None
+
+  with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+    images = list(executor.map(try_store, files))
+
+  for file, image in zip(files, images):
+    if image is None:
+      st.error(f"Error loading the image '{file.name}'")
+
+  images = [image for image in images if image is not None]
+  store_images(images)
+  st.success(f"{len(images)} files uploaded successfully!")
+
 def handle_url_input(url: str) -> None:
   """
   Takes the url of the image as an input. Loads the image from the web
-  and stores it as a session state. If the file is png, converts it to jpg.
+  and saves it into the image store.
   This function should be called only after the user presses the submit button.
 
   Args:
@@ -278,107 +774,140 @@ def handle_url_input(url: str) -> None:
   try:
     # Load image from web
     url = url.strip() # Remove whitespace from the url
-    response = requests.get(url) # Fetch the image from the URL
-    response.raise_for_status() # Raise error if the request fails
+    with tracing.stage("fetch") as span:
+      # Streamed with timeouts and a size cap through the shared session, cached on disk
+      data = fetch_image_bytes(url, cache_dir=os.environ.get("URL_CACHE_DIR", DEFAULT_CACHE_DIR))
+      span.set(num_bytes=len(data))
     
-    # Load the image into memory, converts to jpg
-    st.session_state["image"] = Image.open(BytesIO(response.content)) # Saves image into memory using IO and loads it as an image object
-    st.session_state["image"] = convert_png_to_jpg(st.session_state["image"])
+    # Keep the compressed image, it is decoded only for the prediction
+    store_images([StoredImage(data, name=url, max_pixels=max_image_pixels)])
 
     # Inform the user that the image was loaded
     st.success(f"Image loaded from URL: {url}")
 
-  except requests.exceptions.RequestException as e:
+  except (ImageFetchError, ImageTooLargeError, requests.exceptions.RequestException) as e:
       st.error(f"Error fetching the image: {e}")
   except Exception as e:
       st.error(f"Error loading the image. Make sure that the URL provided is direct link to the image, not just the website containing the image.")
 
 
-st.markdown(
-    """
-    <p style="color: #9CA3AF;">You can submit your image by uploading a file or by providing a direct URL to it. After inserting the image, press the submit button.</p>
-    """,
-    unsafe_allow_html=True
-)
+# Measures every full run of the page, interactions inside fragments record only the fragment
+with tracing.request("page"):
+  st.markdown(
+      """
+      <p style="color: #9CA3AF;">You can submit your image by uploading a file or by providing a direct URL to it. After inserting the image, press the submit button.</p>
+      """,
+      unsafe_allow_html=True
+  )
 
-# Create two tabs (submenu)
-with st.container(key="input_container"):
-  tab1, tab2 = st.tabs(["Upload File", "Provide Link"])
+  # Create two tabs (submenu)
+  with st.container(key="input_container"):
+    tab1, tab2 = st.tabs(["Upload File", "Provide Link"])
 
-  # Tab 1: File Upload
-  with tab1:
-      # Instructions for user
-      st.markdown('<div style="color: black;">Please submit your image by selecting the file from your file system. You can also use the drag-and-drop feature.<br />Supported formats: .jpg, .jpeg, .png, .webp</div>', unsafe_allow_html=True)
+    # Tab 1: File Upload
+    with tab1:
+        # Instructions for user
+        st.markdown('<div style="color: black;">Please submit your images by selecting the files from your file system. You can also use the drag-and-drop feature.<br />Supported formats: .jpg, .jpeg, .png, .webp</div>', unsafe_allow_html=True)
       
-      # User input - upload file widget
-      uploaded_file = st.file_uploader("", type=["jpg", "jpeg", "png", "webp"], key="widget_input_file", accept_multiple_files=False)
+        # User input - upload file widget
+        uploaded_files = st.file_uploader("", type=["jpg", "jpeg", "png", "webp"], key="widget_input_file", accept_multiple_files=True)
       
-      # When sumbit button is pressed
-      if st.button("Submit file"):
-        st.session_state["image"] = None
+        # When sumbit button is pressed
+        if st.button("Submit file"):
+          store_images([])
         
-        # Error handling - no file selected or unsupported file type
-        if uploaded_file is None:
-          st.error("No file was selected")
-        elif uploaded_file.type not in ["image/png", "image/jpg", "image/jpeg", "image/webp"]:
-          st.error("Unsupported file type")
+          # Error handling - no file selected or unsupported file type
+          if not uploaded_files:
+            st.error("No file was selected")
+          elif any(file.type not in ["image/png", "image/jpg", "image/jpeg", "image/webp"] for file in uploaded_files):
+            st.error("Unsupported file type")
         
-        # If valid file selected, pass it to convert to image
-        else:
-          handle_file_upload(uploaded_file)
+          # If valid files selected, pass them to convert to images
+          elif len(uploaded_files) == 1:
+            handle_file_upload(uploaded_files[0])
+          else:
+            handle_file_uploads(uploaded_files)
           
-  # Tab 2: Url Input
-  with tab2:
-      # Instructions for user
-      st.markdown('<div style="color: black;">Please submit your image by providing a direct URL to it.<br />Make sure the URL links directly to the image file (e.g., ending in .jpg, .png, or similar).<br />Also make sure that the URL scheme is specified. The URL should start with "http://" or "https://".</div>', unsafe_allow_html=True)
+    # Tab 2: Url Input
+    with tab2:
+        # Instructions for user
+        st.markdown('<div style="color: black;">Please submit your image by providing a direct URL to it.<br />Make sure the URL links directly to the image file (e.g., ending in .jpg, .png, or similar).<br />Also make sure that the URL scheme is specified. The URL should start with "http://" or "https://".</div>', unsafe_allow_html=True)
       
-      # User input - text field for url
-      text_input = st.text_input("", key="widget_input_url", placeholder="https://example.com/image.jpg")
+        # User input - text field for url
+        text_input = st.text_input("", key="widget_input_url", placeholder="https://example.com/image.jpg")
       
-      # When sumbit button is pressed, pass it to convert to image
-      if st.button("Submit image via link"):
-        st.session_state["image"] = None
-        handle_url_input(text_input)
-
-# Set CSS style of the input menu (tabs)
-set_color("input_container", "grey")
-
-# Runs if an image has been uploaded and loaded
-if st.session_state["image"] is not None:
-  # Runs image trough AI mode, shows the image preview, shows the AI prediction
-  process_image(st.session_state["image"]) 
-
-st.markdown(
-    """
-    <div style="background-color: #8493af; border: 1px solid #8493af; border-radius: 5px; padding: 20px; line-height: 1.6; color: black;">
-        <h2 style="color: black; text-align: left;">Skin Cancer Prevention</h2>
-        <hr style="border: 1 px solid black; margin-top: 5px; margin-bottom: 5px;">
-        <p>
-            According to the <strong>Centers for Disease Control and Prevention (CDC)</strong>, the leading health organization in the United States, most skin cancers are caused by excessive exposure to ultraviolet (UV) rays, which damage skin cells. These harmful rays originate from sources like the sun, tanning beds, and sunlamps. 
-            To reduce your risk of developing skin cancer, it is essential to protect your skin from UV rays.
-        </p>
-        <h3 style="color: black;">Key Facts about UV Protection:</h3>
-        <ul>
-            <li>UV protection is necessary all year round—not just during the summer.</li>
-            <li>UV rays can penetrate through clouds and cool weather.</li>
-            <li>They can also reflect off surfaces such as water, cement, sand, and snow.</li>
-        </ul>
-        <h3 style="color: black;">CDC Recommendations for Skin Protection:</h3>
-        <ol>
-            <li><strong>Stay in the shade</strong> whenever possible, especially during midday hours when the sun’s rays are strongest.</li>
-            <li><strong>Wear protective clothing</strong> that covers your arms and legs.</li>
-            <li><strong>Use a hat with a wide brim</strong> to shield your face, head, ears, and neck.</li>
-            <li><strong>Wear sunglasses</strong> that wrap around your eyes and block both UVA and UVB rays.</li>
-            <li><strong>Apply sunscreen</strong> with a broad spectrum SPF of 15 or higher, and reapply as needed.</li>
-        </ol>
-        <p>
-            By following these steps, you can significantly lower your risk of skin cancer while maintaining healthy and protected skin year-round.
-        </p>
-        <p style="text-align: left; font-size: 12px;">
-            Source: <a href="https://www.cdc.gov/skin-cancer/prevention/index.html" style="color: blue;">CDC Skin Cancer Prevention</a>
-        </p>
-    </div>
-    """,
-    unsafe_allow_html=True
-)
-
+        # When sumbit button is pressed, pass it to convert to image
+        if st.button("Submit image via link"):
+          store_images([])
+          handle_url_input(text_input)
+
+  # Set CSS style of the input menu (tabs)
+  set_color("input_container", "grey")
+
+  # Load the model after the page is painted (cached after the first run)
+  processor, model = load_model()
+  preprocessor = load_preprocessor()
+  prediction_cache = load_prediction_cache()
+  batcher = load_batcher()
+  tta = load_tta()
+  admission = load_admission()
+  audit_log = load_audit_log()
+  lesion_index = load_lesion_index()
+
+  image_store = load_image_store()
+  stored_images = image_store.get(st.session_state["session_id"])
+
+  # Runs if an image has been uploaded and loaded
+  if stored_images and len(stored_images) == 1:
+    # Runs image trough AI mode, shows the image preview, shows the AI prediction
+    with tracing.request("process_image"):
+      run_admitted(partial(process_image, stored_images[0]), stored_images)
+
+  # Runs if multiple images have been uploaded
+  elif stored_images:
+    with tracing.request("process_images"):
+      run_admitted(partial(process_images, stored_images), stored_images)
+
+  # The images of idle sessions are evicted when the server is short of memory
+  elif st.session_state["submitted"]:
+    st.info("The images were removed from the server after a period of inactivity, please submit them again.")
+    st.session_state["submitted"] = False
+
+  if stored_images:
+    stats = image_store.stats()
+    st.caption(f"Image memory: {image_store.session_bytes(st.session_state['session_id']) / 2**20:.1f} MB in this session, "
+               f"{stats['bytes'] / 2**20:.1f} MB of {stats['budget_bytes'] / 2**20:.0f} MB in {stats['sessions']} sessions")
+
+  st.markdown(
+      """
+      <div style="background-color: #8493af; border: 1px solid #8493af; border-radius: 5px; padding: 20px; line-height: 1.6; color: black;">
+          <h2 style="color: black; text-align: left;">Skin Cancer Prevention</h2>
+          <hr style="border: 1 px solid black; margin-top: 5px; margin-bottom: 5px;">
+          <p>
+              According to the <strong>Centers for Disease Control and Prevention (CDC)</strong>, the leading health organization in the United States, most skin cancers are caused by excessive exposure to ultraviolet (UV) rays, which damage skin cells. These harmful rays originate from sources like the sun, tanning beds, and sunlamps. 
+              To reduce your risk of developing skin cancer, it is essential to protect your skin from UV rays.
+          </p>
+          <h3 style="color: black;">Key Facts about UV Protection:</h3>
+          <ul>
+              <li>UV protection is necessary all year round—not just during the summer.</li>
+              <li>UV rays can penetrate through clouds and cool weather.</li>
+              <li>They can also reflect off surfaces such as water, cement, sand, and snow.</li>
+          </ul>
+          <h3 style="color: black;">CDC Recommendations for Skin Protection:</h3>
+          <ol>
+              <li><strong>Stay in the shade</strong> whenever possible, especially during midday hours when the sun’s rays are strongest.</li>
+              <li><strong>Wear protective clothing</strong> that covers your arms and legs.</li>
+              <li><strong>Use a hat with a wide brim</strong> to shield your face, head, ears, and neck.</li>
+              <li><strong>Wear sunglasses</strong> that wrap around your eyes and block both UVA and UVB rays.</li>
+              <li><strong>Apply sunscreen</strong> with a broad spectrum SPF of 15 or higher, and reapply as needed.</li>
+          </ol>
+          <p>
+              By following these steps, you can significantly lower your risk of skin cancer while maintaining healthy and protected skin year-round.
+          </p>
+          <p style="text-align: left; font-size: 12px;">
+              Source: <a href="https://www.cdc.gov/skin-cancer/prevention/index.html" style="color: blue;">CDC Skin Cancer Prevention</a>
+          </p>
+      </div>
+      """,
+      unsafe_allow_html=True
+  )
@@ -0,0 +1,291 @@
+"""
+Headless batch inference over a folder, a glob pattern or a CSV manifest.
+
+Results are appended to a JSONL or CSV file after every batch. When the
+output file already exists, images that are already in it are skipped, so an
+interrupted job can be restarted with the same command.
+
+Example:
+  python src/batch_predict.py data/images --output results.jsonl --batch-size 32 --workers 4
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from utils.backends import BACKENDS, EagerBackend, load_backend
+from utils.descriptions import lesion_names
+from utils.model import load_processor_and_model
+from utils.preprocessing import FastPreprocessor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Preprocessor of the current worker process (set by _init_worker)
+_worker_preprocessor = None
+
+
+def collect_inputs(sources: Iterable[str]) -> List[str]:
+    """
+    Expands directories, glob patterns and CSV manifests into a list of image paths.
+    A manifest must have a "path" column; relative paths are resolved against the
+    directory of the manifest.
+
+    Args:
+      sources (Iterable[str]): Directories, glob patterns or .csv files.
+
+    Returns:
+      List[str]: Image paths in a stable order, without duplicates.
+    """
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                paths.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif source.lower().endswith(".csv"):
+            base_dir = os.path.dirname(source)
+            with open(source, newline="") as f:
+                for row in csv.DictReader(f):
+                    paths.append(os.path.join(base_dir, row["path"]))
+        else:
+            paths.extend(sorted(glob.glob(source, recursive=True)))
+
+    return list(dict.fromkeys(paths))
+
+
+def completed_paths(output: str, output_format: str) -> set:
+    """
+    Reads paths that already have a result in the output file. A trailing partial
+    line left behind by a crash is cut off, so new results can be appended safely.
+
+    Args:
+      output (str): Path of the output file.
+      output_format (str): "jsonl" or "csv".
+
+    Returns:
+      set: Paths of images that were already processed.
+    """
+    if not os.path.exists(output):
+        return set()
+
+    # Cut off the last line if it was not completely written
+    with open(output, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+    done = set()
+    with open(output, newline="") as f:
+        if output_format == "csv":
+            done.update(row["path"] for row in csv.DictReader(f))
+        else:
+            done.update(json.loads(line)["path"] for line in f if line.strip())
+    return done
+
+
+def _init_worker(preprocessor: FastPreprocessor) -> None:
+    global _worker_preprocessor
+
+    # Decoding runs in many processes, each of them should use a single thread
+    torch.set_num_threads(1)
+    _worker_preprocessor = preprocessor
+
+
+def _preprocess(path: str):
+    """
+    Decodes and preprocesses one image in a worker process.
+
+    Returns:
+      tuple: The path, pixel values (or None) and an error message (or None).
+    """
+    try:
+        with Image.open(path) as image:
+            pixel_values = _worker_preprocessor(image)[0].numpy()
+        return path, pixel_values, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def _iter_preprocessed(executor: Optional[ProcessPoolExecutor], paths: List[str], prefetch: int) -> Iterator[tuple]:
+    """
+    Yields preprocessed images in input order, keeping at most `prefetch` images in flight.
+    """
+    if executor is None:
+        yield from map(_preprocess, paths)
+        return
+
+    pending = deque()
+    for path in paths:
+        pending.append(executor.submit(_preprocess, path))
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ResultWriter:
+    """
+    Appends prediction records to a JSONL or CSV file and flushes them after each batch.
+    """
+
+    def __init__(self, output: str, output_format: str, labels: List[str]):
+        self.output_format = output_format
+        self.labels = labels
+        write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+        self._file = open(output, "a", newline="")
+
+        if output_format == "csv":
+            fieldnames = ["path", "label", "probability", "top_k", "error"] + labels
+            self._csv = csv.DictWriter(self._file, fieldnames=fieldnames)
+            if write_header:
+                self._csv.writeheader()
+
+    def write(self, record: dict) -> None:
+        if self.output_format == "csv":
+            row = {key: record.get(key, "") for key in ("path", "label", "probability", "error")}
+            row["top_k"] = ";".join(item["label"] for item in record.get("top_k", []))
+            row.update(record.get("probabilities", {}))
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(record) + "\n")
+
+    def flush(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def predict_batch(backend, pixel_values: np.ndarray) -> np.ndarray:
+    """
+    Runs one forward pass and returns the class probabilities.
+
+    Args:
+      backend: Inference backend from utils.backends.
+      pixel_values (np.ndarray): Batch of preprocessed images (N, C, H, W).
+
+    Returns:
+      np.ndarray: Probabilities with shape (N, number of classes).
+    """
+    logits = backend(torch.from_numpy(pixel_values))
+    return torch.softmax(logits, dim=1).numpy()
+
+
+def make_records(paths: List[str], probs: np.ndarray, labels: List[str], top_k: int) -> List[dict]:
+    records = []
+    top_indices = np.argsort(-probs, axis=1)[:, :top_k]
+    for path, row, top in zip(paths, probs, top_indices):
+        records.append({
+            "path": path,
+            "label": labels[top[0]],
+            "probability": float(row[top[0]]),
+            "top_k": [{"label": labels[i], "name": lesion_names[labels[i]], "probability": float(row[i])} for i in top],
+            "probabilities": {label: float(p) for label, p in zip(labels, row)},
+        })
+    return records
+
+
+def run(paths: List[str], processor, model, output: str, output_format: str = "jsonl", batch_size: int = 32,
+        workers: int = 0, top_k: int = 3, backend=None) -> int:
+    """
+    Runs batched inference over the images and appends the results to the output file.
+    Images that already have a result in the output file are skipped.
+
+    Args:
+      paths (List[str]): Image paths.
+      processor: The Hugging Face image processor, its parameters are used for preprocessing.
+      model: The classification model.
+      output (str): Path of the JSONL or CSV output file.
+      output_format (str): "jsonl" or "csv".
+      batch_size (int): Number of images per forward pass.
+      workers (int): Number of decoding processes; 0 decodes in the main process.
+      top_k (int): Number of top labels stored per image.
+      backend: Inference backend from utils.backends, eager PyTorch by default.
+
+    Returns:
+      int: Number of images processed by this run.
+    """
+    labels = [model.config.id2label[i] for i in range(len(model.config.id2label))]
+    backend = backend or EagerBackend(model)
+    done = completed_paths(output, output_format)
+    todo = [path for path in paths if path not in done]
+    if done:
+        print(f"Resuming: {len(done)} images already processed, {len(todo)} remaining", file=sys.stderr)
+
+    writer = ResultWriter(output, output_format, labels)
+    preprocessor = FastPreprocessor.from_processor(processor)
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(preprocessor,))
+    else:
+        global _worker_preprocessor
+        _worker_preprocessor = preprocessor
+
+    processed = 0
+    start = time.perf_counter()
+    batch_paths, batch_pixels = [], []
+
+    def flush_batch():
+        nonlocal processed
+        if batch_paths:
+            probs = predict_batch(backend, np.stack(batch_pixels))
+            for record in make_records(batch_paths, probs, labels, top_k):
+                writer.write(record)
+            processed += len(batch_paths)
+            batch_paths.clear()
+            batch_pixels.clear()
+        writer.flush()
+        elapsed = time.perf_counter() - start
+        print(f"{processed}/{len(todo)} images, {processed / max(elapsed, 1e-9):.1f} images/s", file=sys.stderr)
+
+    try:
+        for path, pixel_values, error in _iter_preprocessed(executor, todo, prefetch=2 * batch_size):
+            if error is not None:
+                writer.write({"path": path, "error": error})
+                continue
+            batch_paths.append(path)
+            batch_pixels.append(pixel_values)
+            if len(batch_paths) == batch_size:
+                flush_batch()
+        flush_batch()
+    finally:
+        writer.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return processed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Batch skin lesion classification")
+    parser.add_argument("inputs", nargs="+", help="Directories, glob patterns or CSV manifests with a 'path' column")
+    parser.add_argument("--output", required=True, help="Output file (.jsonl or .csv)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Output format, guessed from the extension by default")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of decoding processes")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--model", help="Hugging Face model id or local bundle, MODEL_DIR or the default model if not set")
+    parser.add_argument("--backend", choices=BACKENDS, help="Inference backend, INFERENCE_BACKEND or eager by default")
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    paths = collect_inputs(args.inputs)
+    processor, model = load_processor_and_model(args.model)
+
+    run(paths, processor, model, args.output, output_format, batch_size=args.batch_size,
+        workers=args.workers, top_k=args.top_k, backend=load_backend(model, args.backend, inplace=True))
+
+
+if __name__ == "__main__":
+    main()
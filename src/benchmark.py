@@ -0,0 +1,286 @@
+"""
+Offline benchmark of the whole prediction path on synthetic images: decoding,
+preprocessing, forward passes, probability post-processing, chart rendering
+and the end-to-end process_image() of the app.
+
+Results (wall time and memory per stage) are written as JSON. When a baseline
+is given, the run fails if any stage got slower or its peak memory grew more
+than the threshold allows.
+
+With --scaling, the throughput of the multi-process worker pool is measured
+instead, for each number of workers.
+
+Example:
+  python src/benchmark.py --output benchmark.json
+  python src/benchmark.py --output new.json --baseline benchmark.json --threshold 0.2
+  MODEL_DIR=model_bundle python src/benchmark.py --scaling --workers 1,2,4,8 --output scaling.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from utils.system import current_rss_mb, peak_rss_mb, process_memory_mb, reset_peak_rss, stage_peak_rss_mb
+
+RESOLUTIONS = {"small": (640, 480), "medium": (2048, 1536), "large": (4032, 3024)}
+FORMATS = ("PNG", "JPEG", "WEBP")
+BATCH_SIZES = (1, 8, 32)
+WORKER_COUNTS = (1, 2, 4)
+
+
+def synthetic_image(size, seed: int = 0) -> Image.Image:
+    """
+    Creates a smooth synthetic photo-like RGB image, noise would make the encoded files unrealistically large.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 32 + 1, width // 32 + 1, 3), dtype=np.uint8)
+    return Image.fromarray(coarse).resize((width, height), Image.BILINEAR)
+
+
+def encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    options = {} if image_format == "PNG" else {"quality": 90}
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def measure(function: Callable[[], object], repeats: int, warmup: int = 1) -> Dict[str, float]:
+    """
+    Runs the function repeatedly and returns wall time statistics in milliseconds
+    together with the RSS growth, the peak RSS while it ran (None where the peak
+    cannot be reset) and the peak RSS of the whole process.
+    """
+    for _ in range(warmup):
+        function()
+
+    rss_before = current_rss_mb()
+    resettable = reset_peak_rss()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+
+    return {
+        "mean_ms": statistics.mean(times),
+        "p50_ms": statistics.median(times),
+        "p95_ms": times[int(0.95 * (len(times) - 1))],
+        "min_ms": times[0],
+        "rss_growth_mb": current_rss_mb() - rss_before,
+        "stage_peak_rss_mb": stage_peak_rss_mb() if resettable else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmarks(repeats: int, resolutions: Dict[str, tuple], batch_sizes=BATCH_SIZES) -> Dict[str, dict]:
+    """
+    Runs all benchmarks and returns the results keyed by stage name.
+    """
+    import app  # Runs the Streamlit script in bare mode and loads the model
+    from utils import charts
+    from utils.image_store import StoredImage
+    from utils.results import sorted_probabilities
+
+    results = {}
+    model = app.model
+    preprocessor = app.preprocessor
+    batcher = app.batcher
+
+    def record(name: str, function: Callable[[], object], count: int = repeats) -> None:
+        results[name] = measure(function, count)
+        peak = results[name]["stage_peak_rss_mb"] or results[name]["peak_rss_mb"]
+        print(f"{name:<36} p50 {results[name]['p50_ms']:>9.2f} ms   peak RSS {peak:>8.1f} MB", file=sys.stderr)
+
+    for resolution, size in resolutions.items():
+        image = synthetic_image(size)
+        for image_format in FORMATS:
+            data = encode(image, image_format)
+
+            def decode(data=data):
+                with Image.open(io.BytesIO(data)) as decoded:
+                    decoded.load()
+
+            record(f"decode/{image_format.lower()}/{resolution}", decode)
+
+            # Preprocessing starts from a freshly opened file, so JPEG draft decoding is included
+            record(f"preprocess/{image_format.lower()}/{resolution}", lambda data=data: preprocessor(Image.open(io.BytesIO(data))))
+
+        record(f"preprocess_hf/{resolution}", lambda image=image: app.processor(images=image, return_tensors="pt"))
+
+    pixel_values = preprocessor(synthetic_image((224, 224)))
+    for batch_size in batch_sizes:
+        batch = pixel_values.repeat(batch_size, 1, 1, 1)
+        record(f"forward/batch_{batch_size}", lambda batch=batch: batcher.predict(batch), max(repeats // batch_size, 3))
+
+    logits = batcher.predict(pixel_values)
+    record("postprocess", lambda: sorted_probabilities(logits, model.config.id2label), repeats * 10)
+
+    labels_sorted, probs_sorted = sorted_probabilities(logits, model.config.id2label)
+    chart_colors = {"column_color": "#10b981", "background_color": "#111827", "grid_color": "white"}
+
+    def chart_cold():
+        charts.clear_cache()
+        app.show_plot_probabilities(labels_sorted, probs_sorted, **chart_colors)
+
+    record("chart/cold", chart_cold)
+    record("chart/cached", lambda: app.show_plot_probabilities(labels_sorted, probs_sorted, **chart_colors))
+
+    def process_image(stored):
+        # process_image() shows errors on the page instead of raising them
+        app.process_image(stored)
+        if stored.logits is None:
+            raise RuntimeError("process_image() did not produce a prediction, see the errors above")
+
+    for resolution, size in resolutions.items():
+        data = encode(synthetic_image(size), "JPEG")
+
+        def process_image_cold(data=data):
+            app.prediction_cache.clear()
+            charts.clear_cache()
+            process_image(StoredImage(data))
+
+        stored = StoredImage(data)
+        record(f"process_image/cold/{resolution}", process_image_cold)
+        record(f"process_image/cached/{resolution}", lambda stored=stored: process_image(stored))
+
+    return results
+
+
+def run_scaling(worker_counts, threads_per_worker: Optional[int] = None, pin_cores: bool = False,
+                requests: int = 64, max_batch_size: int = 8) -> Dict[str, dict]:
+    """
+    Measures the throughput of the worker pool for each number of workers. All
+    single-image requests are submitted at once, as by many concurrent sessions.
+    The memory is summed over the workers; the PSS shows how much of the weights
+    is shared between them.
+    """
+    from utils.model import load_processor_and_model
+    from utils.preprocessing import FastPreprocessor
+    from utils.workers import WorkerPool
+
+    preprocessor = FastPreprocessor.from_processor(load_processor_and_model()[0])
+    pixel_values = preprocessor(synthetic_image((224, 224)))
+
+    results = {}
+    for num_workers in worker_counts:
+        pool = WorkerPool(num_workers, threads_per_worker, pin_cores, max_batch_size=max_batch_size)
+        try:
+            for future in [pool.submit(pixel_values) for _ in range(2 * num_workers)]:
+                future.result()
+
+            start = time.perf_counter()
+            for future in [pool.submit(pixel_values) for _ in range(requests)]:
+                future.result()
+            elapsed = time.perf_counter() - start
+
+            memory = [process_memory_mb(process.pid) for process in pool.processes]
+            results[f"workers_{num_workers}"] = {
+                "workers": num_workers,
+                "threads_per_worker": pool.threads_per_worker,
+                "images_per_s": requests / elapsed,
+                "rss_mb": sum(m["rss_mb"] for m in memory),
+                "pss_mb": sum(m["pss_mb"] for m in memory),
+            }
+        finally:
+            pool.close()
+
+        result = results[f"workers_{num_workers}"]
+        print(f"{num_workers:>3} workers x {result['threads_per_worker']} threads: {result['images_per_s']:>8.1f} images/s   "
+              f"RSS {result['rss_mb']:>8.1f} MB   PSS {result['pss_mb']:>8.1f} MB", file=sys.stderr)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float, min_delta_ms: float = 0.5) -> List[str]:
+    """
+    Compares the wall time and the peak memory of every stage with a baseline.
+    The peak RSS of the whole process only grows from stage to stage, so the
+    peak while the stage ran is compared; results without it are skipped.
+
+    Args:
+      results (Dict[str, dict]): Results of the current run.
+      baseline (Dict[str, dict]): Results of the baseline run.
+      threshold (float): Allowed relative increase, e.g. 0.2 for 20 %.
+      min_delta_ms (float): Smaller absolute increases of wall time are treated as noise.
+
+    Returns:
+      List[str]: Descriptions of the regressions, empty if there are none.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("p50_ms", "stage_peak_rss_mb"):
+            old, new = baseline[name].get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == "p50_ms" and new - old < min_delta_ms:
+                continue
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append(f"{name}: {metric} {old:.2f} -> {new:.2f} (+{new / old - 1:.0%})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the prediction path")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file with the results")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="Ignore smaller wall time increases")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--quick", action="store_true", help="Only the small resolution and fewer repeats")
+    parser.add_argument("--scaling", action="store_true", help="Measure the throughput of the worker pool instead")
+    parser.add_argument("--workers", default=",".join(map(str, WORKER_COUNTS)), help="Comma separated worker counts for --scaling")
+    parser.add_argument("--threads-per-worker", type=int, help="Torch threads of each worker, cores / workers by default")
+    parser.add_argument("--pin-cores", action="store_true", help="Pin each worker to its own cores")
+    parser.add_argument("--requests", type=int, default=64, help="Number of requests per worker count for --scaling")
+    args = parser.parse_args(argv)
+
+    if args.scaling:
+        worker_counts = [int(count) for count in args.workers.split(",")]
+        scaling = run_scaling(worker_counts, args.threads_per_worker, args.pin_cores, args.requests)
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"python": platform.python_version(), "torch": torch.__version__, "cores": os.cpu_count(),
+                                "machine": platform.machine(), "timestamp": time.time()}, "scaling": scaling}, f, indent=2)
+        return
+
+    resolutions = {"small": RESOLUTIONS["small"]} if args.quick else RESOLUTIONS
+    repeats = min(args.repeats, 5) if args.quick else args.repeats
+    results = run_benchmarks(repeats, resolutions)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print("Regressions against the baseline:", file=sys.stderr)
+            print("\n".join(regressions), file=sys.stderr)
+            raise SystemExit(1)
+        print("No regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
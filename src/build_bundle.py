@@ -0,0 +1,56 @@
+"""
+Downloads the model and bakes it into a local bundle (safetensors weights,
+config and preprocessing config). Run at image build time; at runtime the
+app loads the bundle from MODEL_DIR without any network access.
+
+Example:
+  python src/build_bundle.py --output model_bundle
+"""
+import argparse
+import json
+import os
+from typing import List, Optional
+
+from safetensors.torch import save_file
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+from utils.model import BUNDLE_INFO_FILE, MODEL_NAME, WEIGHTS_FILE
+
+
+def build_bundle(output: str, model_name: str = MODEL_NAME, revision: Optional[str] = None) -> None:
+    """
+    Saves the processor, the model config and the weights into the output directory.
+    The weights are stored under the parameter names of the installed transformers
+    version, so at runtime they can be memory-mapped directly into the model.
+
+    Args:
+      output (str): Directory of the bundle.
+      model_name (str): Hugging Face model id.
+      revision (str | None): Git revision of the model, the latest by default.
+    """
+    processor = AutoImageProcessor.from_pretrained(model_name, revision=revision)
+    model = AutoModelForImageClassification.from_pretrained(model_name, revision=revision)
+
+    os.makedirs(output, exist_ok=True)
+    processor.save_pretrained(output)
+    model.config.save_pretrained(output)
+    state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    save_file(state_dict, os.path.join(output, WEIGHTS_FILE), metadata={"format": "pt"})
+
+    with open(os.path.join(output, BUNDLE_INFO_FILE), "w") as f:
+        json.dump({"model": model_name, "revision": getattr(model.config, "_commit_hash", None) or revision}, f)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build a local model bundle")
+    parser.add_argument("--output", default="model_bundle")
+    parser.add_argument("--model", default=MODEL_NAME, help="Hugging Face model id")
+    parser.add_argument("--revision", help="Git revision of the model")
+    args = parser.parse_args(argv)
+
+    build_bundle(args.output, args.model, args.revision)
+    print(f"Model bundle written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Builds the nearest-neighbour index of labeled reference images shown by the app
+as similar known cases (LESION_INDEX_DIR).
+
+The reference images are given as folders named after the labels (e.g.
+reference/melanoma/*.jpg) or as CSV manifests with "path" and "label" columns.
+The labels are the model labels, see utils/descriptions.py.
+
+Example:
+  python src/build_index.py reference/ --output lesion_index --workers 8
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import batch_predict
+from utils.descriptions import lesion_names
+from utils.model import load_processor_and_model, model_revision
+from utils.preprocessing import FastPreprocessor
+from utils.similarity import Embedder, build_index
+
+
+def collect_labeled_inputs(sources: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    Expands folders per label and CSV manifests into image paths and their labels.
+    Images with a label unknown to the model are skipped.
+
+    Args:
+      sources (Iterable[str]): Directories or .csv files.
+
+    Returns:
+      Tuple[List[str], List[str]]: The image paths and their labels.
+    """
+    labeled = {}
+    for source in sources:
+        if source.lower().endswith(".csv"):
+            base_dir = os.path.dirname(source)
+            with open(source, newline="") as f:
+                for row in csv.DictReader(f):
+                    labeled[os.path.join(base_dir, row["path"])] = row["label"]
+        else:
+            for path in batch_predict.collect_inputs([source]):
+                labeled[path] = os.path.basename(os.path.dirname(path))
+
+    unknown = {label for label in labeled.values() if label not in lesion_names}
+    if unknown:
+        print(f"Skipping images with unknown labels: {', '.join(sorted(unknown))}", file=sys.stderr)
+    paths = [path for path, label in labeled.items() if label in lesion_names]
+    return paths, [labeled[path] for path in paths]
+
+
+def compute_embeddings(paths: List[str], processor, model, output: str, batch_size: int = 32,
+                       workers: int = 0) -> Tuple[np.ndarray, List[int]]:
+    """
+    Computes the embeddings of the images into a memory-mapped float32 file, so
+    the reference set does not need to fit in memory.
+
+    Returns:
+      Tuple[np.ndarray, List[int]]: The embeddings of the readable images and their positions in `paths`.
+    """
+    embedder = Embedder(model)
+    preprocessor = FastPreprocessor.from_processor(processor)
+    dim = model.config.hidden_size
+    embeddings = np.lib.format.open_memmap(output, mode="w+", dtype=np.float32, shape=(len(paths), dim))
+
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers, initializer=batch_predict._init_worker, initargs=(preprocessor,))
+    else:
+        batch_predict._worker_preprocessor = preprocessor
+
+    positions = {path: i for i, path in enumerate(paths)}
+    kept = []
+    batch_positions, batch_pixels = [], []
+    start = time.perf_counter()
+
+    def flush_batch():
+        if batch_positions:
+            rows = len(kept)
+            embeddings[rows:rows + len(batch_positions)] = embedder(torch.from_numpy(np.stack(batch_pixels)))
+            kept.extend(batch_positions)
+            batch_positions.clear()
+            batch_pixels.clear()
+        print(f"{len(kept)}/{len(paths)} images, {len(kept) / max(time.perf_counter() - start, 1e-9):.1f} images/s", file=sys.stderr)
+
+    try:
+        for path, pixel_values, error in batch_predict._iter_preprocessed(executor, paths, prefetch=2 * batch_size):
+            if error is not None:
+                print(f"Skipping {path}: {error}", file=sys.stderr)
+                continue
+            batch_positions.append(positions[path])
+            batch_pixels.append(pixel_values)
+            if len(batch_positions) == batch_size:
+                flush_batch()
+        flush_batch()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    embeddings.flush()
+    return embeddings[:len(kept)], kept
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build the index of similar reference lesions")
+    parser.add_argument("inputs", nargs="+", help="Folders named after the labels or CSV manifests with 'path' and 'label' columns")
+    parser.add_argument("--output", default="lesion_index", help="Directory of the index")
+    parser.add_argument("--dtype", choices=["int8", "float16"], default="int8", help="Storage type of the embeddings")
+    parser.add_argument("--clusters", type=int, help="Number of IVF clusters, about sqrt(number of images) by default")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of decoding processes")
+    parser.add_argument("--model", help="Hugging Face model id or local bundle, MODEL_DIR or the default model if not set")
+    args = parser.parse_args(argv)
+
+    paths, labels = collect_labeled_inputs(args.inputs)
+    if not paths:
+        raise SystemExit("No labeled images found")
+    processor, model = load_processor_and_model(args.model)
+
+    os.makedirs(args.output, exist_ok=True)
+    embeddings_file = os.path.join(args.output, "embeddings.float32.tmp.npy")
+    try:
+        embeddings, kept = compute_embeddings(paths, processor, model, embeddings_file, args.batch_size, args.workers)
+        build_index(args.output, embeddings, [labels[i] for i in kept], [paths[i] for i in kept], dtype=args.dtype,
+                    num_clusters=args.clusters, model=model_revision(args.model))
+        del embeddings
+    finally:
+        os.remove(embeddings_file)
+    print(f"Index of {len(kept)} images written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares the inference backends against eager PyTorch: top-1 agreement,
+forward latency and memory.
+
+Example:
+  python src/compare_backends.py --images data/sample --backends eager int8 onnx
+"""
+import argparse
+import statistics
+import time
+from typing import List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from batch_predict import collect_inputs
+from utils.backends import BACKENDS, EagerBackend, OnnxBackend, QuantizedBackend
+from utils.model import load_processor_and_model
+from utils.system import current_rss_mb, peak_rss_mb
+
+
+def sample_pixel_values(processor, image_paths: List[str], count: int, seed: int = 0) -> torch.Tensor:
+    """
+    Preprocesses the sample images, or random synthetic images if no paths are given.
+    """
+    if image_paths:
+        images = [Image.open(path).convert("RGB") for path in image_paths[:count]]
+    else:
+        rng = np.random.default_rng(seed)
+        images = [Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in range(count)]
+    return processor(images=images, return_tensors="pt")["pixel_values"]
+
+
+def create_backend(name: str, model):
+    if name == "eager":
+        return EagerBackend(model)
+    if name == "int8":
+        return QuantizedBackend(model)
+    return OnnxBackend(model)
+
+
+def measure(backend, pixel_values: torch.Tensor, repeats: int) -> dict:
+    """
+    Measures single image latency and returns it together with the logits of all images.
+    """
+    latencies = []
+    for _ in range(repeats):
+        for i in range(len(pixel_values)):
+            start = time.perf_counter()
+            backend(pixel_values[i:i + 1])
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        "logits": backend(pixel_values),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare inference backends")
+    parser.add_argument("--images", nargs="*", default=[], help="Sample images (directories, globs or manifests); synthetic if empty")
+    parser.add_argument("--count", type=int, default=32, help="Number of sample images")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--min-agreement", type=float, default=0.95, help="Fail if top-1 agreement with eager is lower")
+    parser.add_argument("--model", help="Hugging Face model id or local bundle, MODEL_DIR or the default model if not set")
+    args = parser.parse_args(argv)
+
+    processor, model = load_processor_and_model(args.model)
+    pixel_values = sample_pixel_values(processor, collect_inputs(args.images), args.count)
+    reference = EagerBackend(model)(pixel_values).argmax(dim=1)
+
+    print(f"{'backend':<8} {'top-1 agreement':>16} {'p50 ms':>8} {'p95 ms':>8} {'RSS +MB':>8} {'peak RSS MB':>12}")
+    failed = False
+    for name in args.backends:
+        rss_before = current_rss_mb()
+        backend = create_backend(name, model)
+        result = measure(backend, pixel_values, args.repeats)
+        agreement = (result["logits"].argmax(dim=1) == reference).float().mean().item()
+        failed |= agreement < args.min_agreement
+
+        print(f"{name:<8} {agreement:>16.2%} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+              f"{current_rss_mb() - rss_before:>8.1f} {peak_rss_mb():>12.1f}")
+        del backend
+
+    if failed:
+        raise SystemExit(f"Top-1 agreement with eager is below {args.min_agreement:.0%}")
+
+
+if __name__ == "__main__":
+    main()
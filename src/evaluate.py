@@ -0,0 +1,317 @@
+"""
+Evaluates the model on a labeled dataset: confusion matrix, per-class recall,
+top-k accuracy, calibration (ECE) and malignancy sensitivity/specificity.
+
+The dataset is a folder per label (model labels or HAM10000 diagnosis codes),
+a CSV with "path" and "label" columns, or the HAM10000 metadata CSV ("image_id"
+and "dx" columns) together with the folders containing its images.
+
+The logits are cached in an .npz file. Later runs only compute the images which
+are not in the cache yet, so metrics and thresholds can be recomputed without
+running the model again. A cache written with another model revision, backend
+or label space is ignored.
+
+Example:
+  python src/evaluate.py HAM10000_metadata.csv --image-dir HAM10000_images_part_1 HAM10000_images_part_2 --workers 8
+  python src/evaluate.py HAM10000_metadata.csv --image-dir images --malignancy-threshold 0.3 --output metrics.json
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import batch_predict
+from utils.backends import BACKENDS, backend_name, load_backend
+from utils.descriptions import ham10000_labels, lesion_names, malignant_lesions
+from utils.model import load_processor_and_model, model_revision
+from utils.preprocessing import FastPreprocessor
+
+
+def to_model_label(label: str) -> Optional[str]:
+    """
+    Returns the model label of a model label or HAM10000 diagnosis code, None if unknown.
+    """
+    if label in lesion_names:
+        return label
+    return ham10000_labels.get(label.lower())
+
+
+def collect_dataset(sources: Iterable[str], image_dirs: Iterable[str] = ()) -> Tuple[List[str], List[str]]:
+    """
+    Expands the dataset sources into image paths and their model labels.
+    Images with an unknown label or a missing file are skipped.
+
+    Args:
+      sources (Iterable[str]): Folders per label, CSV files with "path" and "label"
+        columns or HAM10000 metadata CSV files with "image_id" and "dx" columns.
+      image_dirs (Iterable[str]): Folders with the images of HAM10000 metadata files,
+        the folder of the CSV file by default.
+
+    Returns:
+      Tuple[List[str], List[str]]: The image paths and their labels.
+    """
+    labeled = {}
+    by_image_id = None
+    for source in sources:
+        if not source.lower().endswith(".csv"):
+            for path in batch_predict.collect_inputs([source]):
+                labeled[path] = os.path.basename(os.path.dirname(path))
+            continue
+
+        base_dir = os.path.dirname(source)
+        with open(source, newline="") as f:
+            for row in csv.DictReader(f):
+                if "path" in row:
+                    labeled[os.path.join(base_dir, row["path"])] = row["label"]
+                    continue
+                if by_image_id is None:
+                    image_paths = batch_predict.collect_inputs(list(image_dirs) or [base_dir])
+                    by_image_id = {os.path.splitext(os.path.basename(path))[0]: path for path in image_paths}
+                path = by_image_id.get(row["image_id"])
+                if path is not None:
+                    labeled[path] = row["dx"]
+
+    paths, labels = [], []
+    skipped = 0
+    for path, label in labeled.items():
+        label = to_model_label(label)
+        if label is None:
+            skipped += 1
+            continue
+        paths.append(path)
+        labels.append(label)
+    if skipped:
+        print(f"Skipped {skipped} images with unknown labels", file=sys.stderr)
+    return paths, labels
+
+
+def load_cache(cache: Optional[str], labels: List[str], model: str, backend: str) -> Dict[str, np.ndarray]:
+    """
+    Reads cached logits, keyed by image path. A cache of a different model, backend or label space is ignored.
+    """
+    if not cache or not os.path.exists(cache):
+        return {}
+    with np.load(cache) as data:
+        if list(data["labels"]) != labels or str(data["model"]) != model:
+            print(f"Ignoring {cache}, it was computed by a different model", file=sys.stderr)
+            return {}
+        # The logits of the int8 and onnx backends differ slightly from those of eager
+        if "backend" not in data or str(data["backend"]) != backend:
+            print(f"Ignoring {cache}, it was computed by a different backend", file=sys.stderr)
+            return {}
+        return dict(zip(data["paths"].tolist(), data["logits"]))
+
+
+def save_cache(cache: str, logits: Dict[str, np.ndarray], labels: List[str], model: str, backend: str) -> None:
+    tmp_path = f"{cache}.tmp.npz"
+    paths = sorted(logits)
+    np.savez(tmp_path, paths=np.array(paths), logits=np.stack([logits[path] for path in paths]),
+             labels=np.array(labels), model=np.array(model), backend=np.array(backend))
+    os.replace(tmp_path, cache)
+
+
+def compute_logits(paths: List[str], preprocessor: FastPreprocessor, backend, batch_size: int = 32,
+                   workers: int = 0) -> Tuple[Dict[str, np.ndarray], float]:
+    """
+    Runs the images through the model, decoding in `workers` processes.
+
+    Returns:
+      Tuple[Dict[str, np.ndarray], float]: The logits of the readable images and the throughput in images/s.
+    """
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(workers, initializer=batch_predict._init_worker, initargs=(preprocessor,))
+    else:
+        batch_predict._worker_preprocessor = preprocessor
+
+    logits = {}
+    batch_paths, batch_pixels = [], []
+    start = time.perf_counter()
+
+    def flush_batch():
+        if batch_paths:
+            batch_logits = backend(torch.from_numpy(np.stack(batch_pixels))).numpy()
+            logits.update(zip(batch_paths, batch_logits))
+            batch_paths.clear()
+            batch_pixels.clear()
+        print(f"{len(logits)}/{len(paths)} images, {len(logits) / max(time.perf_counter() - start, 1e-9):.1f} images/s", file=sys.stderr)
+
+    try:
+        for path, pixel_values, error in batch_predict._iter_preprocessed(executor, paths, prefetch=2 * batch_size):
+            if error is not None:
+                print(f"Skipping {path}: {error}", file=sys.stderr)
+                continue
+            batch_paths.append(path)
+            batch_pixels.append(pixel_values)
+            if len(batch_paths) == batch_size:
+                flush_batch()
+        flush_batch()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return logits, len(logits) / max(time.perf_counter() - start, 1e-9)
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def confusion_matrix(y_true: np.ndarray, y_pred: np.ndarray, num_classes: int) -> np.ndarray:
+    """
+    Returns the confusion matrix, rows are the true classes and columns the predicted ones.
+    """
+    return np.bincount(y_true * num_classes + y_pred, minlength=num_classes**2).reshape(num_classes, num_classes)
+
+
+def top_k_accuracy(probs: np.ndarray, y_true: np.ndarray, k: int) -> float:
+    """
+    Returns the fraction of images whose true class is among the k most probable ones.
+    """
+    k = min(k, probs.shape[1])
+    top_k = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    return float((top_k == y_true[:, None]).any(axis=1).mean())
+
+
+def expected_calibration_error(probs: np.ndarray, y_true: np.ndarray, bins: int = 15) -> float:
+    """
+    Returns the expected calibration error of the top-1 confidence with equal width bins.
+    """
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == y_true
+    bin_index = np.minimum((confidence * bins).astype(int), bins - 1)
+    counts = np.bincount(bin_index, minlength=bins)
+    confidence_sums = np.bincount(bin_index, weights=confidence, minlength=bins)
+    correct_sums = np.bincount(bin_index, weights=correct, minlength=bins)
+    return float(np.abs(confidence_sums - correct_sums).sum() / len(y_true))
+
+
+def compute_metrics(logits: np.ndarray, y_true: np.ndarray, labels: List[str], top_k: Iterable[int] = (1, 2, 3),
+                    bins: int = 15, malignancy_threshold: float = 0.5) -> dict:
+    """
+    Computes all metrics from the logits.
+
+    Args:
+      logits (np.ndarray): Logits (N, K).
+      y_true (np.ndarray): Indices of the true classes (N,).
+      labels (List[str]): Model labels by class index.
+      top_k (Iterable[int]): Values of k for the top-k accuracy.
+      bins (int): Number of bins of the calibration error.
+      malignancy_threshold (float): Images with a larger summed probability of the
+        malignant lesion types count as predicted malignant.
+
+    Returns:
+      dict: The metrics.
+    """
+    probs = softmax(logits.astype(np.float64))
+    matrix = confusion_matrix(y_true, probs.argmax(axis=1), len(labels))
+    support = matrix.sum(axis=1)
+    recall = np.divide(np.diag(matrix), support, out=np.full(len(labels), np.nan), where=support > 0)
+
+    malignant = np.isin(labels, malignant_lesions)
+    is_malignant = malignant[y_true]
+    predicted_malignant = probs[:, malignant].sum(axis=1) > malignancy_threshold
+
+    return {
+        "images": int(len(y_true)),
+        "accuracy": float(np.trace(matrix) / len(y_true)),
+        "top_k_accuracy": {str(k): top_k_accuracy(probs, y_true, k) for k in top_k},
+        "balanced_accuracy": float(np.nanmean(recall)),
+        "recall": {label: (None if np.isnan(value) else float(value)) for label, value in zip(labels, recall)},
+        "support": {label: int(count) for label, count in zip(labels, support)},
+        "expected_calibration_error": expected_calibration_error(probs, y_true, bins),
+        "malignancy": {
+            "threshold": malignancy_threshold,
+            "sensitivity": float(predicted_malignant[is_malignant].mean()) if is_malignant.any() else None,
+            "specificity": float((~predicted_malignant[~is_malignant]).mean()) if (~is_malignant).any() else None,
+        },
+        "confusion_matrix": matrix.tolist(),
+        "labels": labels,
+    }
+
+
+def print_report(metrics: dict) -> None:
+    labels = metrics["labels"]
+    print(f"Images: {metrics['images']}")
+    print(f"Accuracy: {metrics['accuracy']:.2%}   balanced: {metrics['balanced_accuracy']:.2%}")
+    print("Top-k accuracy: " + "   ".join(f"top-{k} {value:.2%}" for k, value in metrics["top_k_accuracy"].items()))
+    print(f"Expected calibration error: {metrics['expected_calibration_error']:.4f}")
+    malignancy = metrics["malignancy"]
+    if malignancy["sensitivity"] is not None and malignancy["specificity"] is not None:
+        print(f"Malignancy (threshold {malignancy['threshold']:g}): sensitivity {malignancy['sensitivity']:.2%}   "
+              f"specificity {malignancy['specificity']:.2%}")
+
+    print("\nRecall per class:")
+    for label in labels:
+        recall = metrics["recall"][label]
+        print(f"  {lesion_names[label]:<32} {'-' if recall is None else f'{recall:.2%}':>8}   ({metrics['support'][label]} images)")
+
+    print("\nConfusion matrix (rows: true, columns: predicted):")
+    width = max(len(str(value)) for row in metrics["confusion_matrix"] for value in row) + 1
+    print(" " * 32 + "".join(f"{i:>{width}}" for i in range(len(labels))))
+    for i, (label, row) in enumerate(zip(labels, metrics["confusion_matrix"])):
+        print(f"{i} {lesion_names[label]:<30}" + "".join(f"{value:>{width}}" for value in row))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Evaluate the model on a labeled dataset")
+    parser.add_argument("inputs", nargs="+", help="Folders per label, CSV files with 'path' and 'label' or HAM10000 metadata")
+    parser.add_argument("--image-dir", nargs="*", default=[], help="Folders with the images of HAM10000 metadata files")
+    parser.add_argument("--cache", default="logits.npz", help="Cache of the logits, '' to disable")
+    parser.add_argument("--output", help="JSON file with the metrics")
+    parser.add_argument("--top-k", default="1,2,3", help="Comma separated values of k for the top-k accuracy")
+    parser.add_argument("--bins", type=int, default=15, help="Number of bins of the calibration error")
+    parser.add_argument("--malignancy-threshold", type=float, default=0.5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of decoding processes")
+    parser.add_argument("--model", help="Hugging Face model id or local bundle, MODEL_DIR or the default model if not set")
+    parser.add_argument("--backend", choices=BACKENDS, help="Inference backend, INFERENCE_BACKEND or eager by default")
+    args = parser.parse_args(argv)
+
+    paths, labels = collect_dataset(args.inputs, args.image_dir)
+    if not paths:
+        raise SystemExit("No labeled images found")
+
+    processor, model = load_processor_and_model(args.model)
+    class_labels = [model.config.id2label[i] for i in range(len(model.config.id2label))]
+    revision = model_revision(args.model, model)
+    backend = backend_name(args.backend)
+
+    logits = load_cache(args.cache, class_labels, revision, backend)
+    todo = [path for path in paths if path not in logits]
+    if todo:
+        print(f"Running the model on {len(todo)} images ({len(paths) - len(todo)} cached)", file=sys.stderr)
+        new_logits, images_per_second = compute_logits(todo, FastPreprocessor.from_processor(processor),
+                                                       load_backend(model, backend, inplace=True), args.batch_size, args.workers)
+        logits.update(new_logits)
+        if args.cache:
+            save_cache(args.cache, logits, class_labels, revision, backend)
+        print(f"Throughput: {images_per_second:.1f} images/s", file=sys.stderr)
+
+    class_index = {label: i for i, label in enumerate(class_labels)}
+    evaluated = [i for i, path in enumerate(paths) if path in logits]
+    metrics = compute_metrics(
+        np.stack([logits[paths[i]] for i in evaluated]),
+        np.array([class_index[labels[i]] for i in evaluated]),
+        class_labels,
+        top_k=[int(k) for k in args.top_k.split(",")],
+        bins=args.bins,
+        malignancy_threshold=args.malignancy_threshold,
+    )
+    print_report(metrics)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
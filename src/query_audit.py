@@ -0,0 +1,236 @@
+"""
+Queries the audit log of the predictions written by the app (AUDIT_LOG).
+
+Without --csv, prints per model (revision, inference backend and whether TTA
+was enabled) the number of predictions of every class and the mean
+probabilities. With --csv, writes the matching records, one row per
+prediction with the probability of every class.
+
+The records are read in chunks and their probability vectors are decoded with
+one NumPy call per chunk, so millions of records are scanned in seconds.
+
+Example:
+  python src/query_audit.py audit.db --since 2025-01-01 --label melanoma
+  python src/query_audit.py audit.db --image 3f2a...c9 --csv image.csv
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import string
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from utils.audit import PROBABILITY_DTYPE
+
+
+def parse_time(value: str) -> float:
+    """
+    Parses a Unix timestamp or an ISO 8601 date/time (UTC if no offset is given).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.timestamp()
+
+
+class Model(NamedTuple):
+    """
+    A model of the log: the predictions of one revision with one backend and TTA setting.
+    """
+    revision: str
+    backend: str
+    tta: bool
+    labels: List[str]
+
+    @property
+    def name(self) -> str:
+        return f"{self.revision} ({self.backend}{', TTA' if self.tta else ''})"
+
+
+def load_models(connection: sqlite3.Connection) -> Dict[int, Model]:
+    """
+    Returns the model of every model id.
+    """
+    return {model_id: Model(revision, backend, bool(tta), json.loads(labels))
+            for model_id, revision, backend, tta, labels in connection.execute("SELECT id, revision, backend, tta, labels FROM models")}
+
+
+def build_filter(models: Dict[int, Model], since: Optional[float] = None, until: Optional[float] = None,
+                 image: Optional[str] = None, model: Optional[str] = None,
+                 label: Optional[str] = None) -> Tuple[str, list]:
+    """
+    Returns the WHERE clause and its parameters selecting the matching records.
+    """
+    conditions, params = [], []
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("timestamp < ?")
+        params.append(until)
+    if image is not None:
+        # A full digest uses the index, a prefix is compared on every record
+        digest = bytes.fromhex(image[:len(image) // 2 * 2])
+        if len(digest) == 32:
+            conditions.append("image_sha256 = ?")
+        else:
+            conditions.append(f"substr(image_sha256, 1, {len(digest)}) = ?")
+        params.append(digest)
+    if model is not None:
+        # A revision selects all of its backends, the name of a model only that one
+        model_ids = [model_id for model_id, entry in models.items() if model in (entry.revision, entry.name)]
+        conditions.append(f"model_id IN ({','.join('?' * len(model_ids)) or 'NULL'})")
+        params.extend(model_ids)
+    if label is not None:
+        # The class index of a label may differ between models
+        pairs = [(model_id, entry.labels.index(label)) for model_id, entry in models.items() if label in entry.labels]
+        conditions.append("(" + (" OR ".join("(model_id = ? AND predicted_class = ?)" for _ in pairs) or "0") + ")")
+        params.extend(value for pair in pairs for value in pair)
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+
+def iter_records(connection: sqlite3.Connection, where: str = "", params: list = (), chunk_size: int = 65536,
+                 limit: Optional[int] = None, with_digests: bool = True
+                 ) -> Iterator[Tuple[int, np.ndarray, Optional[List[bytes]], np.ndarray, np.ndarray]]:
+    """
+    Reads the matching records in insertion order, in chunks grouped by model.
+
+    Yields:
+      Tuple: The model id, timestamps (N,), image digests (None without `with_digests`),
+      predicted classes (N,) and probabilities (N, K) as float32.
+    """
+    # Reading the digests costs a third of the scan, they are only read when needed
+    digest_column = "image_sha256" if with_digests else "NULL"
+    query = f"SELECT model_id, timestamp, {digest_column}, predicted_class, probabilities FROM predictions{where} ORDER BY id"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    cursor = connection.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        model_ids, timestamps, digests, predicted, blobs = zip(*rows)
+        model_ids = np.array(model_ids)
+        timestamps = np.array(timestamps)
+        predicted = np.array(predicted)
+        for model_id in np.unique(model_ids):
+            rows_of_model = np.flatnonzero(model_ids == model_id)
+            # The vectors of one model have the same length, they are decoded together
+            probabilities = np.frombuffer(b"".join(blobs[i] for i in rows_of_model), dtype=PROBABILITY_DTYPE)
+            yield (int(model_id), timestamps[rows_of_model], [digests[i] for i in rows_of_model] if with_digests else None,
+                   predicted[rows_of_model], probabilities.reshape(len(rows_of_model), -1).astype(np.float32))
+
+
+def summarize(connection: sqlite3.Connection, models: Dict[int, Model], where: str = "",
+              params: list = (), limit: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Returns per model name the number of records, their time range, the
+    number of predictions of every class and the mean probabilities.
+    """
+    totals = {}
+    records = iter_records(connection, where, params, limit=limit, with_digests=False)
+    for model_id, timestamps, _, predicted, probabilities in records:
+        labels = models[model_id].labels
+        total = totals.setdefault(model_id, {
+            "count": 0, "first": np.inf, "last": -np.inf,
+            "predicted": np.zeros(len(labels), dtype=np.int64), "probability_sum": np.zeros(len(labels)),
+        })
+        total["count"] += len(predicted)
+        total["first"] = min(total["first"], timestamps.min())
+        total["last"] = max(total["last"], timestamps.max())
+        total["predicted"] += np.bincount(predicted, minlength=len(labels))
+        total["probability_sum"] += probabilities.sum(axis=0, dtype=np.float64)
+
+    summary = {}
+    for model_id, total in totals.items():
+        labels = models[model_id].labels
+        summary[models[model_id].name] = {
+            "count": total["count"],
+            "first": total["first"],
+            "last": total["last"],
+            "predicted": dict(zip(labels, total["predicted"].tolist())),
+            "mean_probability": dict(zip(labels, (total["probability_sum"] / total["count"]).tolist())),
+        }
+    return summary
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="seconds")
+
+
+def print_summary(summary: Dict[str, dict]) -> None:
+    if not summary:
+        print("No matching predictions")
+    for name, model in summary.items():
+        print(f"{name}: {model['count']} predictions from {format_time(model['first'])} to {format_time(model['last'])}")
+        print(f"  {'label':<30} {'predicted':>10} {'mean probability':>17}")
+        for label, count in model["predicted"].items():
+            print(f"  {label:<30} {count:>10} {model['mean_probability'][label]:>17.2%}")
+
+
+def export_csv(connection: sqlite3.Connection, models: Dict[int, Model], output: str, where: str = "",
+               params: list = (), limit: Optional[int] = None) -> int:
+    """
+    Writes the matching records to a CSV file and returns their number.
+    Probabilities are written in columns named after the labels.
+    """
+    all_labels = sorted({label for model in models.values() for label in model.labels})
+    count = 0
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "image_sha256", "model", "backend", "tta", "predicted"] + all_labels)
+        for model_id, timestamps, digests, predicted, probabilities in iter_records(connection, where, params, limit=limit):
+            model = models[model_id]
+            columns = [all_labels.index(label) for label in model.labels]
+            for i in range(len(predicted)):
+                row = [""] * len(all_labels)
+                for column, probability in zip(columns, probabilities[i]):
+                    row[column] = f"{probability:.4f}"
+                writer.writerow([format_time(timestamps[i]), digests[i].hex(), model.revision, model.backend,
+                                 int(model.tta), model.labels[predicted[i]]] + row)
+            count += len(predicted)
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Query the audit log of the predictions")
+    parser.add_argument("database", help="Audit log database (AUDIT_LOG of the app)")
+    parser.add_argument("--since", type=parse_time, help="Records from this time on, ISO date/time (UTC) or Unix time")
+    parser.add_argument("--until", type=parse_time, help="Records before this time")
+    parser.add_argument("--image", help="SHA-256 of the image file or a prefix of it (hex)")
+    parser.add_argument("--model", help="Model revision, as stored in the log, or the name of a model in the summary")
+    parser.add_argument("--label", help="Predicted label")
+    parser.add_argument("--limit", type=int, help="Maximum number of records read")
+    parser.add_argument("--csv", help="Write the matching records to this CSV file instead of the summary")
+    args = parser.parse_args(argv)
+    # Digests are compared as bytes, so a prefix needs at least one full byte
+    if args.image is not None and not (2 <= len(args.image) <= 64 and all(c in string.hexdigits for c in args.image)):
+        parser.error(f"argument --image: {args.image!r} is not a SHA-256 digest or a prefix of it in hex")
+
+    # Read-only, so the query never blocks or modifies the log of a running app
+    connection = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+    models = load_models(connection)
+    where, params = build_filter(models, args.since, args.until, args.image, args.model, args.label)
+
+    start = time.perf_counter()
+    if args.csv:
+        count = export_csv(connection, models, args.csv, where, params, args.limit)
+        print(f"{count} records written to {args.csv}")
+    else:
+        summary = summarize(connection, models, where, params, args.limit)
+        print_summary(summary)
+        count = sum(model["count"] for model in summary.values())
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {count} records in {elapsed:.2f} s ({count / max(elapsed, 1e-9):.0f} records/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,45 @@
 import pytest
 from app import load_model
 from PIL import Image
+import numpy as np
 import torch
+import csv
+import hashlib
 import io
+import json
+import os
+import pstats
+import sqlite3
+
+import threading
+import time
+
+import urllib.request
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import batch_predict
+import benchmark
+import build_index
+import evaluate
+import query_audit
+from build_bundle import build_bundle
+from utils import charts, tracing
+from utils.backends import EagerBackend, OnnxBackend, QuantizedBackend, load_backend, onnx_export_key
+from utils.admission import AdmissionController, ServerBusy
+from utils.audit import AuditLog
+from utils.batching import MicroBatcher, result_or_cancel
+from utils.cache import PredictionCache
+from utils.image_store import ImageStore, ImageTooLargeError, StoredImage
+from utils.fetch import ImageFetchError, fetch_image_bytes
+from utils.model import MODEL_NAME, load_processor_and_model, render_startup_metrics
+from utils.preprocessing import FastPreprocessor
+from utils.workers import WorkerPool
+from utils.similarity import Embedder, LesionIndex
+from utils.similarity import build_index as build_lesion_index
+from utils.results import malignancy_probability, sorted_probabilities
+from utils.tta import AdaptiveTTA, augmented_views
 
 @pytest.fixture
 def model_and_processor():
@@ -51,5 +88,688 @@ def test_image_resizing():
     
     assert original_image.size[0] <= max_size[0] and original_image.size[1] <= max_size[1], "Image should be resized to fit within max_size"
 
+def test_prediction_cache_lru_and_ttl():
+    cache = PredictionCache(max_entries=2, ttl_seconds=60)
+    logits = np.zeros((1, 7), dtype=np.float32)
+
+    assert cache.get("a") is None, "Empty cache should miss"
+    cache.put("a", logits)
+    cache.put("b", logits)
+    cache.get("a") # Marks "a" as recently used
+    cache.put("c", logits) # Evicts "b"
+
+    assert cache.get("a") is not None, "Recently used entry should be kept"
+    assert cache.get("b") is None, "Least recently used entry should be evicted"
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2, "Hits and misses should be counted"
+
+    expired_cache = PredictionCache(ttl_seconds=0)
+    expired_cache.put("a", logits)
+    assert expired_cache.get("a") is None, "Expired entry should not be returned"
+
+def test_prediction_cache_disk_tier(tmp_path):
+    logits = np.arange(7, dtype=np.float32).reshape(1, 7)
+    PredictionCache(disk_dir=str(tmp_path)).put("a", logits)
+
+    # A fresh cache (e.g. another process) finds the entry on disk
+    cache = PredictionCache(disk_dir=str(tmp_path))
+    assert np.array_equal(cache.get("a"), logits), "Logits should be loaded from the disk tier"
+    assert cache.stats()["disk_hits"] == 1, "Disk hit should be counted"
+
+    # Processes running another model or backend do not share the entries
+    PredictionCache(disk_dir=str(tmp_path), namespace="model@1:eager").put("b", logits)
+    assert PredictionCache(disk_dir=str(tmp_path), namespace="model@1:int8").get("b") is None
+    assert PredictionCache(disk_dir=str(tmp_path), namespace="model@2:eager").get("b") is None
+    assert np.array_equal(PredictionCache(disk_dir=str(tmp_path), namespace="model@1:eager").get("b"), logits)
+
+    # Writes remove the expired entries and the oldest ones over the limit
+    cache = PredictionCache(disk_dir=str(tmp_path), namespace="bounded", max_disk_entries=2)
+    for i, key in enumerate(["old", "c", "d", "e"]):
+        cache.put(key, logits)
+        os.utime(cache._disk_path(key), (time.time() - 10 + i, time.time() - 10 + i))
+    assert sorted(os.listdir(cache.disk_dir)) == ["d.npy", "e.npy"], "Disk tier should keep the newest entries"
+    os.utime(cache._disk_path("d"), (time.time() - 7200, time.time() - 7200))
+    cache.put("f", logits)
+    assert sorted(os.listdir(cache.disk_dir)) == ["e.npy", "f.npy"], "Expired entries should be removed"
+
+def test_batch_predict_resumes(model_and_processor, tmp_path):
+    processor, model = model_and_processor
+    for i in range(5):
+        Image.new('RGB', (120, 80), color=(i * 40, 0, 0)).save(tmp_path / f"{i}.png")
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("path\n0.png\n1.png\n2.png\n")
+    output = str(tmp_path / "results.jsonl")
+
+    assert len(batch_predict.collect_inputs([str(manifest)])) == 3, "Manifest should list 3 images"
+    paths = batch_predict.collect_inputs([str(tmp_path)])
+    assert len(paths) == 5, "Directory should contain 5 images"
+
+    batch_predict.run(paths[:3], processor, model, output, batch_size=2)
+    with open(output, "a") as f:
+        f.write('{"path": "trunc') # Simulates a crash while writing
+
+    processed = batch_predict.run(paths, processor, model, output, batch_size=2)
+    assert processed == 2, "Only the remaining images should be processed"
+
+    records = [json.loads(line) for line in open(output)]
+    assert [record["path"] for record in records] == paths, "Every image should have exactly one record"
+    assert abs(sum(records[0]["probabilities"].values()) - 1) < 1e-4, "Probabilities should sum to 1"
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    batch_sizes = []
+
+    def slow_forward(pixel_values):
+        batch_sizes.append(len(pixel_values))
+        time.sleep(0.05)
+        return pixel_values.flatten(1).sum(dim=1, keepdim=True)
+
+    batcher = MicroBatcher(slow_forward, max_batch_size=8, max_wait_ms=20)
+    try:
+        # A lone request is served on its own
+        assert batcher.predict(torch.ones(1, 3, 2, 2)).item() == 12, "Result should belong to the request"
+
+        results = [None] * 8
+        def client(i):
+            results[i] = batcher.predict(torch.full((1, 3, 2, 2), float(i))).item()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [i * 12.0 for i in range(8)], "Each client should get its own result"
+        assert max(batch_sizes) > 1, "Concurrent requests should be batched"
+        assert batcher.stats()["requests"] == 9, "All requests should be counted"
+    finally:
+        batcher.close()
+
+def test_expired_requests_are_cancelled():
+    started = threading.Event()
+    release = threading.Event()
+    batch_sizes = []
+
+    def blocked_forward(pixel_values):
+        batch_sizes.append(len(pixel_values))
+        started.set()
+        release.wait(5)
+        return pixel_values.flatten(1).sum(dim=1, keepdim=True)
+
+    batcher = MicroBatcher(blocked_forward, max_batch_size=8, max_wait_ms=1)
+    try:
+        running = batcher.submit(torch.ones(1, 3, 2, 2))
+        started.wait(5)
+        expired = batcher.submit(torch.ones(2, 3, 2, 2))
+        with pytest.raises(FutureTimeoutError):
+            result_or_cancel(expired, timeout=0.05)
+        release.set()
+
+        assert result_or_cancel(running, timeout=5).item() == 12
+        assert expired.cancelled(), "The expired request should be cancelled"
+        batcher.close()
+        assert batch_sizes == [1], "The expired request should not be run"
+    finally:
+        release.set()
+        batcher.close()
+
+def test_backends_agree_with_eager(model_and_processor, tmp_path):
+    _, model = model_and_processor
+    pixel_values = torch.randn(8, 3, 224, 224)
+    reference = EagerBackend(model)(pixel_values)
+
+    backends = [load_backend(model, "int8")]
+    assert torch.equal(EagerBackend(model)(pixel_values), reference), "The int8 backend should quantize a copy"
+    try:
+        import onnxruntime
+        backends.append(OnnxBackend(model, cache_dir=str(tmp_path)))
+    except ImportError:
+        pass
+
+    for backend in backends:
+        logits = backend(pixel_values)
+        assert logits.shape == reference.shape, f"{backend.name} logits should have the eager shape"
+        agreement = (logits.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        assert agreement >= 0.75, f"{backend.name} top-1 should agree with eager"
+
+def test_fast_preprocessor_matches_processor(model_and_processor):
+    processor, _ = model_and_processor
+    preprocessor = FastPreprocessor.from_processor(processor)
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)) for h, w in [(100, 100), (251, 317), (640, 480)]]
+
+    expected = processor(images=images, return_tensors="pt")["pixel_values"]
+    pixel_values = preprocessor(images)
+
+    assert pixel_values.shape == expected.shape, "Batch should have the processor's shape"
+    assert pixel_values.is_contiguous(), "Batch should be contiguous"
+    assert torch.allclose(pixel_values, expected, atol=1e-4), "Pixel values should match the processor"
+
+def test_fast_preprocessor_jpeg_draft(model_and_processor):
+    processor, _ = model_and_processor
+    preprocessor = FastPreprocessor.from_processor(processor)
+    rng = np.random.default_rng(0)
+    # Smooth large image, so decoding at a reduced scale loses little detail
+    pixels = np.kron(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8), np.ones((80, 80, 1), dtype=np.uint8))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=95)
+
+    expected = processor(images=Image.open(io.BytesIO(buffer.getvalue())), return_tensors="pt")["pixel_values"]
+    pixel_values = preprocessor(Image.open(io.BytesIO(buffer.getvalue())))
+
+    assert (pixel_values - expected).abs().mean() < 0.05, "Draft decoding should stay close to the full decode"
+
+    # Decoding ahead (the app decodes in its own stage) keeps the draft scale
+    decoded = preprocessor.decode(Image.open(io.BytesIO(buffer.getvalue())))
+    assert decoded.size == (400, 300), "JPEG should be decoded at 1/8 scale"
+    assert torch.equal(preprocessor(decoded), pixel_values)
+
+def test_model_bundle(model_and_processor, tmp_path):
+    _, model = model_and_processor
+    build_bundle(str(tmp_path), MODEL_NAME)
+
+    _, bundled_model = load_processor_and_model(str(tmp_path))
+    pixel_values = torch.randn(2, 3, 224, 224)
+    with torch.inference_mode():
+        expected = model(pixel_values=pixel_values).logits
+        logits = bundled_model(pixel_values=pixel_values).logits
+
+    assert torch.allclose(logits, expected), "Bundled model should give the same logits"
+
+    # A rebuilt bundle in the same directory must not reuse the exported graph of the old one
+    keys = [onnx_export_key(bundled_model)]
+    os.utime(tmp_path / "model.safetensors", ns=(0, 0))
+    keys.append(onnx_export_key(bundled_model))
+    with open(tmp_path / "bundle.json") as f:
+        info = json.load(f)
+    with open(tmp_path / "bundle.json", "w") as f:
+        json.dump({**info, "revision": "other"}, f)
+    keys.append(onnx_export_key(bundled_model))
+    assert len(set(keys)) == 3, "The key should change with the weights and the revision"
+
+    metrics = render_startup_metrics()
+    assert "# TYPE skin_startup_model_load_seconds gauge" in metrics, "Load time should be exported as a gauge"
+
+def test_tracing_disabled_is_noop(monkeypatch):
+    monkeypatch.setattr(tracing, "enabled", False)
+    with tracing.stage("noop_stage") as span:
+        span.set(num_bytes=10)
+
+    assert "noop_stage" not in tracing.render_prometheus(), "Disabled tracing should not record anything"
+
+def test_tracing_metrics_endpoint(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, "enabled", True)
+    monkeypatch.setattr(tracing, "profile_slowest", 1)
+    monkeypatch.setattr(tracing, "profile_dir", str(tmp_path))
+
+    for _ in range(3):
+        with tracing.request("test_request"):
+            with tracing.stage("test_stage") as span:
+                span.set(num_bytes=2048, image=Image.new('RGB', (100, 50)))
+
+    for _ in range(100):
+        tracing.observe("stage_bytes", "test_large_stage", 12_345_678, tracing.BYTES_BUCKETS)
+
+    server = tracing.start_metrics_server(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        server.shutdown()
+
+    assert 'skin_stage_duration_seconds_count{stage="test_stage"} 3' in body, "Stage durations should be exported"
+    assert 'skin_stage_bytes_bucket{stage="test_stage",le="4096"} 3' in body, "Bytes should be exported"
+    assert 'skin_stage_image_pixels_sum{stage="test_stage"} 15000' in body, "Image dimensions should be exported"
+    assert 'skin_stage_bytes_sum{stage="test_large_stage"} 1234567800.0' in body, "Sums should not be rounded"
+    assert 'skin_request_cpu_seconds_count{stage="test_request"} 3' in body, "CPU time of requests should be exported"
+    assert len(list(tmp_path.glob("test_request-*.prof"))) == 1, "Only the slowest request should be profiled"
+
+def test_tracing_nested_requests_profile_outer(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, "enabled", True)
+    monkeypatch.setattr(tracing, "profile_slowest", 5)
+    monkeypatch.setattr(tracing, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(tracing, "_slowest", [])
+
+    def after_inner_request():
+        return sum(range(1000))
+
+    with tracing.request("outer_request"):
+        with tracing.request("inner_request"):
+            pass
+        after_inner_request()
+
+    profiles = list(tmp_path.glob("*.prof"))
+    assert len(profiles) == 1 and profiles[0].name.startswith("outer_request-"), "Only the outer request should be profiled"
+    functions = {name for _, _, name in pstats.Stats(str(profiles[0])).stats}
+    assert "after_inner_request" in functions, "The profile should cover the work after the nested request"
+
+def test_benchmark_compare():
+    baseline = {"forward": {"p50_ms": 100.0, "stage_peak_rss_mb": 500.0}, "postprocess": {"p50_ms": 0.1, "stage_peak_rss_mb": 500.0},
+                "chart": {"p50_ms": 1.0, "stage_peak_rss_mb": 500.0, "peak_rss_mb": 500.0}}
+    results = {"forward": {"p50_ms": 150.0, "stage_peak_rss_mb": 510.0}, "postprocess": {"p50_ms": 0.3, "stage_peak_rss_mb": 500.0},
+               "chart": {"p50_ms": 1.0, "stage_peak_rss_mb": None, "peak_rss_mb": 900.0}}
+
+    regressions = benchmark.compare(results, baseline, threshold=0.2)
+
+    assert len(regressions) == 1 and regressions[0].startswith("forward: p50_ms"), "Only the slower forward should be reported"
+    assert benchmark.compare(results, baseline, threshold=0.6) == [], "Changes within the threshold should pass"
+    assert benchmark.compare({"chart": {"p50_ms": 1.0, "stage_peak_rss_mb": 700.0}}, baseline, threshold=0.2) == [
+        "chart: stage_peak_rss_mb 500.00 -> 700.00 (+40%)"], "A stage using more memory should be reported"
+
+def test_benchmark_measure():
+    result = benchmark.measure(lambda: benchmark.encode(benchmark.synthetic_image((64, 48)), "WEBP"), repeats=3)
+
+    assert 0 < result["min_ms"] <= result["p50_ms"] <= result["p95_ms"], "Timing statistics should be ordered"
+    assert result["peak_rss_mb"] > 0, "Peak RSS should be reported"
+    if result["stage_peak_rss_mb"] is not None:
+        assert result["stage_peak_rss_mb"] > 0, "Peak RSS of the stage should be reported"
+
+def test_probability_chart_spec_is_cached_and_bounded():
+    labels = ["Melanoma", "Dermatofibroma"]
+    spec = charts.probability_chart_spec(labels, [0.70001, 0.29999], "#10b981", "#111827", "white")
+
+    assert [row["Lesion"] for row in spec["data"]["values"]] == labels, "Most probable label should be first"
+    assert spec["encoding"]["y"]["sort"] is None, "Chart should keep the order of the labels"
+
+    charts.clear_cache()
+    rng = np.random.default_rng(0)
+    for _ in range(3000):
+        charts.probability_chart_spec(labels, rng.random(2).tolist(), "#10b981", "#111827", "white")
+    charts.probability_chart_spec(labels, [0.7, 0.3], "#10b981", "#111827", "white")
+    charts.probability_chart_spec(labels, [0.70004, 0.29996], "#10b981", "#111827", "white")
+
+    cache_info = charts._spec_json.cache_info()
+    assert cache_info.currsize <= cache_info.maxsize, "Chart cache should stay bounded"
+    assert cache_info.hits >= 1, "Nearly equal probabilities should share the cached chart"
+
+def test_malignancy_probability():
+    id2label = {0: "melanoma", 1: "melanocytic_Nevi", 2: "basal_cell_carcinoma"}
+    logits = torch.log(torch.tensor([[0.5, 0.3, 0.2]]))
+
+    labels_sorted, probs_sorted = sorted_probabilities(logits, id2label)
+
+    assert labels_sorted == ["melanoma", "melanocytic_Nevi", "basal_cell_carcinoma"], "Labels should be sorted by probability"
+    assert abs(malignancy_probability(logits, id2label) - 0.7) < 1e-6, "Malignant probabilities should be summed"
+
+def test_adaptive_tta_escalates_only_uncertain_images():
+    calls = []
+
+    def submit(pixel_values):
+        calls.append(len(pixel_values))
+        # Every view is sure of a different class, so the mean of the probabilities is known
+        future = Future()
+        future.set_result(torch.eye(3)[torch.arange(len(pixel_values)) % 3] * 100)
+        return future
+
+    tta = AdaptiveTTA(submit, min_margin=0.2)
+    pixel_values = torch.rand(2, 3, 8, 8)
+    logits = torch.log(torch.tensor([[0.9, 0.05, 0.05], [0.45, 0.4, 0.15]]))
+
+    refined = tta(pixel_values, logits)
+
+    assert calls == [7], "Only the uncertain image should be augmented, in one forward pass of 7 views"
+    assert torch.allclose(refined[0], logits[0]), "The confident prediction should be kept"
+    # The plain prediction and the views (classes 0, 1, 2, 0, 1, 2, 0) are averaged
+    expected = (torch.tensor([0.45, 0.4, 0.15]) + torch.tensor([3.0, 2.0, 2.0])) / 8
+    assert torch.allclose(torch.softmax(refined[1], dim=0), expected, atol=1e-5)
+    assert tta.stats()["escalation_rate"] == 0.5
+
+    # The augmented forward pass gives up at the deadline and is cancelled
+    pending = Future()
+    with pytest.raises(FutureTimeoutError):
+        AdaptiveTTA(lambda pixel_values: pending, min_margin=0.2)(pixel_values, logits, timeout=0.01)
+    assert pending.cancelled()
+    assert torch.equal(augmented_views(pixel_values)[2:4], pixel_values.flip(-2)), "Views should be view-major"
+
+def test_admission_control_under_load():
+    admission = AdmissionController(max_concurrency=2, max_queue=3, timeout_seconds=10)
+    start = threading.Barrier(10)
+    lock = threading.Lock()
+    active, peak, outcomes, positions = [0], [0], [], []
+
+    def user():
+        start.wait()
+        try:
+            with admission.admit(on_wait=positions.append):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                time.sleep(0.3)
+                with lock:
+                    active[0] -= 1
+            outcomes.append("served")
+        except ServerBusy as e:
+            outcomes.append(e.position)
+
+    users = [threading.Thread(target=user) for _ in range(10)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+
+    assert peak[0] == 2, "No more requests than the concurrency limit should run at once"
+    assert outcomes.count("served") == 5, "The running and queued requests should be served"
+    assert sorted(o for o in outcomes if o != "served") == [4] * 5, "The others should be turned away at once"
+    assert sorted(set(positions)) == [1, 2, 3], "Queued requests should be told their position"
+    stats = admission.stats()
+    assert (stats["admitted"], stats["rejected"], stats["active"], stats["queued"]) == (5, 5, 0, 0)
+
+def test_admission_deadline():
+    admission = AdmissionController(max_concurrency=1, max_queue=4)
+    positions = []
+
+    with admission.admit():
+        with pytest.raises(ServerBusy) as error:
+            with admission.admit(timeout=0.1, on_wait=positions.append):
+                pass
+
+    assert error.value.position == 1 and positions == [1]
+    assert admission.stats()["timed_out"] == 1
+    with admission.admit(timeout=5) as ticket:
+        assert ticket.waited < 0.1 and 0 < ticket.remaining() <= 5, "A free slot should be taken at once"
+
+def test_audit_log_batches_and_query(tmp_path, capsys):
+    path = str(tmp_path / "audit.db")
+    digests = [hashlib.sha256(bytes([i])).hexdigest() for i in range(10)]
+
+    log = AuditLog(path, "model@1", ["melanoma", "melanocytic_Nevi"], batch_size=4, flush_seconds=5)
+    for i, digest in enumerate(digests):
+        assert log.record(digest, np.array([0.9, 0.1]) if i < 3 else np.array([0.2, 0.8]), timestamp=1000 + i)
+    log.close()
+    assert log.stats()["written"] == 10 and log.stats()["batches"] == 3, "Records should be written in batches"
+    assert not log.record(digests[0], np.array([0.5, 0.5])), "A closed log should not accept records"
+
+    # A later model revision, with another order of the labels
+    log = AuditLog(path, "model@2", ["melanocytic_Nevi", "melanoma"])
+    log.record(digests[0], np.array([0.3, 0.7]), timestamp=2000)
+    log.flush()
+    log.close()
+
+    # The same revision with another backend and TTA is another model of the log
+    log = AuditLog(path, "model@2", ["melanocytic_Nevi", "melanoma"], backend="int8", tta=True)
+    log.record(digests[1], np.array([0.6, 0.4]), timestamp=3000)
+    log.close()
+
+    query_audit.main([path, "--label", "melanoma", "--until", "1970-01-01T00:30:00"])
+    output = capsys.readouterr().out
+    assert "model@1 (eager): 3 predictions" in output and "model@2" not in output
+
+    query_audit.main([path, "--model", "model@2"])
+    output = capsys.readouterr().out
+    assert "model@2 (eager): 1 predictions" in output and "model@2 (int8, TTA): 1 predictions" in output
+
+    connection = sqlite3.connect(path)
+    models = query_audit.load_models(connection)
+    where, params = query_audit.build_filter(models, image=digests[0][:10])
+    summary = query_audit.summarize(connection, models, where, params)
+    assert summary["model@1 (eager)"]["count"] == 1
+    assert summary["model@2 (eager)"]["predicted"] == {"melanocytic_Nevi": 0, "melanoma": 1}
+    assert abs(summary["model@2 (eager)"]["mean_probability"]["melanoma"] - 0.7) < 1e-3, "Probabilities are stored as float16"
+
+    assert query_audit.export_csv(connection, models, str(tmp_path / "audit.csv")) == 12
+    with open(tmp_path / "audit.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert rows[-2]["model"] == "model@2" and rows[-2]["predicted"] == "melanoma" and rows[-2]["image_sha256"] == digests[0]
+    assert rows[-1]["backend"] == "int8" and rows[-1]["tta"] == "1" and rows[-1]["predicted"] == "melanocytic_Nevi"
+
+    with pytest.raises(SystemExit):
+        query_audit.main([path, "--image", "not-hex"])
+    assert "is not a SHA-256 digest" in capsys.readouterr().err, "Malformed digests should be reported"
+
+    # A timestamp of 0 is kept, not replaced with the current time
+    log = AuditLog(str(tmp_path / "epoch.db"), "model@1", ["melanoma", "melanocytic_Nevi"])
+    log.record(digests[0], np.array([0.9, 0.1]), timestamp=0)
+    log.close()
+    assert sqlite3.connect(str(tmp_path / "epoch.db")).execute("SELECT timestamp FROM predictions").fetchall() == [(0.0,)]
+
+@pytest.fixture
+def image_server():
+    """
+    Local stand-in for image hosts, serves a PNG with an ETag and some misbehaving responses.
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32), color='red').save(buffer, format='PNG')
+    png = buffer.getvalue()
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            if self.path == "/image.png":
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_body(png, "image/png", {"ETag": '"v1"'})
+            elif self.path == "/fresh.png":
+                self.send_body(png, "image/png", {"Cache-Control": "max-age=3600"})
+            elif self.path == "/page.html":
+                self.send_body(b"<html></html>", "text/html")
+            elif self.path == "/fake.png":
+                self.send_body(b"not really a png", "image/png")
+            elif self.path == "/huge.png":
+                # No Content-Length, so the size is only known while streaming
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.end_headers()
+                self.wfile.write(png[:16] + bytes(2 * 2**20))
+            elif self.path == "/slow.png":
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.end_headers()
+                for byte in png[:20]:
+                    self.wfile.write(bytes([byte]))
+                    self.wfile.flush()
+                    time.sleep(0.1)
+
+        def send_body(self, body, content_type, headers={}):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", png, requests_seen
+    server.shutdown()
+
+def test_fetch_image_http_cache(image_server, tmp_path):
+    base_url, png, requests_seen = image_server
+
+    assert fetch_image_bytes(f"{base_url}/image.png", cache_dir=str(tmp_path)) == png, "Image should be downloaded"
+    assert fetch_image_bytes(f"{base_url}/image.png", cache_dir=str(tmp_path)) == png, "Revalidated image should come from the cache"
+    assert requests_seen.count("/image.png") == 2, "Image with an ETag should be revalidated"
+
+    for _ in range(2):
+        assert fetch_image_bytes(f"{base_url}/fresh.png", cache_dir=str(tmp_path)) == png
+    assert requests_seen.count("/fresh.png") == 1, "Fresh cached image should not be requested again"
+
+@pytest.mark.parametrize("path, kwargs, message", [
+    ("/page.html", {}, "Content-Type"),
+    ("/fake.png", {}, "JPEG, PNG or WebP"),
+    ("/huge.png", {"max_bytes": 2**20}, "larger"),
+    ("/slow.png", {"total_timeout": 0.5}, "longer"),
+])
+def test_fetch_image_rejects_bad_responses(image_server, path, kwargs, message):
+    base_url, _, _ = image_server
+
+    start = time.perf_counter()
+    with pytest.raises(ImageFetchError, match=message):
+        fetch_image_bytes(f"{base_url}{path}", **kwargs)
+    assert time.perf_counter() - start < 1.5, "Bad responses should be rejected early"
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_stored_image_guards_and_downscales():
+    # A PNG of one color is tiny on disk but needs width * height * 3 bytes when decoded as RGB
+    bomb = encode_png(Image.new('1', (9000, 9000)))
+    with pytest.raises(ImageTooLargeError):
+        StoredImage(bomb, max_pixels=64_000_000)
+
+    noise = Image.fromarray(np.random.default_rng(0).integers(0, 256, (600, 800, 3), dtype=np.uint8))
+    data = encode_png(noise)
+    stored = StoredImage(data, max_stored_bytes=100_000, max_stored_side=400)
+    assert stored.format == "JPEG" and stored.size == (400, 300), "Large files should be stored as a downscaled JPEG"
+    assert stored.open().size == (400, 300), "Stored image should decode on demand"
+    assert stored.original_digest == hashlib.sha256(data).hexdigest(), "The submitted file should keep its digest"
+    assert stored.digest == hashlib.sha256(stored.data).hexdigest() != stored.original_digest
+
+    small = StoredImage(encode_png(Image.new('RGB', (64, 64))))
+    assert small.digest == small.original_digest, "A file stored as submitted should have one digest"
+
+def test_image_store_evicts_idle_sessions():
+    image = StoredImage(encode_png(Image.new('RGB', (64, 64), color='red')))
+    store = ImageStore(budget_bytes=int(image.nbytes * 2.5))
+
+    store.put("a", [image])
+    store.put("b", [image])
+    store.get("a")  # "b" is now the least recently used session
+    store.put("c", [image])
+
+    assert store.get("b") is None, "Least recently used session should be evicted"
+    assert store.get("a") is not None and store.get("c") is not None, "Recent sessions should be kept"
+    assert store.session_bytes("a") == image.nbytes
+    assert store.stats() == {"sessions": 2, "images": 2, "bytes": 2 * image.nbytes,
+                             "budget_bytes": store.budget_bytes, "evictions": 1}
+
+def test_worker_pool_matches_eager(model_and_processor):
+    processor, model = model_and_processor
+    pixel_values = FastPreprocessor.from_processor(processor)([Image.new('RGB', (100, 100), color=c) for c in ('red', 'blue', 'green')])
+    expected = EagerBackend(model)(pixel_values)
+
+    pool = WorkerPool(2, threads_per_worker=1, pin_cores=True, max_batch_size=4)
+    try:
+        futures = [pool.submit(pixel_values[i:i + 1]) for i in range(3)] + [pool.submit(pixel_values)]
+        cancelled = pool.submit(pixel_values)
+        assert cancelled.cancel(), "A queued request should be cancellable"
+        results = [future.result(timeout=60) for future in futures]
+        assert pool.stats()["pending"] == 0, "A cancelled request should not stay pending"
+
+        # A worker which dies is replaced and the pool keeps serving
+        pool.processes[0].kill()
+        pool.processes[0].join()
+        deadline = time.monotonic() + 120
+        while pool.stats()["restarts"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert pool.stats()["restarts"] == 1, "The dead worker should be restarted"
+        assert torch.allclose(pool.predict(pixel_values), expected, atol=1e-5)
+
+        # A worker which cannot load the model is not restarted forever, the pool fails
+        pool.max_restarts = 0
+        pool._model_name = "no-such-model"
+        pool.processes[1].kill()
+        pool.processes[1].join()
+        deadline = time.monotonic() + 120
+        while not pool.stats()["failed"] and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert pool.stats()["failed"], "The pool should fail when a worker dies before it is ready"
+        with pytest.raises(RuntimeError, match="failed"):
+            pool.submit(pixel_values)
+    finally:
+        pool.close()
+
+    assert all(not process.is_alive() for process in pool.processes), "Workers should stop when the pool is closed"
+    assert torch.allclose(torch.cat(results[:3]), expected, atol=1e-5), "Workers should return the logits of each request"
+    assert torch.allclose(results[3], expected, atol=1e-5), "Multi-image requests should keep their order"
+
+def test_lesion_index_recall(tmp_path):
+    # Clustered synthetic embeddings, the IVF search should find the same neighbours as a full scan
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(50, 64))
+    vectors = centers[rng.integers(0, 50, 20000)] + 0.3 * rng.normal(size=(20000, 64))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    labels = ["melanoma" if i % 2 else "dermatofibroma" for i in range(len(vectors))]
+    build_lesion_index(str(tmp_path), vectors, labels, [f"{i}.jpg" for i in range(len(vectors))], dtype="int8")
+
+    index = LesionIndex(str(tmp_path), nprobe=8)
+    assert isinstance(index.embeddings, np.memmap), "Embeddings should be memory-mapped"
+    assert index.embeddings.dtype == np.int8 and len(index) == 20000
+
+    hits = 0
+    for query in vectors[:50]:
+        expected = set(np.argsort(-(vectors @ query))[:5])
+        results = index.search(query, k=5)
+        hits += len(expected & {int(result["path"][:-4]) for result in results})
+    assert hits / 250 >= 0.9, "IVF search should find most of the exact nearest neighbours"
+
+    best = index.search(vectors[1], k=1)[0]
+    assert best["path"] == "1.jpg" and best["label"] == "melanoma" and best["similarity"] > 0.99
+
+def test_build_index_tool(model_and_processor, tmp_path):
+    processor, model = model_and_processor
+    rng = np.random.default_rng(0)
+    for label in ("melanoma", "dermatofibroma"):
+        os.makedirs(tmp_path / "reference" / label)
+        for i in range(3):
+            Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(tmp_path / "reference" / label / f"{i}.png")
+
+    build_index.main([str(tmp_path / "reference"), "--output", str(tmp_path / "index"), "--workers", "0"])
+
+    index = LesionIndex(str(tmp_path / "index"))
+    pixel_values = FastPreprocessor.from_processor(processor)(Image.open(tmp_path / "reference" / "melanoma" / "1.png"))
+    query = Embedder(model)(pixel_values)[0]
+    best = index.search(query, k=1)[0]
+    assert best["path"].endswith("melanoma/1.png") and best["similarity"] > 0.99, "The image itself should be the most similar"
+
+    # The app computes the embeddings through a micro-batcher
+    embedder = MicroBatcher(Embedder(model))
+    np.testing.assert_allclose(embedder.predict(pixel_values)[0], query, atol=1e-5)
+    embedder.close()
+    assert not list((tmp_path / "index").glob("*.tmp.npy")), "Temporary embeddings should be removed"
+
+def test_evaluation_metrics():
+    labels = ["melanoma", "melanocytic_Nevi", "dermatofibroma"]
+    probs = np.array([[0.85, 0.1, 0.05], [0.65, 0.3, 0.05], [0.15, 0.75, 0.1], [0.3, 0.25, 0.45]])
+    y_true = np.array([0, 1, 1, 2])
+
+    metrics = evaluate.compute_metrics(np.log(probs), y_true, labels, top_k=(1, 2), bins=10)
+
+    assert metrics["confusion_matrix"] == [[1, 0, 0], [1, 1, 0], [0, 0, 1]]
+    assert metrics["recall"] == {"melanoma": 1.0, "melanocytic_Nevi": 0.5, "dermatofibroma": 1.0}
+    assert metrics["top_k_accuracy"] == {"1": 0.75, "2": 1.0}
+    # One image per bin: 0.85 (correct), 0.65 (wrong), 0.75 (correct), 0.45 (correct)
+    assert abs(metrics["expected_calibration_error"] - (0.15 + 0.65 + 0.25 + 0.55) / 4) < 1e-9
+    assert metrics["malignancy"]["sensitivity"] == 1.0 and metrics["malignancy"]["specificity"] == 2 / 3
+
+def test_evaluate_reuses_cached_logits(model_and_processor, tmp_path, monkeypatch, capsys):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "images")
+    with open(tmp_path / "metadata.csv", "w") as f:
+        f.write("lesion_id,image_id,dx\n")
+        for i, dx in enumerate(["mel", "nv", "bkl", "unknown"]):
+            Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(tmp_path / "images" / f"ISIC_{i}.jpg")
+            f.write(f"HAM_{i},ISIC_{i},{dx}\n")
+
+    cache = str(tmp_path / "logits.npz")
+    args = [str(tmp_path / "metadata.csv"), "--image-dir", str(tmp_path / "images"), "--cache", cache, "--workers", "0"]
+    evaluate.main(args + ["--output", str(tmp_path / "first.json")])
+
+    # The second run must not run the model
+    compute_logits = evaluate.compute_logits
+    monkeypatch.setattr(evaluate, "compute_logits", lambda *args, **kwargs: pytest.fail("Logits should come from the cache"))
+    evaluate.main(args + ["--output", str(tmp_path / "second.json"), "--malignancy-threshold", "0.1"])
+
+    with open(tmp_path / "first.json") as f:
+        first = json.load(f)
+    with open(tmp_path / "second.json") as f:
+        second = json.load(f)
+    assert first["images"] == 3, "Images with an unknown diagnosis should be skipped"
+    assert first["confusion_matrix"] == second["confusion_matrix"], "Cached logits should give the same results"
+    assert second["malignancy"]["threshold"] == 0.1
+
+    # Logits of another backend are computed again
+    computed = []
+    monkeypatch.setattr(evaluate, "compute_logits", lambda paths, *args: computed.append(paths) or compute_logits(paths, *args))
+    evaluate.main(args + ["--backend", "int8"])
+    assert len(computed) == 1 and len(computed[0]) == 3, "Cached logits of the eager backend should not be used"
+
 # You might want to add more tests here for other functions in your app
 
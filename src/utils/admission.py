@@ -0,0 +1,182 @@
+"""
+Admission control of the inference requests.
+
+At most `max_concurrency` requests use the model at once, the others wait in a
+FIFO queue of at most `max_queue` requests. A request arriving at a full queue
+is rejected at once, and a queued request gives up at its deadline, so under
+overload users get a quick "busy" answer instead of all requests slowing down
+together until they time out.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class ServerBusy(Exception):
+    """
+    Raised when a request is not admitted: the queue is full or the deadline passed while waiting.
+
+    Attributes:
+      position (int): Position of the request in the queue (1 is the next to be served).
+      queued (int): Number of requests waiting when it was rejected.
+    """
+
+    def __init__(self, message: str, position: int, queued: int):
+        super().__init__(message)
+        self.position = position
+        self.queued = queued
+
+
+class Ticket:
+    """
+    An admitted request, returned by AdmissionController.admit().
+
+    Attributes:
+      waited (float): Seconds spent in the queue.
+      deadline (float | None): time.monotonic() by which the request should be done.
+    """
+
+    def __init__(self, waited: float, deadline: Optional[float]):
+        self.waited = waited
+        self.deadline = deadline
+
+    def remaining(self) -> Optional[float]:
+        """
+        Returns the seconds left until the deadline (at least 0), or None without a deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class AdmissionController:
+    """
+    Bounded admission of requests with a concurrency limit, a queue and deadlines.
+
+    Usage:
+      with controller.admit(on_wait=lambda position: ...) as ticket:
+        logits = batcher.submit(pixel_values).result(timeout=ticket.remaining())
+
+    Args:
+      max_concurrency (int): Number of requests admitted at once.
+      max_queue (int): Number of requests which may wait, requests beyond it are rejected immediately.
+      timeout_seconds (float | None): Default deadline of a request, from its arrival; None waits forever.
+    """
+
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16, timeout_seconds: Optional[float] = 30.0):
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout_seconds = timeout_seconds
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+        self._waiting = deque()
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def admit(self, timeout: Optional[float] = None, on_wait: Optional[Callable[[int], None]] = None,
+              poll_seconds: float = 0.5) -> "_Admission":
+        """
+        Returns a context manager which waits for a free slot and releases it on exit.
+
+        Args:
+          timeout (float | None): Deadline of the request in seconds, `timeout_seconds` if not set.
+          on_wait (Callable | None): Called in the waiting thread with the position in the queue
+            whenever it changes, e.g. to show it to the user.
+          poll_seconds (float): Longest wait between two calls of `on_wait`.
+
+        Raises:
+          ServerBusy: On entering, when the queue is full or the deadline passes while waiting.
+        """
+        return _Admission(self, self.timeout_seconds if timeout is None else timeout, on_wait, poll_seconds)
+
+    def _acquire(self, timeout: Optional[float], on_wait: Optional[Callable[[int], None]], poll_seconds: float) -> Ticket:
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        with self._condition:
+            # Requests only skip the queue when nobody is waiting, so the order stays first come, first served
+            if not self._waiting and self.active < self.max_concurrency:
+                return self._admit(start, deadline)
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                raise ServerBusy(f"The server is busy, {len(self._waiting)} requests are waiting",
+                                 position=len(self._waiting) + 1, queued=len(self._waiting))
+
+            ticket_id = next(self._ids)
+            self._waiting.append(ticket_id)
+            position = None
+            try:
+                while not (self._waiting[0] == ticket_id and self.active < self.max_concurrency):
+                    current = self._waiting.index(ticket_id) + 1
+                    if on_wait is not None and current != position:
+                        # Runs with the lock released, the callback may be slow (e.g. a UI update)
+                        self._condition.release()
+                        try:
+                            on_wait(current)
+                        finally:
+                            self._condition.acquire()
+                        position = current
+                        continue
+
+                    wait = poll_seconds if deadline is None else min(poll_seconds, deadline - time.monotonic())
+                    if wait <= 0:
+                        self.timed_out += 1
+                        raise ServerBusy(f"The server is busy, the request waited {time.monotonic() - start:.1f} seconds",
+                                         position=current, queued=len(self._waiting))
+                    self._condition.wait(wait)
+            finally:
+                self._waiting.remove(ticket_id)
+                # The next request in the queue may now be at the front
+                self._condition.notify_all()
+            return self._admit(start, deadline)
+
+    def _admit(self, start: float, deadline: Optional[float]) -> Ticket:
+        # Called with the lock held
+        waited = time.monotonic() - start
+        self.active += 1
+        self.admitted += 1
+        self.wait_seconds += waited
+        return Ticket(waited, deadline)
+
+    def _release(self) -> None:
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "active": self.active,
+                "queued": len(self._waiting),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+class _Admission:
+    def __init__(self, controller: AdmissionController, timeout: Optional[float],
+                 on_wait: Optional[Callable[[int], None]], poll_seconds: float):
+        self._controller = controller
+        self._timeout = timeout
+        self._on_wait = on_wait
+        self._poll_seconds = poll_seconds
+
+    def __enter__(self) -> Ticket:
+        return self._controller._acquire(self._timeout, self._on_wait, self._poll_seconds)
+
+    def __exit__(self, *exc):
+        self._controller._release()
+        return False
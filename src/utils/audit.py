@@ -0,0 +1,211 @@
+"""
+Append-only audit log of the predictions.
+
+Every prediction shown to a user is recorded with the SHA-256 of the image,
+the time, the full probability vector (float16), the predicted class and the
+model which made it: its revision, the inference backend and whether
+test-time augmentation was enabled. The request thread only puts the record
+into a bounded in-memory queue; a background thread writes the queued records
+in batches, one SQLite transaction per batch, to a database in WAL mode.
+
+Tables:
+  models(id, revision, backend, tta, labels)   labels is the JSON list of class labels
+  predictions(id, timestamp, image_sha256, model_id, predicted_class, probabilities)
+    image_sha256 is the 32-byte digest, probabilities the little-endian float16
+    vector in the order of the model labels
+
+See query_audit.py for reading the log.
+"""
+import atexit
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+PROBABILITY_DTYPE = np.dtype("<f2")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    id INTEGER PRIMARY KEY,
+    revision TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    tta INTEGER NOT NULL,
+    labels TEXT NOT NULL,
+    UNIQUE (revision, backend, tta, labels)
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    image_sha256 BLOB NOT NULL,
+    model_id INTEGER NOT NULL REFERENCES models (id),
+    predicted_class INTEGER NOT NULL,
+    probabilities BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS predictions_timestamp ON predictions (timestamp);
+CREATE INDEX IF NOT EXISTS predictions_image ON predictions (image_sha256);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Opens an audit database, creating its tables if needed.
+    """
+    connection = sqlite3.connect(path)
+    # Readers (query_audit.py) do not block the writer and commits do not wait for fsync
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class AuditLog:
+    """
+    Asynchronous, batched writer of the audit log.
+
+    record() does not touch the disk: the record is put into a queue of at most
+    `max_buffer` records, waiting at most `block_seconds` when the queue is full
+    (the record is then dropped and counted in `dropped`). The writer thread
+    takes up to `batch_size` records, or what arrived within `flush_seconds`,
+    into one transaction. The queued records are written when the process exits.
+
+    Args:
+      path (str): SQLite database file.
+      model (str): Revision of the model making the predictions, see model_revision().
+      labels (List[str]): Labels of the classes, in the order of the probabilities.
+      backend (str): Inference backend, see load_backend().
+      tta (bool): Whether uncertain predictions are refined by test-time augmentation.
+      max_buffer (int): Maximum number of records waiting to be written.
+      batch_size (int): Maximum number of records written in one transaction.
+      flush_seconds (float): Maximum time a record waits for its batch to fill.
+      block_seconds (float): Maximum time record() waits when the buffer is full.
+    """
+
+    def __init__(self, path: str, model: str, labels: List[str], backend: str = "eager", tta: bool = False,
+                 max_buffer: int = 10000, batch_size: int = 1024, flush_seconds: float = 1.0, block_seconds: float = 0.1):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.block_seconds = block_seconds
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = queue.Queue(max_buffer)
+        self._closed = False
+        self._lock = threading.Lock()
+
+        # The schema is created here, so a database which cannot be opened fails at startup
+        connection = connect(path)
+        with connection:
+            labels_json = json.dumps(list(labels))
+            row = (model, backend, int(tta), labels_json)
+            connection.execute("INSERT OR IGNORE INTO models (revision, backend, tta, labels) VALUES (?, ?, ?, ?)", row)
+            self.model_id = connection.execute(
+                "SELECT id FROM models WHERE revision = ? AND backend = ? AND tta = ? AND labels = ?", row).fetchone()[0]
+        connection.close()
+
+        self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, image_sha256: str, probabilities: np.ndarray, timestamp: Optional[float] = None) -> bool:
+        """
+        Queues the record of one prediction.
+
+        Args:
+          image_sha256 (str): Hex SHA-256 of the image file.
+          probabilities (np.ndarray): Probabilities of the classes.
+          timestamp (float | None): Unix time of the prediction, now if not set.
+
+        Returns:
+          bool: False if the record was dropped because the buffer is full or the log is closed.
+        """
+        if not self._closed:
+            try:
+                self._queue.put((time.time() if timestamp is None else timestamp, image_sha256, probabilities), timeout=self.block_seconds)
+                return True
+            except queue.Full:
+                pass
+        with self._lock:
+            self.dropped += 1
+        return False
+
+    def flush(self) -> None:
+        """
+        Waits until the queued records are written.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Writes the queued records and stops the writer thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+            "queued": self._queue.qsize(),
+        }
+
+    def _run(self) -> None:
+        connection = connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                self._queue.task_done()
+                break
+
+            # Wait a little for more records, one transaction per batch
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+
+            try:
+                self._write(connection, batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"Audit log: {len(batch)} records could not be written: {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        connection.close()
+
+    def _write(self, connection: sqlite3.Connection, batch: list) -> None:
+        # The whole batch is converted at once
+        probabilities = np.stack([np.asarray(p, dtype=np.float32).reshape(-1) for _, _, p in batch])
+        predicted = probabilities.argmax(axis=1)
+        blobs = probabilities.astype(PROBABILITY_DTYPE)
+        rows = [
+            (timestamp, bytes.fromhex(digest), self.model_id, int(predicted[i]), blobs[i].tobytes())
+            for i, (timestamp, digest, _) in enumerate(batch)
+        ]
+        with connection:
+            connection.executemany(
+                "INSERT INTO predictions (timestamp, image_sha256, model_id, predicted_class, probabilities) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+        self.written += len(batch)
+        self.batches += 1
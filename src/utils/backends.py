@@ -0,0 +1,150 @@
+import copy
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+
+BACKENDS = ("eager", "int8", "onnx")
+DEFAULT_ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "skin-cancer-detection", "onnx")
+
+
+class EagerBackend:
+    """
+    Runs the PyTorch model in fp32 under torch.inference_mode().
+
+    Args:
+      model: The classification model.
+    """
+    name = "eager"
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.model(pixel_values=pixel_values).logits
+
+
+class QuantizedBackend(EagerBackend):
+    """
+    Runs the model with dynamically int8-quantized linear layers.
+
+    Args:
+      model: The classification model.
+      inplace (bool): Quantize the given model instead of a copy (saves memory).
+    """
+    name = "int8"
+
+    def __init__(self, model, inplace: bool = False):
+        if not inplace:
+            model = copy.deepcopy(model)
+        quantized = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        super().__init__(quantized)
+
+
+class OnnxBackend:
+    """
+    Runs the model exported to ONNX with onnxruntime. The exported graph is
+    cached on disk, so the export is done only once per model revision and weights.
+
+    Args:
+      model: The classification model.
+      cache_dir (str | None): Directory for exported graphs.
+    """
+    name = "onnx"
+
+    def __init__(self, model, cache_dir: Optional[str] = None):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx backend requires onnxruntime, install it with: pip install onnx onnxruntime") from e
+
+        cache_dir = cache_dir or os.environ.get("ONNX_CACHE_DIR", DEFAULT_ONNX_CACHE_DIR)
+        self.path = export_onnx(model, cache_dir)
+        self.session = onnxruntime.InferenceSession(self.path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pixel_values = np.ascontiguousarray(pixel_values.numpy(), dtype=np.float32)
+        (logits,) = self.session.run(["logits"], {"pixel_values": pixel_values})
+        return torch.from_numpy(logits)
+
+
+def onnx_export_key(model) -> str:
+    """
+    Returns the key of the exported graph of a model in the cache: the model
+    revision (see model_revision()), the size and modification time of the
+    weights of a local model directory (e.g. a rebuilt bundle) and the torch version.
+    """
+    from utils.model import WEIGHTS_FILE, model_revision
+
+    weights = ""
+    try:
+        stat = os.stat(os.path.join(model.name_or_path, WEIGHTS_FILE))
+        weights = f"{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        pass
+    revision = model_revision(model.name_or_path, model)
+    return hashlib.sha256(f"{revision}:{weights}:{torch.__version__}".encode()).hexdigest()[:16]
+
+
+def export_onnx(model, cache_dir: str) -> str:
+    """
+    Exports the model to ONNX unless an export of the same model is cached, see onnx_export_key().
+
+    Args:
+      model: The classification model.
+      cache_dir (str): Directory for exported graphs.
+
+    Returns:
+      str: Path of the exported graph.
+    """
+    key = onnx_export_key(model)
+    path = os.path.join(cache_dir, f"model-{key}.onnx")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    image_size = model.config.image_size
+    dummy = torch.zeros(1, model.config.num_channels, image_size, image_size)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with torch.inference_mode():
+        torch.onnx.export(
+            model.eval(), (dummy,), tmp_path,
+            input_names=["pixel_values"], output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17, dynamo=False,
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def backend_name(name: Optional[str] = None) -> str:
+    """
+    Returns the name of the backend load_backend() creates: `name`, else the
+    INFERENCE_BACKEND environment variable, else "eager".
+    """
+    return name or os.environ.get("INFERENCE_BACKEND", "eager")
+
+
+def load_backend(model, name: Optional[str] = None, inplace: bool = False):
+    """
+    Creates the inference backend selected by name or by the INFERENCE_BACKEND
+    environment variable (default "eager"). Every backend is a callable mapping
+    pixel values (N, C, H, W) to logits (N, K). The int8 backend quantizes a
+    copy of the model, so the fp32 model stays usable (e.g. for embeddings).
+
+    Args:
+      model: The classification model.
+      name (str | None): One of "eager", "int8" or "onnx".
+      inplace (bool): Let the int8 backend quantize the given model itself, when nothing else uses it.
+    """
+    name = backend_name(name)
+    if name == "eager":
+        return EagerBackend(model)
+    if name == "int8":
+        return QuantizedBackend(model, inplace=inplace)
+    if name == "onnx":
+        return OnnxBackend(model)
+    raise ValueError(f"Invalid inference backend: {name}, expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+
+def result_or_cancel(future: Future, timeout: Optional[float] = None):
+    """
+    Waits for the result of a request submitted to MicroBatcher or WorkerPool.
+    A request which is not done within `timeout` seconds is cancelled, so it does
+    not use the model once nobody waits for it any more.
+
+    Raises:
+      concurrent.futures.TimeoutError: The result was not ready in time.
+    """
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+
+class MicroBatcher:
+    """
+    In-process inference service which coalesces requests from concurrent
+    sessions into batched forward passes.
+
+    Requests are put into an asyncio queue served by a background thread. A lone
+    request is dispatched immediately. Requests that arrive while a batch is
+    running are grouped into the next batch; if more than one is waiting, the
+    batcher lingers up to `max_wait_ms` to fill the batch up to `max_batch_size`.
+
+    Args:
+      forward (Callable): Function mapping pixel values (N, C, H, W) to logits (N, K).
+      max_batch_size (int): Maximum number of images in one forward pass.
+      max_wait_ms (float): Maximum time to wait for more requests once a batch is forming.
+    """
+
+    def __init__(self, forward: Callable[[torch.Tensor], torch.Tensor], max_batch_size: int = 8, max_wait_ms: float = 5.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.requests = 0
+        self._forward = forward
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="micro-batcher-forward")
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._ready.set()
+        self._loop.run_until_complete(self._serve())
+        self._loop.close()
+
+    def submit(self, pixel_values: torch.Tensor) -> Future:
+        """
+        Queues images for inference.
+
+        Args:
+          pixel_values (torch.Tensor): Preprocessed images with shape (N, C, H, W).
+
+        Returns:
+          Future: Resolves to the logits of the submitted images.
+        """
+        future = Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (pixel_values, future))
+        return future
+
+    def predict(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Blocking version of submit().
+        """
+        return self.submit(pixel_values).result()
+
+    def close(self) -> None:
+        """
+        Stops the service after the queued requests are served.
+        """
+        if self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+            self._thread.join()
+        self._executor.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            size = len(item[0])
+
+            # Take everything which queued up while the previous batch was running
+            while size < self.max_batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            # Other sessions are active, so wait a little to fill the batch
+            if len(batch) > 1 and not stopping:
+                deadline = loop.time() + self.max_wait_ms / 1000
+                while size < self.max_batch_size:
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    size += len(item[0])
+
+            await loop.run_in_executor(self._executor, self._run_batch, batch)
+
+    def _run_batch(self, batch: List[Tuple[torch.Tensor, Future]]) -> None:
+        batch = [(pixel_values, future) for pixel_values, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            logits = self._forward(torch.cat([pixel_values for pixel_values, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.requests += len(batch)
+        start = 0
+        for pixel_values, future in batch:
+            future.set_result(logits[start:start + len(pixel_values)])
+            start += len(pixel_values)
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+class PredictionCache:
+    """
+    Two tier cache of model logits keyed by image digest.
+
+    The first tier is a bounded in-process LRU with TTL eviction. The optional
+    second tier is a directory of .npy files shared by every session (and every
+    process pointing at the same directory). Its entries are kept in a
+    subdirectory per `namespace`, so processes running another model or backend
+    (e.g. during a deploy) never read each other's logits. After every write,
+    expired files are removed and, over `max_disk_entries`, the least recently
+    stored ones.
+
+    Args:
+      max_entries (int): Maximum number of entries kept in memory.
+      ttl_seconds (float): Entries older than this are treated as missing.
+      disk_dir (str | None): Directory for the on-disk tier, disabled if None.
+      namespace (str): What the logits depend on besides the image, e.g. the model revision and backend.
+      max_disk_entries (int): Maximum number of entries kept on disk.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600.0, disk_dir: Optional[str] = None,
+                 namespace: str = "", max_disk_entries: int = 4096):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        if disk_dir is not None and namespace:
+            disk_dir = os.path.join(disk_dir, hashlib.sha256(namespace.encode()).hexdigest()[:16])
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.npy")
+
+    def _read_disk(self, key: str) -> Optional[np.ndarray]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                return None
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, logits: np.ndarray) -> None:
+        if self.disk_dir is None:
+            return
+        # Write to a temporary file first, so other processes never read a partial file
+        tmp_path = f"{self._disk_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, logits)
+            os.replace(tmp_path, self._disk_path(key))
+            self._prune_disk()
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _prune_disk(self) -> None:
+        # Removes the expired entries and the least recently stored ones over the limit
+        files = [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".npy")]
+        now = time.time()
+        expired, kept = [], []
+        for entry in files:
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue  # Removed by another process meanwhile
+            (expired if now - mtime > self.ttl_seconds else kept).append((mtime, entry.path))
+        kept.sort()
+        for _, path in expired + kept[:max(0, len(kept) - self.max_disk_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _store(self, key: str, logits: np.ndarray) -> None:
+        # Caller must hold the lock
+        self._entries[key] = (time.monotonic(), logits)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Returns the cached logits for the key or None if they are not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, logits = entry
+                if time.monotonic() - created <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return logits
+                del self._entries[key]
+
+        logits = self._read_disk(key)
+        with self._lock:
+            if logits is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, logits)
+        return logits
+
+    def put(self, key: str, logits: np.ndarray) -> None:
+        """
+        Stores logits in the memory tier and, if enabled, in the disk tier.
+        """
+        logits = np.ascontiguousarray(logits, dtype=np.float32)
+        logits.setflags(write=False)
+        with self._lock:
+            self._store(key, logits)
+        self._write_disk(key, logits)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters and the current number of entries in memory.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,59 @@
+import json
+from functools import lru_cache
+from typing import Sequence, Tuple
+
+# Probabilities are rounded, so nearly equal results share a cached chart
+PROBABILITY_DECIMALS = 3
+
+
+def probability_chart_spec(labels: Sequence[str], probs: Sequence[float], column_color: str,
+                           background_color: str, grid_color: str) -> dict:
+    """
+    Builds a Vega-Lite spec of a horizontal bar chart of the probabilities. The
+    chart is drawn by the browser, so the server does not rasterize any image.
+    Specs are cached by the rounded probabilities and colors.
+
+    Args:
+      labels (Sequence[str]): Labels sorted from the most to the least probable, the first is drawn at the top.
+      probs (Sequence[float]): Probabilities of the labels.
+      column_color (str): Color of the bars.
+      background_color (str): Color of the background.
+      grid_color (str): Color of the grid, axes and texts.
+
+    Returns:
+      dict: The Vega-Lite spec, a new copy on every call.
+    """
+    rounded = tuple(round(float(prob), PROBABILITY_DECIMALS) for prob in probs)
+    return json.loads(_spec_json(tuple(labels), rounded, column_color, background_color, grid_color))
+
+
+@lru_cache(maxsize=1024)
+def _spec_json(labels: Tuple[str, ...], probs: Tuple[float, ...], column_color: str,
+               background_color: str, grid_color: str) -> str:
+    spec = {
+        "title": {"text": "Predicted Probabilities for Each Lesion Type", "color": grid_color},
+        "background": background_color,
+        "height": 40 * len(labels),
+        "data": {"values": [{"Lesion": label, "Probability": prob} for label, prob in zip(labels, probs)]},
+        "mark": {"type": "bar", "color": column_color},
+        "encoding": {
+            # sort=None keeps the order of the data, so the most probable label is at the top
+            "y": {"field": "Lesion", "type": "nominal", "sort": None, "title": None},
+            "x": {"field": "Probability", "type": "quantitative", "title": "Probability"},
+            "tooltip": [{"field": "Lesion"}, {"field": "Probability", "format": ".2%"}],
+        },
+        "config": {
+            "view": {"stroke": grid_color},
+            "axis": {
+                "labelColor": grid_color, "titleColor": grid_color, "domainColor": grid_color,
+                "tickColor": grid_color, "gridColor": grid_color, "gridDash": [4, 4], "gridWidth": 0.5,
+                "labelLimit": 300,
+            },
+            "axisY": {"grid": False},
+        },
+    }
+    return json.dumps(spec)
+
+
+def clear_cache() -> None:
+    _spec_json.cache_clear()
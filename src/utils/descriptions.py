@@ -38,6 +38,20 @@ lesion_names = {
     "dermatofibroma": "Dermatofibroma"
 }
 
+# Diagnosis codes of the HAM10000 dataset ("dx" column of its metadata) and the corresponding model labels
+ham10000_labels = {
+    "akiec": "actinic_keratoses",
+    "bcc": "basal_cell_carcinoma",
+    "bkl": "benign_keratosis-like_lesions",
+    "df": "dermatofibroma",
+    "mel": "melanoma",
+    "nv": "melanocytic_Nevi",
+    "vasc": "vascular_lesions",
+}
+
+# Malignant and premalignant lesion types (as grouped in the HAM10000 dataset), used to sort results by malignancy
+malignant_lesions = ("melanoma", "basal_cell_carcinoma", "actinic_keratoses")
+
 # 1. Benign Keratosis-like Lesions
 # Benign keratosis-like lesions encompass skin conditions such as seborrheic keratosis, lichen planus-like keratosis, and solar lentigo. These lesions are non-cancerous and appear as warty, rough, or pigmented growths on the skin. They are generally harmless but may resemble malignant growths, warranting careful clinical evaluation.
 # 2. Basal Cell Carcinoma
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "skin-cancer-detection", "http")
+DEFAULT_MAX_BYTES = 20 * 2**20
+DEFAULT_TIMEOUT = (3.05, 10.0)  # (connect, read) in seconds
+DEFAULT_TOTAL_TIMEOUT = 30.0
+
+# Content types which may still contain an image, the magic bytes decide
+GENERIC_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream", "")
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class ImageFetchError(Exception):
+    """
+    Raised when the URL does not point to an acceptable image.
+    """
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by all sessions of the app, so connections are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = "skin-cancer-detection"
+            _session = session
+        return _session
+
+
+def is_image_data(data: bytes) -> bool:
+    """
+    Checks the magic bytes of JPEG, PNG and WebP files.
+    """
+    return (data.startswith(b"\xff\xd8\xff")
+            or data.startswith(b"\x89PNG\r\n\x1a\n")
+            or (data[:4] == b"RIFF" and data[8:12] == b"WEBP"))
+
+
+def _cache_paths(cache_dir: str, url: str) -> Tuple[str, str]:
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json"), os.path.join(cache_dir, f"{key}.body")
+
+
+def _read_cache(cache_dir: Optional[str], url: str) -> Optional[Tuple[dict, bytes]]:
+    if cache_dir is None:
+        return None
+    meta_path, body_path = _cache_paths(cache_dir, url)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            body = f.read()
+    except (OSError, ValueError):
+        return None
+    return (meta, body) if meta.get("url") == url else None
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _write_cache(cache_dir: str, url: str, response: requests.Response, body: bytes, max_entries: int) -> None:
+    cache_control = response.headers.get("Cache-Control", "").lower()
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    if "no-store" in cache_control or not (etag or last_modified or max_age):
+        return
+
+    meta = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "stored_at": time.time(),
+        "max_age": 0 if "no-cache" in cache_control or max_age is None else int(max_age.group(1)),
+    }
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path, body_path = _cache_paths(cache_dir, url)
+        _write_atomic(body_path, body)
+        _write_atomic(meta_path, json.dumps(meta).encode())
+        _prune_cache(cache_dir, max_entries)
+    except OSError:
+        pass
+
+
+def _prune_cache(cache_dir: str, max_entries: int) -> None:
+    # Removes the least recently stored entries
+    meta_files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".json")]
+    if len(meta_files) <= max_entries:
+        return
+    meta_files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in meta_files[:len(meta_files) - max_entries]:
+        for path in (entry.path, entry.path[:-len(".json")] + ".body"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _iter_chunks(response: requests.Response, chunk_size: int = 64 * 1024):
+    # read1() returns whatever one socket read delivers, so a server sending a few
+    # bytes at a time cannot keep the caller from checking the deadline
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        yield from response.iter_content(chunk_size=8 * 1024)
+        return
+    while True:
+        chunk = read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+def fetch_image_bytes(url: str, max_bytes: int = DEFAULT_MAX_BYTES, timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                      total_timeout: float = DEFAULT_TOTAL_TIMEOUT, cache_dir: Optional[str] = None,
+                      max_cache_entries: int = 512, session: Optional[requests.Session] = None) -> bytes:
+    """
+    Downloads an image with a streaming request. The download is stopped as soon
+    as the response is known not to be an acceptable image: wrong Content-Type,
+    wrong magic bytes, too large, or too slow.
+
+    Responses are cached on disk if the server allows it. A fresh cached response
+    is returned without any request; a stale one is revalidated with its ETag or
+    Last-Modified date.
+
+    Args:
+      url (str): URL of the image (http or https).
+      max_bytes (int): Maximum size of the image.
+      timeout (Tuple[float, float]): Connect and read timeouts in seconds.
+      total_timeout (float): Maximum duration of the whole download in seconds.
+      cache_dir (str | None): Directory of the response cache, disabled if None.
+      max_cache_entries (int): Maximum number of cached responses.
+      session (requests.Session | None): Session to use, the shared one by default.
+
+    Returns:
+      bytes: The image file.
+
+    Raises:
+      ImageFetchError: If the response is not an acceptable image.
+      requests.exceptions.RequestException: If the request fails.
+    """
+    if not url.lower().startswith(("http://", "https://")):
+        raise ImageFetchError("The URL should start with http:// or https://")
+
+    headers = {}
+    cached = _read_cache(cache_dir, url)
+    if cached is not None:
+        meta, body = cached
+        if time.time() - meta["stored_at"] < meta["max_age"]:
+            return body
+        if meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    deadline = time.monotonic() + total_timeout
+    response = (session or get_session()).get(url, stream=True, timeout=timeout, headers=headers)
+    try:
+        if response.status_code == 304 and cached is not None:
+            meta, body = cached
+            meta["stored_at"] = time.time()
+            try:
+                _write_atomic(_cache_paths(cache_dir, url)[0], json.dumps(meta).encode())
+            except OSError:
+                pass
+            return body
+        response.raise_for_status()
+
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not content_type.startswith("image/") and content_type not in GENERIC_CONTENT_TYPES:
+            raise ImageFetchError(f"The URL does not point to an image (Content-Type: {content_type})")
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            raise ImageFetchError(f"The image is larger than {max_bytes // 2**20} MB")
+
+        body = bytearray()
+        checked = False
+        for chunk in _iter_chunks(response):
+            body += chunk
+            if not checked and len(body) >= 12:
+                if not is_image_data(bytes(body[:12])):
+                    raise ImageFetchError("The URL does not point to a JPEG, PNG or WebP image")
+                checked = True
+            if len(body) > max_bytes:
+                raise ImageFetchError(f"The image is larger than {max_bytes // 2**20} MB")
+            if time.monotonic() > deadline:
+                raise ImageFetchError(f"The download took longer than {total_timeout:g} seconds")
+        if not checked:
+            raise ImageFetchError("The URL does not point to a JPEG, PNG or WebP image")
+    finally:
+        response.close()
+
+    body = bytes(body)
+    if cache_dir is not None:
+        _write_cache(cache_dir, url, response, body, max_cache_entries)
+    return body
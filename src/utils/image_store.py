@@ -0,0 +1,163 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_MAX_PIXELS = 64_000_000
+DEFAULT_MAX_STORED_BYTES = 4 * 2**20
+DEFAULT_MAX_STORED_SIDE = 2048
+
+
+class ImageTooLargeError(ValueError):
+    """
+    Raised when the dimensions of an image exceed the allowed number of pixels.
+    """
+
+
+class StoredImage:
+    """
+    Image kept in its compressed form, it is decoded only when needed.
+
+    The dimensions are read from the header and checked against `max_pixels`
+    before anything is decoded, so decompression bombs are rejected cheaply.
+    Files larger than `max_stored_bytes` are replaced by a JPEG derivative whose
+    longer side is at most `max_stored_side` (still larger than what the model
+    and the page need).
+
+    `original_digest` is the SHA-256 of the file as submitted, which identifies
+    the image in the audit log; `digest` the one of the stored file, which keys
+    the predictions.
+
+    Args:
+      data (bytes): Encoded image file.
+      name (str): Name shown to the user (file name or URL).
+      max_pixels (int): Maximum width * height of the image.
+      max_stored_bytes (int): Larger files are stored as a downscaled JPEG.
+      max_stored_side (int): Longer side of the downscaled JPEG.
+    """
+
+    def __init__(self, data: bytes, name: str = "", max_pixels: int = DEFAULT_MAX_PIXELS,
+                 max_stored_bytes: int = DEFAULT_MAX_STORED_BYTES, max_stored_side: int = DEFAULT_MAX_STORED_SIDE):
+        original, original_digest = data, hashlib.sha256(data).hexdigest()
+        try:
+            image = Image.open(BytesIO(data))  # Parses only the header
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e)) from e
+        with image:
+            width, height = image.size
+            if width * height > max_pixels:
+                raise ImageTooLargeError(f"The image has {width}x{height} pixels, at most {max_pixels / 1e6:g} MP are allowed")
+            image_format = image.format
+
+            if len(data) > max_stored_bytes:
+                image.draft("RGB", (max_stored_side, max_stored_side))
+                image = image.convert("RGB")
+                image.thumbnail((max_stored_side, max_stored_side), Image.BILINEAR)
+                buffer = BytesIO()
+                image.save(buffer, format="JPEG", quality=90)
+                data, image_format = buffer.getvalue(), "JPEG"
+                width, height = image.size
+
+        self.data = data
+        self.name = name
+        self.size = (width, height)
+        self.format = image_format
+        self.original_digest = original_digest
+        self.digest = original_digest if data is original else hashlib.sha256(data).hexdigest()
+        self.logits: Optional[np.ndarray] = None  # Model output, set once predicted
+        self.embedding: Optional[np.ndarray] = None  # Set once searched for similar cases
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + sum(array.nbytes for array in (self.logits, self.embedding) if array is not None)
+
+    def open(self) -> Image.Image:
+        """
+        Returns a new lazily decoded PIL image (JPEG files can still use draft mode).
+        """
+        return Image.open(BytesIO(self.data))
+
+
+class ImageStore:
+    """
+    Images of all sessions, with one memory budget for the whole process.
+
+    Sessions are kept in least recently used order. When the stored images exceed
+    `budget_bytes`, the images of the sessions which were idle the longest are
+    evicted; the session being stored is never evicted by its own put(). Sessions
+    idle for more than `idle_seconds` are evicted too.
+
+    Args:
+      budget_bytes (int): Memory budget of all stored images.
+      idle_seconds (float): Images of sessions idle for longer are evicted.
+    """
+
+    def __init__(self, budget_bytes: int = 512 * 2**20, idle_seconds: float = 3600):
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()  # id -> (last access, images)
+        self._lock = threading.Lock()
+
+    def put(self, session_id: str, images: List[StoredImage]) -> None:
+        """
+        Replaces the images of a session, an empty list removes them.
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if images:
+                self._sessions[session_id] = (time.monotonic(), list(images))
+            self._evict(keep=session_id)
+
+    def get(self, session_id: str) -> Optional[List[StoredImage]]:
+        """
+        Returns the images of a session, or None if there are none (or they were evicted).
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (time.monotonic(), entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def _evict(self, keep: str) -> None:
+        now = time.monotonic()
+        total = self._total_bytes()
+        for session_id, (last_access, images) in list(self._sessions.items()):
+            if session_id == keep:
+                continue
+            if total <= self.budget_bytes and now - last_access <= self.idle_seconds:
+                break
+            del self._sessions[session_id]
+            total -= sum(image.nbytes for image in images)
+            self.evictions += 1
+
+    def _total_bytes(self) -> int:
+        return sum(image.nbytes for _, images in self._sessions.values() for image in images)
+
+    def session_bytes(self, session_id: str) -> int:
+        """
+        Returns the memory used by the images of a session.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return 0 if entry is None else sum(image.nbytes for image in entry[1])
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of sessions and images, the memory used and the number of evicted sessions.
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "images": sum(len(images) for _, images in self._sessions.values()),
+                "bytes": self._total_bytes(),
+                "budget_bytes": self.budget_bytes,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,141 @@
+import json
+import os
+import sys
+import time
+from typing import List, Optional
+
+import torch
+from PIL import Image
+from safetensors.torch import load_file
+from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification
+
+from utils.system import process_uptime
+
+MODEL_NAME = "Anwarkh1/Skin_Cancer-Image_Classification"
+BUNDLE_INFO_FILE = "bundle.json"
+WEIGHTS_FILE = "model.safetensors"
+
+# Cold start timings of this process, in seconds
+startup_metrics = {}
+
+
+def resolve_model_path(model_name: Optional[str] = None) -> str:
+    """
+    Returns the model to load: the given name, the local bundle in the MODEL_DIR
+    environment variable, or the Hugging Face model id.
+    """
+    return model_name or os.environ.get("MODEL_DIR") or MODEL_NAME
+
+
+def load_model_mmap(model_dir: str):
+    """
+    Loads the model from a local safetensors bundle. The weights are memory-mapped
+    instead of being copied, so loading is fast and processes loading the same
+    bundle share the pages. Falls back to a regular from_pretrained() if the
+    parameter names do not match (bundle built by another transformers version).
+
+    Args:
+      model_dir (str): Directory created by build_bundle.py.
+    """
+    config = AutoConfig.from_pretrained(model_dir, local_files_only=True)
+    with torch.device("meta"):
+        model = AutoModelForImageClassification.from_config(config)
+
+    try:
+        model.load_state_dict(load_file(os.path.join(model_dir, WEIGHTS_FILE)), strict=True, assign=True)
+    except RuntimeError:
+        return AutoModelForImageClassification.from_pretrained(model_dir, local_files_only=True).eval()
+
+    if any(tensor.is_meta for tensor in model.state_dict().values()):
+        return AutoModelForImageClassification.from_pretrained(model_dir, local_files_only=True).eval()
+    return model.eval()
+
+
+def load_processor_and_model(model_name: Optional[str] = None):
+    """
+    Loads the image processor and the classification model. Used by the
+    Streamlit app as well as by the command line tools.
+
+    Args:
+      model_name (str | None): Hugging Face model id or local directory, see resolve_model_path().
+
+    Returns:
+      tuple: The image processor and the model in evaluation mode.
+    """
+    start = time.perf_counter()
+    model_name = resolve_model_path(model_name)
+
+    if os.path.exists(os.path.join(model_name, WEIGHTS_FILE)):
+        processor = AutoImageProcessor.from_pretrained(model_name, local_files_only=True)
+        model = load_model_mmap(model_name)
+    else:
+        processor = AutoImageProcessor.from_pretrained(model_name)
+        model = AutoModelForImageClassification.from_pretrained(model_name)
+        model.eval()
+
+    startup_metrics["model_load_s"] = time.perf_counter() - start
+    return processor, model
+
+
+def model_revision(model_name: Optional[str] = None, model=None) -> str:
+    """
+    Returns the model id and revision, read from the bundle info if a bundle is used.
+    Given the loaded model, the revision of a model from the Hub is its commit.
+    """
+    model_name = resolve_model_path(model_name)
+    try:
+        with open(os.path.join(model_name, BUNDLE_INFO_FILE)) as f:
+            info = json.load(f)
+        return f"{info['model']}@{info['revision']}"
+    except (OSError, ValueError, KeyError):
+        commit = getattr(getattr(model, "config", None), "_commit_hash", None) or _hub_commit(model_name)
+        return f"{model_name}@{commit}" if commit else model_name
+
+
+def _hub_commit(model_name: str) -> Optional[str]:
+    # Commit of the snapshot in the Hugging Face cache, the one from_pretrained() loads
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        path = try_to_load_from_cache(model_name, "config.json")
+    except Exception:
+        return None
+    return os.path.basename(os.path.dirname(path)) if isinstance(path, str) else None
+
+
+def warm_up(backend, preprocessor, repeats: int = 2) -> None:
+    """
+    Runs synthetic predictions, so lazy initialization (kernel selection, memory
+    pools, first page faults of the weights) is not paid by the first user.
+
+    Args:
+      backend: Inference backend from utils.backends.
+      preprocessor (FastPreprocessor): The preprocessing stage.
+      repeats (int): Number of synthetic forward passes.
+    """
+    start = time.perf_counter()
+    pixel_values = preprocessor(Image.new("RGB", (64, 64)))
+    for _ in range(repeats):
+        backend(pixel_values)
+    startup_metrics["warm_up_s"] = time.perf_counter() - start
+
+
+def record_first_prediction() -> None:
+    """
+    Records the time from the process start to the first served prediction.
+    Only the first call has an effect.
+    """
+    if "time_to_first_prediction_s" not in startup_metrics:
+        startup_metrics["time_to_first_prediction_s"] = process_uptime()
+        print(f"Cold start: {json.dumps(startup_metrics)}", file=sys.stderr)
+
+
+def render_startup_metrics(prefix: str = "skin") -> List[str]:
+    """
+    Returns the cold start timings recorded so far as Prometheus gauges, e.g.
+    skin_startup_model_load_seconds. A collector for tracing.register_collector().
+    """
+    lines = []
+    for name, seconds in sorted(startup_metrics.items()):
+        metric = f"{prefix}_startup_{name[:-len('_s')]}_seconds"
+        lines += [f"# TYPE {metric} gauge", f"{metric} {seconds!r}"]
+    return lines
@@ -0,0 +1,116 @@
+import threading
+from typing import List, Sequence, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class FastPreprocessor:
+    """
+    Image preprocessing with the same parameters as the Hugging Face image
+    processor of the model, but without its generic per-call overhead.
+
+    JPEG images are downscaled already while decoding (draft mode), resized with
+    PIL and normalized by a single vectorized NumPy operation into a contiguous
+    batch buffer.
+
+    Args:
+      size (tuple): Target (height, width).
+      image_mean (Sequence[float]): Per channel mean used for normalization.
+      image_std (Sequence[float]): Per channel standard deviation used for normalization.
+      rescale_factor (float): Factor applied to the uint8 pixel values before normalization.
+      resample (int): PIL resampling filter.
+    """
+
+    def __init__(self, size=(224, 224), image_mean: Sequence[float] = (0.5, 0.5, 0.5),
+                 image_std: Sequence[float] = (0.5, 0.5, 0.5), rescale_factor: float = 1 / 255,
+                 resample: int = Image.BILINEAR):
+        self.size = tuple(size)
+        self.resample = resample
+
+        # (x * rescale - mean) / std folded into one multiply and one add
+        mean = np.asarray(image_mean, dtype=np.float32)
+        std = np.asarray(image_std, dtype=np.float32)
+        self._scale = (rescale_factor / std).reshape(1, 3, 1, 1).astype(np.float32)
+        self._offset = (-mean / std).reshape(1, 3, 1, 1).astype(np.float32)
+        self._local = threading.local()
+
+    @classmethod
+    def from_processor(cls, processor) -> "FastPreprocessor":
+        """
+        Creates the preprocessor from the configuration of a Hugging Face image processor.
+        """
+        size = processor.size
+        height, width = (size["height"], size["width"]) if "height" in size else (size["shortest_edge"],) * 2
+        do_rescale = getattr(processor, "do_rescale", True)
+        do_normalize = getattr(processor, "do_normalize", True)
+        return cls(
+            size=(height, width),
+            image_mean=processor.image_mean if do_normalize else (0.0, 0.0, 0.0),
+            image_std=processor.image_std if do_normalize else (1.0, 1.0, 1.0),
+            rescale_factor=processor.rescale_factor if do_rescale else 1.0,
+            resample=int(getattr(processor, "resample", Image.BILINEAR)),
+        )
+
+    def __getstate__(self):
+        # Buffers are per thread and are not sent to worker processes
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _buffer(self, count: int) -> np.ndarray:
+        # Reused uint8 buffer for the resized images, one per thread
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or len(buffer) < count:
+            height, width = self.size
+            buffer = np.empty((count, height, width, 3), dtype=np.uint8)
+            self._local.buffer = buffer
+        return buffer[:count]
+
+    def decode(self, image: Image.Image) -> Image.Image:
+        """
+        Decodes the image (if not done yet) into RGB pixels.
+        """
+        height, width = self.size
+        if image.format == "JPEG":
+            # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale; no-op if the image is already loaded
+            image.draft("RGB", (width, height))
+        if image.mode != "RGB":
+            return image.convert("RGB")
+        image.load()
+        return image
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        """
+        Decodes (if not done yet) and resizes the image to the model input size.
+        """
+        height, width = self.size
+        return self.decode(image).resize((width, height), self.resample)
+
+    def __call__(self, images: Union[Image.Image, List[Image.Image]]) -> torch.Tensor:
+        """
+        Preprocesses one image or a batch of images.
+
+        Args:
+          images (PIL.Image | List[PIL.Image]): Images to preprocess.
+
+        Returns:
+          torch.Tensor: Pixel values with shape (N, 3, height, width).
+        """
+        if isinstance(images, Image.Image):
+            images = [images]
+
+        buffer = self._buffer(len(images))
+        for i, image in enumerate(images):
+            buffer[i] = np.asarray(self.resize(image))
+
+        height, width = self.size
+        pixel_values = np.empty((len(images), 3, height, width), dtype=np.float32)
+        np.multiply(buffer.transpose(0, 3, 1, 2), self._scale, out=pixel_values)
+        np.add(pixel_values, self._offset, out=pixel_values)
+        return torch.from_numpy(pixel_values)
@@ -0,0 +1,41 @@
+from typing import Dict, List, Tuple
+
+import torch
+
+from utils.descriptions import malignant_lesions
+
+
+def sorted_probabilities(logits: torch.Tensor, id2label: Dict[int, str]) -> Tuple[List[str], List[float]]:
+    """
+    Converts the logits of one image into labels and probabilities sorted from
+    the most to the least probable.
+
+    Args:
+      logits (torch.Tensor): Logits with shape (1, number of classes).
+      id2label (Dict[int, str]): Mapping of class indices to labels.
+
+    Returns:
+      Tuple[List[str], List[float]]: Sorted labels and their probabilities.
+    """
+    # Apply softmax to logits to get probabilities
+    probs = torch.nn.functional.softmax(logits, dim=1)[0]
+
+    # Get the sorted indices based on probabilities (highest to lowest)
+    sorted_indices = torch.argsort(probs, descending=True).tolist()
+
+    labels_sorted = [id2label[idx] for idx in sorted_indices]
+    probs_sorted = probs[sorted_indices].tolist()
+    return labels_sorted, probs_sorted
+
+
+def malignancy_probability(logits: torch.Tensor, id2label: Dict[int, str]) -> float:
+    """
+    Returns the total probability of the malignant lesion types for one image.
+
+    Args:
+      logits (torch.Tensor): Logits with shape (1, number of classes).
+      id2label (Dict[int, str]): Mapping of class indices to labels.
+    """
+    probs = torch.nn.functional.softmax(logits, dim=1)[0]
+    indices = [idx for idx, label in id2label.items() if label in malignant_lesions]
+    return probs[indices].sum().item()
@@ -0,0 +1,219 @@
+"""
+Embeddings of lesion images and a nearest-neighbour index of labeled reference images.
+
+The index is a directory of NumPy files which are memory-mapped when loaded:
+the embeddings are quantized to int8 (or stored as float16) and grouped by an
+inverted file (IVF) of k-means clusters. A search compares the query with the
+cluster centroids and scans only the `nprobe` closest clusters, so search time
+and resident memory grow with the size of the probed clusters, not with the
+size of the reference set.
+"""
+import json
+import os
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+INDEX_INFO_FILE = "index.json"
+
+
+class Embedder:
+    """
+    Computes L2-normalized image embeddings with the classification model: the
+    [CLS] token of its last layer, i.e. the representation the classifier sees.
+
+    Args:
+      model: The classification model.
+    """
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        """
+        Returns the embeddings with shape (N, D) as float32.
+        """
+        with torch.inference_mode():
+            outputs = self.model.base_model(pixel_values=pixel_values)
+            pooled = getattr(outputs, "pooler_output", None)
+            embeddings = pooled if pooled is not None else outputs.last_hidden_state[:, 0]
+        return normalize(embeddings.float().numpy())
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _chunks(count: int, size: int) -> Iterator[slice]:
+    for start in range(0, count, size):
+        yield slice(start, min(start + size, count))
+
+
+def spherical_kmeans(vectors: np.ndarray, num_clusters: int, iterations: int = 20, seed: int = 0,
+                     chunk_size: int = 65536) -> np.ndarray:
+    """
+    Clusters normalized vectors by cosine similarity (Lloyd's algorithm with normalized centroids).
+
+    Args:
+      vectors (np.ndarray): Normalized vectors (N, D), may be a memory map.
+      num_clusters (int): Number of clusters.
+      iterations (int): Number of iterations.
+      seed (int): Seed of the initial centroids.
+      chunk_size (int): Vectors processed at once, bounds the memory used.
+
+    Returns:
+      np.ndarray: Normalized centroids (num_clusters, D) as float32.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = np.asarray(vectors[np.sort(rng.choice(len(vectors), num_clusters, replace=False))], dtype=np.float32)
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(num_clusters, dtype=np.int64)
+        for chunk in _chunks(len(vectors), chunk_size):
+            block = np.asarray(vectors[chunk], dtype=np.float32)
+            assignment = np.argmax(block @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            clusters, starts = np.unique(assignment[order], return_index=True)
+            sums[clusters] += np.add.reduceat(block[order], starts, axis=0)
+            counts += np.bincount(assignment, minlength=num_clusters)
+
+        # Empty clusters restart from a random vector
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums).astype(np.float32)
+
+    return centroids
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Returns the index of the most similar centroid of every vector.
+    """
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for chunk in _chunks(len(vectors), chunk_size):
+        assignment[chunk] = np.argmax(np.asarray(vectors[chunk], dtype=np.float32) @ centroids.T, axis=1)
+    return assignment
+
+
+def build_index(output: str, embeddings: np.ndarray, labels: List[str], paths: List[str], dtype: str = "int8",
+                num_clusters: Optional[int] = None, train_size: int = 100_000, chunk_size: int = 65536,
+                model: Optional[str] = None) -> None:
+    """
+    Writes an index of the reference embeddings.
+
+    Args:
+      output (str): Directory of the index.
+      embeddings (np.ndarray): Normalized embeddings (N, D), may be a memory map.
+      labels (List[str]): Label of every reference image.
+      paths (List[str]): Path of every reference image.
+      dtype (str): "int8" (per-vector scale) or "float16".
+      num_clusters (int | None): Number of IVF clusters, about sqrt(N) by default.
+      train_size (int): Number of vectors sampled to train the clusters.
+      chunk_size (int): Vectors processed at once, bounds the memory used.
+      model (str | None): Model which computed the embeddings, see model_revision().
+    """
+    if dtype not in ("int8", "float16"):
+        raise ValueError(f"Invalid index dtype: {dtype}, expected int8 or float16")
+    count, dim = embeddings.shape
+    num_clusters = min(num_clusters or max(1, int(np.sqrt(count))), count)
+
+    # Clusters are trained on a sample, then every vector is assigned
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(count, min(train_size, count), replace=False))
+    centroids = spherical_kmeans(np.asarray(embeddings[sample], dtype=np.float32), num_clusters)
+    assignment = assign_clusters(embeddings, centroids, chunk_size)
+
+    # Vectors of a cluster are stored contiguously, offsets[c]:offsets[c + 1] are the rows of cluster c
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.zeros(num_clusters + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=num_clusters), out=offsets[1:])
+
+    os.makedirs(output, exist_ok=True)
+    matrix = np.lib.format.open_memmap(os.path.join(output, "embeddings.npy"), mode="w+", dtype=dtype, shape=(count, dim))
+    scales = np.ones(count, dtype=np.float32)
+    for chunk in _chunks(count, chunk_size):
+        block = np.asarray(embeddings[order[chunk]], dtype=np.float32)
+        if dtype == "int8":
+            scales[chunk] = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127
+            matrix[chunk] = np.round(block / scales[chunk, None]).astype(np.int8)
+        else:
+            matrix[chunk] = block.astype(np.float16)
+    matrix.flush()
+    del matrix
+
+    label_names = sorted(set(labels))
+    label_ids = {label: i for i, label in enumerate(label_names)}
+    np.save(os.path.join(output, "scales.npy"), scales)
+    np.save(os.path.join(output, "centroids.npy"), centroids)
+    np.save(os.path.join(output, "offsets.npy"), offsets)
+    np.save(os.path.join(output, "labels.npy"), np.array([label_ids[labels[i]] for i in order], dtype=np.int16))
+    np.save(os.path.join(output, "paths.npy"), np.array([paths[i].encode() for i in order]))
+
+    with open(os.path.join(output, INDEX_INFO_FILE), "w") as f:
+        json.dump({"count": int(count), "dim": int(dim), "dtype": dtype, "clusters": int(num_clusters),
+                   "labels": label_names, "model": model}, f)
+
+
+class LesionIndex:
+    """
+    Memory-mapped nearest-neighbour index of reference lesions built by build_index().
+
+    Args:
+      index_dir (str): Directory of the index.
+      nprobe (int): Number of clusters scanned per search.
+    """
+
+    def __init__(self, index_dir: str, nprobe: int = 8):
+        with open(os.path.join(index_dir, INDEX_INFO_FILE)) as f:
+            self.info = json.load(f)
+        self.nprobe = nprobe
+        self.label_names = self.info["labels"]
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode="r")
+        self.embeddings = load("embeddings.npy")
+        self.scales = load("scales.npy")
+        self.labels = load("labels.npy")
+        self.paths = load("paths.npy")
+        # Small arrays used by every search are kept in memory
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def search(self, query: np.ndarray, k: int = 5, nprobe: Optional[int] = None) -> List[Dict]:
+        """
+        Finds the reference images most similar to a normalized embedding.
+
+        Args:
+          query (np.ndarray): Normalized embedding (D,).
+          k (int): Number of results.
+          nprobe (int | None): Number of clusters scanned, the value of the index by default.
+
+        Returns:
+          List[Dict]: Results with "path", "label" and cosine "similarity", most similar first.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        clusters = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        # Every cluster is a contiguous block of rows, read sequentially from the memory map
+        blocks = [(self.offsets[c], self.offsets[c + 1]) for c in np.sort(clusters) if self.offsets[c + 1] > self.offsets[c]]
+        if not blocks:
+            return []
+        rows = np.concatenate([np.arange(start, end) for start, end in blocks])
+        scores = np.concatenate([
+            (self.embeddings[start:end].astype(np.float32) @ query) * self.scales[start:end] for start, end in blocks
+        ])
+
+        k = min(k, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [{
+            "path": self.paths[rows[i]].decode(),
+            "label": self.label_names[self.labels[rows[i]]],
+            "similarity": float(scores[i]),
+        } for i in best]
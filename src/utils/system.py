@@ -0,0 +1,93 @@
+import os
+import resource
+import sys
+import time
+
+
+def current_rss_mb() -> float:
+    """
+    Returns the resident set size of the current process in MB.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the current process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of the current process to its current RSS,
+    so stage_peak_rss_mb() reports the peak of what runs afterwards.
+
+    Returns:
+      bool: False if the system cannot reset it (only Linux can).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def stage_peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size in MB since the last reset_peak_rss().
+    Unlike peak_rss_mb() (which is never reset), this is read from /proc.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
+        pass
+    return peak_rss_mb()
+
+
+def process_memory_mb(pid: int) -> dict:
+    """
+    Returns the resident (RSS) and proportional (PSS) set sizes of a process in MB.
+    Pages shared by several processes, such as memory-mapped weights, are counted
+    fully in the RSS of each of them but divided among them in the PSS.
+    """
+    memory = {"rss_mb": 0.0, "pss_mb": 0.0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    memory[f"{key.lower()}_mb"] = int(value.split()[0]) / 2**10
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+# Fallback for process_uptime() on systems without /proc
+_import_time = time.time()
+
+
+def process_uptime() -> float:
+    """
+    Returns the number of seconds since the current process was started.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, the fields after it are space separated
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time() - _import_time
@@ -0,0 +1,234 @@
+"""
+Lightweight per-stage tracing with latency histograms exported in the
+Prometheus text format.
+
+Tracing is enabled by the TRACING environment variable. When disabled,
+stage() returns a shared no-op object, so instrumented code pays only for
+one function call. Each request() records its wall time and the CPU time of
+the calling thread (time.thread_time, so concurrent sessions do not inflate
+it; the forward pass runs in the micro-batcher thread and has its own stage).
+When PROFILE_SLOWEST=N is set, each request() is run under cProfile (a
+request nested in another one is part of the outer profile) and the profiles
+of the N slowest requests are written to PROFILE_DIR (open them with snakeviz
+or `python -m pstats`).
+"""
+import bisect
+import cProfile
+import heapq
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(2**i for i in range(10, 28, 2))
+PIXELS_BUCKETS = (0.1e6, 0.25e6, 0.5e6, 1e6, 2e6, 4e6, 8e6, 12e6, 16e6, 24e6, 48e6)
+
+enabled = os.environ.get("TRACING", "") not in ("", "0")
+profile_slowest = int(os.environ.get("PROFILE_SLOWEST", 0))
+profile_dir = os.environ.get("PROFILE_DIR", "profiles")
+
+_lock = threading.Lock()
+_histograms: Dict[Tuple[str, str], "Histogram"] = {}
+_collectors: List[Callable[[], List[str]]] = []
+_slowest: List[Tuple[float, str]] = []  # Min-heap of (duration, profile path)
+_active = threading.local()  # Number of requests running in the thread
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket bounds, as used by Prometheus.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def observe(metric: str, stage: str, value: float, buckets: Tuple[float, ...] = DURATION_BUCKETS) -> None:
+    """
+    Adds a value to the histogram of the metric and stage.
+    """
+    with _lock:
+        histogram = _histograms.get((metric, stage))
+        if histogram is None:
+            histogram = _histograms[(metric, stage)] = Histogram(buckets)
+        histogram.observe(value)
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    Measures the duration of one stage. Sizes can be attached with set().
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_duration_seconds", self.name, time.perf_counter() - self._start)
+        return False
+
+    def set(self, num_bytes: Optional[int] = None, image=None) -> None:
+        """
+        Records the number of processed bytes and/or the dimensions of a PIL image.
+        """
+        if num_bytes is not None:
+            observe("stage_bytes", self.name, num_bytes, BYTES_BUCKETS)
+        if image is not None:
+            observe("stage_image_pixels", self.name, image.size[0] * image.size[1], PIXELS_BUCKETS)
+
+
+def stage(name: str):
+    """
+    Context manager measuring the duration of a stage, e.g.:
+
+      with tracing.stage("decode") as span:
+        image = Image.open(file)
+        span.set(num_bytes=file.size, image=image)
+    """
+    if not enabled:
+        return _NOOP_SPAN
+    return Span(name)
+
+
+class _Request:
+    def __init__(self, name: str):
+        self.name = name
+        self._profiler = None
+
+    def __enter__(self):
+        depth = getattr(_active, "depth", 0)
+        _active.depth = depth + 1
+        # A nested request is part of the profile of the outer one, a second
+        # profiler would replace the hook of the outer profiler
+        if profile_slowest > 0 and depth == 0:
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Another request in a different thread is being profiled
+                self._profiler = None
+        self._start = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        _active.depth -= 1
+        duration = time.perf_counter() - self._start
+        observe("request_duration_seconds", self.name, duration)
+        observe("request_cpu_seconds", self.name, time.thread_time() - self._start_cpu)
+        if self._profiler is not None:
+            self._profiler.disable()
+            _keep_if_slow(self._profiler, self.name, duration)
+        return False
+
+
+def request(name: str):
+    """
+    Context manager measuring a whole request; the request is profiled if PROFILE_SLOWEST is set.
+    """
+    if not enabled:
+        return _NOOP_SPAN
+    return _Request(name)
+
+
+def _keep_if_slow(profiler: cProfile.Profile, name: str, duration: float) -> None:
+    with _lock:
+        if len(_slowest) >= profile_slowest and duration <= _slowest[0][0]:
+            return
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{name}-{duration * 1000:.0f}ms-{time.time_ns()}.prof")
+        profiler.dump_stats(path)
+        heapq.heappush(_slowest, (duration, path))
+        if len(_slowest) > profile_slowest:
+            _, removed = heapq.heappop(_slowest)
+            os.remove(removed)
+
+
+def register_collector(collector: Callable[[], List[str]]) -> None:
+    """
+    Registers a function returning additional lines in the Prometheus text format.
+    """
+    with _lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+
+def render_prometheus(prefix: str = "skin") -> str:
+    """
+    Renders all histograms and registered collectors in the Prometheus text format.
+    """
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        collectors = list(_collectors)
+
+    last_metric = None
+    for (metric, stage_name), histogram in histograms:
+        name = f"{prefix}_{metric}"
+        if metric != last_metric:
+            lines.append(f"# TYPE {name} histogram")
+            last_metric = metric
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'{name}_bucket{{stage="{stage_name}",le="{le}"}} {cumulative}')
+        # Full precision, rate() of a rounded sum would be wrong
+        lines.append(f'{name}_sum{{stage="{stage_name}"}} {histogram.sum!r}')
+        lines.append(f'{name}_count{{stage="{stage_name}"}} {histogram.count}')
+
+    for collector in collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
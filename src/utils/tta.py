@@ -0,0 +1,137 @@
+"""
+Adaptive test-time augmentation (TTA).
+
+Every image first gets the plain forward pass. Only the uncertain ones, whose
+softmax margin between the two most probable classes is below `min_margin` or
+whose normalized entropy is above `max_entropy`, are escalated: their flipped
+and rotated views are stacked into one batch and run in a single forward pass.
+Confident images cost one forward pass, so the average cost stays close to it.
+"""
+import math
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+import torch
+
+from utils.batching import result_or_cancel
+
+
+def augmented_views(pixel_values: torch.Tensor) -> torch.Tensor:
+    """
+    Stacks the flipped and rotated views of the images, without the images themselves.
+    Square images get the 7 non-identity symmetries of the square, others the 3 flips.
+
+    Args:
+      pixel_values (torch.Tensor): Preprocessed images with shape (N, C, H, W).
+
+    Returns:
+      torch.Tensor: The views with shape (V * N, C, H, W), view-major.
+    """
+    views = [pixel_values.flip(-1), pixel_values.flip(-2), pixel_values.flip((-2, -1))]
+    if pixel_values.shape[-1] == pixel_values.shape[-2]:
+        transposed = pixel_values.transpose(-2, -1)
+        views += [transposed, transposed.flip(-1), transposed.flip(-2), transposed.flip((-2, -1))]
+    return torch.cat(views)
+
+
+def uncertainty(logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the softmax margin between the two most probable classes and the
+    entropy normalized to [0, 1] of every image.
+
+    Args:
+      logits (torch.Tensor): Logits with shape (N, number of classes).
+    """
+    probs = torch.softmax(logits.float(), dim=1)
+    top2 = torch.topk(probs, 2, dim=1).values
+    entropy = -(probs * torch.log(probs.clamp_min(1e-12))).sum(dim=1) / math.log(logits.shape[1])
+    return top2[:, 0] - top2[:, 1], entropy
+
+
+def aggregate(logits: torch.Tensor, num_images: int) -> torch.Tensor:
+    """
+    Averages the probabilities of the views of every image.
+
+    Args:
+      logits (torch.Tensor): Logits of the views with shape (V * N, number of classes), view-major.
+      num_images (int): Number of images N.
+
+    Returns:
+      torch.Tensor: Log of the mean probabilities with shape (N, number of classes),
+      their softmax is the mean probability of the views.
+    """
+    log_probs = torch.log_softmax(logits.float(), dim=1).reshape(-1, num_images, logits.shape[1])
+    return torch.logsumexp(log_probs, dim=0) - math.log(len(log_probs))
+
+
+class AdaptiveTTA:
+    """
+    Escalates uncertain predictions to test-time augmentation.
+
+    Args:
+      submit (Callable): Function queueing pixel values (N, C, H, W) and returning a Future of
+        their logits (N, K), e.g. MicroBatcher.submit.
+      min_margin (float): Images whose top-2 probability margin is below it are escalated.
+      max_entropy (float): Images whose normalized entropy is above it are escalated (1 disables the check).
+    """
+
+    def __init__(self, submit: Callable[[torch.Tensor], Future], min_margin: float = 0.2,
+                 max_entropy: float = 1.0):
+        self.submit = submit
+        self.min_margin = min_margin
+        self.max_entropy = max_entropy
+        self.requests = 0
+        self.escalated = 0
+        self.added_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def needs_augmentation(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Returns a boolean mask of the images to escalate.
+        """
+        margin, entropy = uncertainty(logits)
+        return (margin < self.min_margin) | (entropy > self.max_entropy)
+
+    def __call__(self, pixel_values: torch.Tensor, logits: torch.Tensor, timeout: Optional[float] = None) -> torch.Tensor:
+        """
+        Refines the logits of the plain forward pass.
+
+        Args:
+          pixel_values (torch.Tensor): Preprocessed images with shape (N, C, H, W).
+          logits (torch.Tensor): Their logits from the plain forward pass, shape (N, K).
+          timeout (float | None): Seconds left for the augmented forward pass, it is cancelled after.
+
+        Returns:
+          torch.Tensor: The logits of the confident images unchanged, the log of the
+          mean probabilities of all views for the escalated ones.
+
+        Raises:
+          concurrent.futures.TimeoutError: The augmented forward pass did not finish within `timeout`.
+        """
+        start = time.perf_counter()
+        escalate = self.needs_augmentation(logits)
+        count = int(escalate.sum())
+        if count:
+            selected = pixel_values[escalate]
+            views_logits = result_or_cancel(self.submit(augmented_views(selected)), timeout)
+            refined = aggregate(torch.cat([logits[escalate].float(), views_logits.float()]), count)
+            logits = logits.float().clone()
+            logits[escalate] = refined
+
+        with self._lock:
+            self.requests += len(escalate)
+            self.escalated += count
+            if count:
+                self.added_seconds += time.perf_counter() - start
+        return logits
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalated / self.requests if self.requests else 0.0,
+            "added_seconds": self.added_seconds,
+            "mean_added_ms": 1000 * self.added_seconds / self.requests if self.requests else 0.0,
+        }
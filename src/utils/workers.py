@@ -0,0 +1,425 @@
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.spawn
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+
+def available_cores() -> List[int]:
+    """
+    Returns the CPU cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _worker_main(index: int, tasks, results, threads: int, cores: Optional[List[int]], model_name: Optional[str],
+                 backend_name: Optional[str], max_batch_size: int) -> None:
+    # Runs in the worker process, the thread budget must be set before the first parallel operation
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    try:
+        from utils.backends import load_backend
+        from utils.model import load_processor_and_model, warm_up
+        from utils.preprocessing import FastPreprocessor
+
+        # Loaded from a bundle, the weights are memory-mapped and their pages are shared by all workers
+        processor, model = load_processor_and_model(model_name)
+        backend = load_backend(model, backend_name, inplace=True)
+        warm_up(backend, FastPreprocessor.from_processor(processor))
+    except Exception as e:
+        results.send((None, index, f"{type(e).__name__}: {e}"))
+        return
+    results.send((None, index, None))
+
+    stopping = False
+    while not stopping:
+        task = tasks.get()
+        if task is None:
+            break
+
+        # Take the requests which queued up meanwhile into the same forward pass,
+        # (task id, None) cancels a queued request whose deadline passed
+        batch = [task]
+        size = 0 if task[1] is None else len(task[1])
+        while size < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                stopping = True
+                break
+            batch.append(task)
+            if task[1] is not None:
+                size += len(task[1])
+
+        cancelled = {task_id for task_id, pixel_values in batch if pixel_values is None}
+        batch = [task for task in batch if task[1] is not None and task[0] not in cancelled]
+        if not batch:
+            continue
+
+        try:
+            logits = backend(torch.from_numpy(np.concatenate([pixel_values for _, pixel_values in batch]))).numpy()
+        except Exception as e:
+            for task_id, _ in batch:
+                results.send((task_id, None, f"{type(e).__name__}: {e}"))
+            continue
+
+        start = 0
+        for task_id, pixel_values in batch:
+            results.send((task_id, logits[start:start + len(pixel_values)], None))
+            start += len(pixel_values)
+
+
+WORKER_NAME_PREFIX = "inference-worker-"
+
+
+def _preparation_data(name: str) -> dict:
+    # Spawned processes import the __main__ module of the parent first. Streamlit
+    # runs the app as __main__, so every worker would run the whole page again;
+    # the workers need nothing from it and start without it. This leaves
+    # sys.modules["__main__"] alone, which the script runs of other sessions set.
+    data = _get_preparation_data(name)
+    if name.startswith(WORKER_NAME_PREFIX):
+        data.pop("init_main_from_name", None)
+        data.pop("init_main_from_path", None)
+    return data
+
+
+# Read at every start of a spawned process, wrapped once even if this module is reloaded
+_get_preparation_data = getattr(multiprocessing.spawn.get_preparation_data, "__wrapped__",
+                                multiprocessing.spawn.get_preparation_data)
+_preparation_data.__wrapped__ = _get_preparation_data
+multiprocessing.spawn.get_preparation_data = _preparation_data
+
+
+class WorkerPool:
+    """
+    Inference service running the model in several worker processes.
+
+    Every worker uses its own torch thread budget and can be pinned to its own
+    cores, so concurrent requests neither oversubscribe nor leave cores idle.
+    Every worker has its own task queue and a request goes to the worker with
+    the fewest outstanding requests; a worker takes the requests waiting in its
+    queue into one batch (up to `max_batch_size` images). A worker which dies
+    (e.g. killed when out of memory) fails its outstanding requests and is
+    restarted, so the pool keeps serving. A worker which dies again before it
+    has loaded the model is restarted after an exponentially growing delay;
+    after `max_restarts` such failures in a row the pool is marked failed and
+    submit() raises.
+
+    The workers load the model with load_processor_and_model(). When it comes
+    from a bundle (MODEL_DIR, see build_bundle.py) the weights are memory-mapped,
+    so all workers share the same physical pages instead of holding a copy each.
+
+    Has the same interface as MicroBatcher.
+
+    Args:
+      num_workers (int): Number of worker processes.
+      threads_per_worker (int | None): Torch threads of each worker, by default the cores are divided among the workers.
+      pin_cores (bool): Pin each worker to its own `threads_per_worker` cores.
+      model_name (str | None): Model to load, see resolve_model_path().
+      backend_name (str | None): Inference backend, see load_backend().
+      max_batch_size (int): Maximum number of images in one forward pass of a worker.
+      start_timeout (float): Seconds to wait for the workers to load the model.
+      max_restarts (int): Restarts in a row of a worker dying before it is ready, after which the pool fails.
+      restart_backoff (float): Seconds before restarting a worker which failed once, doubled on every further failure.
+    """
+
+    def __init__(self, num_workers: int, threads_per_worker: Optional[int] = None, pin_cores: bool = False,
+                 model_name: Optional[str] = None, backend_name: Optional[str] = None, max_batch_size: int = 8,
+                 start_timeout: float = 300, max_restarts: int = 5, restart_backoff: float = 1.0):
+        cores = available_cores()
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, len(cores) // num_workers)
+        self.max_batch_size = max_batch_size
+        self.requests = 0
+        self.restarts = 0
+        self.max_restarts = max_restarts
+        self.restart_backoff = restart_backoff
+        self.error: Optional[str] = None  # Set when the pool failed
+
+        # Spawned workers do not inherit the threads of the parent (Streamlit, the batcher, torch)
+        self._context = multiprocessing.get_context("spawn")
+        # A killed worker may leave the lock of a queue held, so every worker has its own
+        # task queue and sends its results through its own pipe, which needs no lock
+        self._queues = [None] * num_workers
+        self._results = [None] * num_workers
+        self._assigned = [set() for _ in range(num_workers)]  # Ids of the outstanding requests of every worker
+        self._owners: Dict[int, int] = {}  # Worker of every outstanding request
+        self._ready = [False] * num_workers  # Whether the current process of every worker loaded the model
+        self._failures = [0] * num_workers  # Processes in a row of every worker which died before they were ready
+        self._restart_at: Dict[int, float] = {}  # Dead workers and when to restart them
+        self._futures: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._worker_cores = []
+        for index in range(num_workers):
+            worker_cores = None
+            if pin_cores:
+                first = index * self.threads_per_worker
+                worker_cores = [cores[(first + i) % len(cores)] for i in range(self.threads_per_worker)]
+            self._worker_cores.append(worker_cores)
+        self._model_name = model_name
+        self._backend_name = backend_name
+        self.processes = []
+        for index in range(num_workers):
+            self._queues[index], self._results[index], process = self._start_worker(index)
+            self.processes.append(process)
+
+        try:
+            self._wait_until_ready(start_timeout)
+        except Exception:
+            self._terminate()
+            raise
+        self._ready = [True] * num_workers
+
+        self._collector = threading.Thread(target=self._collect, name="worker-pool-results", daemon=True)
+        self._collector.start()
+
+    def _start_worker(self, index: int):
+        # Returns the task queue, the result pipe and the started process of a worker,
+        # spawning takes a while so no lock is held
+        tasks = self._context.Queue()
+        results, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, tasks, sender, self.threads_per_worker, self._worker_cores[index],
+                  self._model_name, self._backend_name, self.max_batch_size),
+            name=f"{WORKER_NAME_PREFIX}{index}",
+            daemon=True,
+        )
+        process.start()
+        # Only the worker writes to the pipe, reading from it fails once the worker exited
+        sender.close()
+        return tasks, results, process
+
+    def _receive(self, timeout: float) -> list:
+        # Waits for the messages sent by the workers, the pipe of an exited worker is dropped
+        with self._lock:
+            pipes = [results for results in self._results if results is not None]
+        messages = []
+        for results in multiprocessing.connection.wait(pipes, timeout):
+            try:
+                messages.append(results.recv())
+            except (EOFError, OSError):
+                with self._lock:
+                    self._results = [None if other is results else other for other in self._results]
+                results.close()
+        return messages
+
+    def _wait_until_ready(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        ready = 0
+        while ready < self.num_workers:
+            messages = self._receive(1.0)
+            # A worker which cannot even import the model code exits without a message
+            if not messages and not all(process.is_alive() for process in self.processes):
+                raise RuntimeError("An inference worker exited while starting")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The inference workers did not start within {timeout:g} seconds")
+            for _, index, error in messages:
+                if error is not None:
+                    raise RuntimeError(f"Inference worker {index} failed to start: {error}")
+                ready += 1
+
+    def submit(self, pixel_values: torch.Tensor) -> Future:
+        """
+        Queues images for inference.
+
+        Args:
+          pixel_values (torch.Tensor): Preprocessed images with shape (N, C, H, W).
+
+        Returns:
+          Future: Resolves to the logits of the submitted images.
+        """
+        future = Future()
+        with self._lock:
+            if self.error is not None:
+                raise RuntimeError(f"The worker pool failed: {self.error}")
+            if self._closed:
+                raise RuntimeError("The worker pool is closed")
+            # Workers waiting for their restart get no requests
+            running = [i for i in range(self.num_workers) if i not in self._restart_at]
+            if not running:
+                raise RuntimeError("No inference worker is running, they are being restarted")
+            task_id = next(self._ids)
+            index = min(running, key=lambda i: len(self._assigned[i]))
+            self._assigned[index].add(task_id)
+            self._owners[task_id] = index
+            self._futures[task_id] = future
+            tasks = self._queues[index]
+            self.requests += 1
+        future.add_done_callback(partial(self._on_done, task_id))
+        tasks.put((task_id, pixel_values.numpy()))
+        return future
+
+    def _on_done(self, task_id: int, future: Future) -> None:
+        # A request cancelled before its result arrived is dropped by its worker
+        if future.cancelled():
+            with self._lock:
+                self._futures.pop(task_id, None)
+                index = self._owners.pop(task_id, None)
+                if index is None:
+                    return
+                self._assigned[index].discard(task_id)
+                tasks = self._queues[index]
+            tasks.put((task_id, None))
+
+    def predict(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Blocking version of submit().
+        """
+        return self.submit(pixel_values).result()
+
+    def _collect(self) -> None:
+        # Resolves the futures with the results sent back by the workers
+        next_check = time.monotonic() + 1.0
+        while True:
+            messages = self._receive(1.0)
+            if not messages and self._closed:
+                return
+
+            if time.monotonic() >= next_check:
+                self._restart_dead_workers()
+                next_check = time.monotonic() + 1.0
+
+            for task_id, logits, error in messages:
+                self._resolve(task_id, logits, error)
+
+    def _resolve(self, task_id: Optional[int], logits, error: Optional[str]) -> None:
+        if task_id is None:
+            # Ready message of a restarted worker: (None, worker index, error)
+            if error is not None:
+                print(f"Inference worker {logits} failed to start: {error}", file=sys.stderr)
+            else:
+                with self._lock:
+                    self._ready[logits] = True
+                    self._failures[logits] = 0
+            return
+
+        with self._lock:
+            future = self._futures.pop(task_id, None)
+            index = self._owners.pop(task_id, None)
+            if index is not None:
+                self._assigned[index].discard(task_id)
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+                future.set_result(torch.from_numpy(logits))
+
+    def _restart_dead_workers(self) -> None:
+        # The requests of a dead worker fail, the worker is replaced with a new process and queue
+        failed = []
+        due = []
+        with self._lock:
+            if self._closed or self.error is not None:
+                return
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if index in self._restart_at:
+                    if now >= self._restart_at[index]:
+                        due.append(index)
+                    continue
+                if process.is_alive():
+                    continue
+
+                for task_id in self._assigned[index]:
+                    self._owners.pop(task_id, None)
+                    failed.append(self._futures.pop(task_id))
+                self._assigned[index] = set()
+
+                # A worker which cannot load the model will likely fail again, it is retried later and later
+                if not self._ready[index]:
+                    self._failures[index] += 1
+                if self._failures[index] > self.max_restarts:
+                    self.error = (f"inference worker {index} exited with code {process.exitcode} "
+                                  f"{self._failures[index]} times in a row before it was ready")
+                    failed.extend(self._futures.values())
+                    self._futures.clear()
+                    self._owners.clear()
+                    print(f"The worker pool failed: {self.error}", file=sys.stderr)
+                    break
+                delay = self.restart_backoff * 2 ** (self._failures[index] - 1) if self._failures[index] else 0.0
+                self._restart_at[index] = now + delay
+                print(f"Inference worker {index} exited with code {process.exitcode}, restarting it in {delay:g} s",
+                      file=sys.stderr)
+                if delay == 0:
+                    due.append(index)
+
+        error = RuntimeError(f"The worker pool failed: {self.error}" if self.error is not None
+                             else "An inference worker exited unexpectedly")
+        for future in failed:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        if self.error is not None:
+            return
+
+        for index in due:
+            tasks, results, process = self._start_worker(index)
+            with self._lock:
+                closed = self._closed
+                stale = self._results[index]
+                if not closed:
+                    self._queues[index], self._results[index], self.processes[index] = tasks, results, process
+                    self._ready[index] = False
+                    del self._restart_at[index]
+                    self.restarts += 1
+            if stale is not None and not closed:
+                stale.close()
+            if closed:
+                # close() ran meanwhile and did not see the new process
+                process.terminate()
+                process.join()
+                results.close()
+                return
+
+    def _terminate(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def close(self) -> None:
+        """
+        Stops the workers after the queued requests are served.
+        """
+        with self._lock:
+            if self._closed and not any(process.is_alive() for process in self.processes):
+                return
+            self._closed = True
+        for tasks in self._queues:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+        self._terminate()
+        self._collector.join()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "workers": self.num_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "pending": len(self._futures),
+            "restarts": self.restarts,
+            "failed": self.error is not None,
+        }